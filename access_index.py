@@ -0,0 +1,91 @@
+import math
+import logging
+from datetime import datetime, timezone
+
+logger = logging.getLogger(__name__)
+
+
+class AccessIndex:
+    """UUID -> (user_id, expires_at) для активных подписок в памяти
+
+    Проверка доступа по UUID не обращается к Firestore. Пользователь без
+    записи в индексе доступа не имеет, истекшие записи отклоняются по
+    сроку и удаляются при обращении.
+    """
+
+    def __init__(self):
+        self._by_uuid = {}
+        self._uuid_by_user = {}
+        self.ready = False
+        self.last_sync = None
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._by_uuid)
+
+    def put(self, user_id: str, vless_uuid: str, expires_at: datetime):
+        """Записывает доступ пользователя, старый UUID пользователя вытесняется"""
+        if not vless_uuid or expires_at is None:
+            self.remove_user(user_id)
+            return
+
+        old_uuid = self._uuid_by_user.get(user_id)
+        if old_uuid and old_uuid != vless_uuid:
+            self._by_uuid.pop(old_uuid, None)
+        self._uuid_by_user[user_id] = vless_uuid
+        self._by_uuid[vless_uuid] = (user_id, expires_at)
+
+    def remove_user(self, user_id: str):
+        vless_uuid = self._uuid_by_user.pop(user_id, None)
+        if vless_uuid:
+            self._by_uuid.pop(vless_uuid, None)
+
+    def apply_user(self, user_id: str, user_data: dict):
+        """Обновляет запись по документу пользователя с вычисленным состоянием подписки"""
+        if user_data.get('has_subscription'):
+            self.put(user_id, user_data.get('vless_uuid'), user_data.get('expires_at'))
+        else:
+            self.remove_user(user_id)
+
+    def load(self, users: list, synced_at: datetime):
+        """Полная загрузка из списка (user_id, user_data)"""
+        self._by_uuid.clear()
+        self._uuid_by_user.clear()
+        for user_id, user_data in users:
+            self.apply_user(user_id, user_data)
+        self.ready = True
+        self.last_sync = synced_at
+        logger.info(f"✅ Access index loaded: {len(self._by_uuid)} active UUIDs")
+
+    def apply_delta(self, users: list, synced_at: datetime) -> int:
+        for user_id, user_data in users:
+            self.apply_user(user_id, user_data)
+        self.last_sync = synced_at
+        return len(users)
+
+    def check(self, vless_uuid: str, now: datetime = None) -> dict:
+        """Возвращает user_id и оставшиеся дни или None, если доступа нет"""
+        entry = self._by_uuid.get(vless_uuid)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        user_id, expires_at = entry
+        remaining = (expires_at - (now or datetime.now(timezone.utc))).total_seconds()
+        if remaining <= 0:
+            self.remove_user(user_id)
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return {"user_id": user_id, "subscription_days": math.ceil(remaining / 86400)}
+
+    def stats(self) -> dict:
+        return {
+            "ready": self.ready,
+            "entries": len(self._by_uuid),
+            "hits": self.hits,
+            "misses": self.misses,
+            "last_sync": self.last_sync.isoformat() if self.last_sync else None
+        }
@@ -1,19 +1,18 @@
 from fastapi import FastAPI, HTTPException, Request, BackgroundTasks
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import HTMLResponse, FileResponse, JSONResponse
+from fastapi.responses import HTMLResponse, FileResponse, JSONResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 import uvicorn
 import os
 import logging
 import asyncio
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 import threading
 import subprocess
+import time
 import sys
 import uuid
-import httpx
-import firebase_admin
-from firebase_admin import credentials, firestore
+from firebase_admin import firestore
 from pydantic import BaseModel
 import re
 import json
@@ -21,8 +20,24 @@ import urllib.parse
 from typing import List, Optional
 from PIL import Image, ImageDraw, ImageFont
 import io
-from apscheduler.schedulers.background import BackgroundScheduler
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.interval import IntervalTrigger
+import database
+from expiry_index import ExpiryIndex
+from access_index import AccessIndex
+from xray_nodes import NodeClientRegistry
+from node_health import NodeHealthProber
+from payment_events import PaymentEvents
+from yookassa_client import YooKassaClient, CircuitOpenError
+from provisioning_outbox import ProvisioningOutbox, ACTION_ADD, ACTION_REMOVE
+from xray_manager import uuid_set_digest
+from database import (
+    get_user, create_user, update_user, update_user_balance, find_user_by_uuid,
+    get_subscribed_users, get_last_users, referral_exists,
+    add_referral_bonus_immediately, save_vless_key_to_db, get_user_vless_keys,
+    set_user_vless_keys_status, get_recent_vless_keys,
+    save_payment, update_payment_status, get_payment
+)
 
 # Настройка логирования
 logging.basicConfig(
@@ -59,6 +74,20 @@ XRAY_SERVERS = {
     }
 }
 
+# Пул keep-alive клиентов к API нод Xray
+xray_clients = NodeClientRegistry(XRAY_SERVERS)
+XRAY_BATCH_SIZE = 1000
+# Фоновый опрос здоровья нод: эндпоинты и выбор сервера читают его кэш
+node_health = NodeHealthProber(xray_clients)
+# Дедлайны на ноду при параллельном опросе: проверки, изменения, сверка
+XRAY_CHECK_DEADLINE = 3.0
+XRAY_MUTATION_DEADLINE = 60.0
+XRAY_RECONCILE_DEADLINE = 180.0
+# Постраничный вывод пользователей ноды в админке
+XRAY_USERS_PAGE_SIZE = 1000
+XRAY_USERS_PAGE_MAX = 50000
+XRAY_USERS_STREAM_CHUNK = 300
+
 VLESS_SERVERS = [
     {
         "id": "London", 
@@ -73,6 +102,16 @@ VLESS_SERVERS = [
     }
 ]
 
+# YooKassa: общий клиент с пулом соединений, single-flight и предохранителем
+yookassa = YooKassaClient()
+# Если уведомления настроены, /payment-status отвечает только из базы
+YOOKASSA_WEBHOOKS_ENABLED = os.getenv("YOOKASSA_WEBHOOKS_ENABLED", "false").lower() == "true"
+# Поток статуса платежа: keep-alive, проверка шлюза без уведомлений, время жизни
+PAYMENT_EVENTS_HEARTBEAT = 15.0
+PAYMENT_EVENTS_GATEWAY_INTERVAL = 15.0
+PAYMENT_EVENTS_MAX_SECONDS = 600.0
+payment_events = PaymentEvents()
+
 # Тарифы
 TARIFFS = {
     "1month": {
@@ -91,39 +130,43 @@ TARIFFS = {
 REFERRAL_BONUS_REFERRER = 50.0
 REFERRAL_BONUS_REFERRED = 100.0
 
+# Проверка истекших подписок
+SUBSCRIPTION_SWEEP_INTERVAL_HOURS = 6
+SUBSCRIPTION_SWEEP_PAGE_SIZE = 300
+SUBSCRIPTION_SWEEP_MAX_PAGES = 1000
+last_subscription_sweep = {}
+
+# Сверка пользователей на нодах Xray с активными подписками
+RECONCILE_INTERVAL_MINUTES = 30
+# Больше этой доли клиентов ноды за один прогон не удаляем
+RECONCILE_MAX_REMOVE_RATIO = 0.2
+RECONCILE_MIN_REMOVE_GUARD = 10
+reconcile_lock = asyncio.Lock()
+last_reconcile = {}
+
+# Сверка незавершенных платежей со шлюзом: окно по дате создания,
+# свежие платежи оставляем webhook и странице оплаты
+PAYMENT_RECONCILE_INTERVAL_MINUTES = 10
+PAYMENT_RECONCILE_WINDOW = timedelta(days=3)
+PAYMENT_RECONCILE_MIN_AGE = timedelta(minutes=5)
+PAYMENT_RECONCILE_PAGE_SIZE = 200
+PAYMENT_RECONCILE_MAX_PAGES = 50
+PAYMENT_RECONCILE_CONCURRENCY = 10
+# Через сколько незавершенную активацию оплаченного тарифа повторяет сверка
+PAYMENT_APPLY_LEASE = timedelta(minutes=10)
+payment_reconcile_lock = asyncio.Lock()
+last_payment_reconcile = {}
+
+# Индекс доступа по UUID: досинхронизация изменений из Firestore.
+# Перекрытие окна покрывает расхождение часов сервера и Firestore
+ACCESS_INDEX_SYNC_SECONDS = 60
+ACCESS_INDEX_SYNC_OVERLAP = timedelta(minutes=2)
+ACCESS_BATCH_MAX_ITEMS = 20000
+
+scheduler = AsyncIOScheduler()
+
 # Инициализация Firebase
-try:
-    if not firebase_admin._apps:
-        logger.info("🚀 Initializing Firebase for Railway")
-        
-        firebase_config = {
-            "type": "service_account",
-            "project_id": os.getenv("FIREBASE_PROJECT_ID"),
-            "private_key_id": os.getenv("FIREBASE_PRIVATE_KEY_ID"),
-            "private_key": os.getenv("FIREBASE_PRIVATE_KEY", "").replace('\\n', '\n'),
-            "client_email": os.getenv("FIREBASE_CLIENT_EMAIL"),
-            "client_id": os.getenv("FIREBASE_CLIENT_ID"),
-            "auth_uri": "https://accounts.google.com/o/oauth2/auth",
-            "token_uri": "https://oauth2.googleapis.com/token",
-            "auth_provider_x509_cert_url": "https://www.googleapis.com/oauth2/v1/certs",
-            "client_x509_cert_url": os.getenv("FIREBASE_CLIENT_X509_CERT_URL"),
-            "universe_domain": "googleapis.com"
-        }
-        
-        required_fields = ["project_id", "private_key", "client_email"]
-        for field in required_fields:
-            if not firebase_config.get(field):
-                raise ValueError(f"Missing required Firebase config field: {field}")
-        
-        cred = credentials.Certificate(firebase_config)
-        firebase_admin.initialize_app(cred)
-    
-    db = firestore.client()
-    logger.info("✅ Firebase initialized successfully")
-    
-except Exception as e:
-    logger.error(f"❌ Firebase initialization failed: {str(e)}")
-    db = None
+db = database.init_firebase()
 
 # Модели данных
 class PaymentRequest(BaseModel):
@@ -161,6 +204,9 @@ class BuyWithBalanceRequest(BaseModel):
     tariff_days: int
     selected_server: str = None
 
+class AccessBatchRequest(BaseModel):
+    uuids: List[str]
+
 class SaveVlessKeyRequest(BaseModel):
     user_id: str
     server_id: str
@@ -217,141 +263,81 @@ def create_placeholder_logo():
         logger.error(f"❌ Error creating placeholder logo: {e}")
 
 # Функции работы с Xray через API - ОПТИМИЗИРОВАННЫЕ ВЕРСИИ
+def xray_targets(server_id: str = None) -> List[str]:
+    """Ноды для операции: выбранная, если она известна, иначе все"""
+    if server_id in XRAY_SERVERS:
+        return [server_id]
+    return list(XRAY_SERVERS.keys())
+
 async def check_user_in_xray(user_uuid: str, server_id: str = None) -> bool:
     """Проверить есть ли пользователь в Xray - БЫСТРАЯ ВЕРСИЯ"""
+    async def exists_on(server_name: str) -> bool:
+        response = await xray_clients.get(server_name, f"/user/{user_uuid}", timeout=XRAY_CHECK_DEADLINE)
+        return response.status_code == 200 and response.json().get('exists', False)
+    
     try:
-        if server_id and server_id in XRAY_SERVERS:
-            servers_to_check = [(server_id, XRAY_SERVERS[server_id])]
-        else:
-            servers_to_check = list(XRAY_SERVERS.items())
-        
-        for server_name, server_config in servers_to_check:
-            try:
-                async with httpx.AsyncClient() as client:
-                    response = await client.get(
-                        f"{server_config['url']}/user/{user_uuid}",
-                        headers={"X-API-Key": server_config["api_key"]},
-                        timeout=3.0  # Уменьшили таймаут
-                    )
-                    
-                    if response.status_code == 200:
-                        data = response.json()
-                        if data.get('exists'):
-                            return True
-            except Exception:
-                continue
-        
-        return False
-            
+        # Опрашиваем ноды параллельно, первый положительный ответ отменяет остальные
+        found = await xray_clients.first_success(
+            xray_targets(server_id), exists_on, deadline=XRAY_CHECK_DEADLINE
+        )
+        return found is not None
     except Exception as e:
         logger.error(f"❌ [XRAY CHECK] Exception: {str(e)}")
         return False
 
-def remove_user_from_xray(user_uuid: str) -> bool:
-    """Удалить пользователя из Xray config"""
-    try:
-        logger.info(f"🔄 Удаляем пользователя {user_uuid} из Xray config...")
-        
-        with open(XRAY_CONFIG_PATH, 'r') as f:
-            config = json.load(f)
-
-        user_removed = False
-        
-        # Находим VLESS inbound
-        for inbound in config.get('inbounds', []):
-            if (inbound.get('protocol') == 'vless' and
-                inbound.get('settings', {}).get('clients') is not None):
-                
-                clients = inbound['settings']['clients']
-                original_count = len(clients)
-                
-                # Удаляем пользователя
-                inbound['settings']['clients'] = [
-                    client for client in clients 
-                    if client.get('id') != user_uuid
-                ]
-                
-                if len(inbound['settings']['clients']) < original_count:
-                    user_removed = True
-                    logger.info(f"✅ Пользователь {user_uuid} удален из Xray config")
-                    logger.info(f"📊 Осталось пользователей: {len(inbound['settings']['clients'])}")
-                break
-
-        if not user_removed:
-            logger.info(f"ℹ️ Пользователь {user_uuid} не найден в Xray config")
-            return True
-
-        # Сохраняем конфиг
-        with open(XRAY_CONFIG_PATH, 'w') as f:
-            json.dump(config, f, indent=2)
-        
-        # Перезагружаем Xray
-        try:
-            subprocess.run(['systemctl', 'reload', 'xray'], check=True, timeout=10)
-            logger.info("🔄 Xray перезагружен после удаления пользователя")
-        except Exception as e:
-            logger.error(f"❌ Ошибка перезагрузки Xray: {e}")
-            return False
+async def xray_batch(server_id: str, add: List[str] = None, remove: List[str] = None) -> dict:
+    """Пакетное добавление/удаление на одной ноде за один запрос, результат по каждому UUID"""
+    add = add or []
+    remove = remove or []
+    results = {}
+    
+    for start in range(0, max(len(add), len(remove)), XRAY_BATCH_SIZE):
+        add_chunk = add[start:start + XRAY_BATCH_SIZE]
+        remove_chunk = remove[start:start + XRAY_BATCH_SIZE]
+        
+        response = await xray_clients.post(
+            server_id,
+            "/users/batch",
+            json={"add": [{"uuid": user_uuid} for user_uuid in add_chunk], "remove": remove_chunk},
+            timeout=60.0
+        )
         
-        return True
+        if response.status_code == 404:
+            # Нода без пакетного API: поштучные запросы
+            results.update(await xray_single_requests(server_id, add_chunk, remove_chunk))
+            continue
         
-    except Exception as e:
-        logger.error(f"❌ Ошибка удаления пользователя из Xray: {e}")
-        return False
+        if response.status_code != 200:
+            logger.warning(f"⚠️ Batch to {server_id} returned {response.status_code}")
+            for user_uuid in add_chunk + remove_chunk:
+                results[user_uuid] = False
+            continue
         
-async def remove_user_from_xray(user_uuid: str, server_id: str = None) -> bool:
-    """Удалить пользователя из Xray сервер(ы)"""
-    try:
-        logger.info(f"🗑️ [XRAY REMOVE] Removing user: {user_uuid} from server: {server_id}")
-        return True
-    except Exception as e:
-        logger.error(f"❌ [XRAY REMOVE] Exception: {str(e)}")
-        return False
+        for item in response.json().get("results", []):
+            results[item["uuid"]] = item.get("success", False)
+    
+    return results
+
+async def xray_single_requests(server_id: str, add: List[str], remove: List[str]) -> dict:
+    """Поштучное добавление/удаление для нод без /users/batch"""
+    results = {}
+    for user_uuid in add:
+        response = await xray_clients.post(server_id, "/user", json={"uuid": user_uuid})
+        results[user_uuid] = response.status_code in [200, 201]
+    for user_uuid in remove:
+        response = await xray_clients.request(server_id, "DELETE", f"/user/{user_uuid}")
+        results[user_uuid] = response.status_code in [200, 204, 404]
+    return results
 
 async def get_xray_users_count(server_id: str = None) -> int:
-    """Получить количество пользователей в Xray"""
+    """Получить количество пользователей в Xray из кэша опроса нод"""
     try:
-        return 0
+        return node_health.users_count(server_id)
     except Exception as e:
         logger.error(f"❌ Error getting Xray users count: {e}")
         return 0
 
 # Функции работы с Firebase
-def get_user(user_id: str):
-    if not db: 
-        return None
-    try:
-        doc = db.collection('users').document(user_id).get()
-        return doc.to_dict() if doc.exists else None
-    except Exception as e:
-        logger.error(f"❌ Error getting user: {e}")
-        return None
-
-def update_user_balance(user_id: str, amount: float):
-    if not db: 
-        return False
-    try:
-        user_ref = db.collection('users').document(user_id)
-        user = user_ref.get()
-        
-        if user.exists:
-            user_data = user.to_dict()
-            current_balance = user_data.get('balance', 0.0)
-            new_balance = current_balance + amount
-            
-            user_ref.update({
-                'balance': new_balance,
-                'updated_at': firestore.SERVER_TIMESTAMP
-            })
-            
-            logger.info(f"💰 Balance updated for user {user_id}: {current_balance} -> {new_balance}")
-            return True
-        else:
-            return False
-    except Exception as e:
-        logger.error(f"❌ Error updating balance: {e}")
-        return False
-
 def generate_user_uuid():
     """Генерация уникального UUID для пользователя"""
     return str(uuid.uuid4())
@@ -362,23 +348,18 @@ async def ensure_user_uuid(user_id: str, server_id: str = None) -> str:
         raise Exception("Database not connected")
     
     try:
-        user_ref = db.collection('users').document(user_id)
-        user = user_ref.get()
+        user_data = await get_user(user_id)
         
-        if not user.exists:
+        if not user_data:
             raise Exception("User not found")
         
-        user_data = user.to_dict()
         vless_uuid = user_data.get('vless_uuid')
         
         if vless_uuid:
             logger.info(f"🔍 User {user_id} has existing UUID: {vless_uuid}")
             
-            # БЫСТРОЕ ДОБАВЛЕНИЕ: не проверяем, просто добавляем
-            servers_to_add = [server_id] if server_id else list(XRAY_SERVERS.keys())
-            
-            # Запускаем добавление асинхронно без ожидания
-            asyncio.create_task(fast_add_to_xray(vless_uuid, servers_to_add))
+            # БЫСТРОЕ ДОБАВЛЕНИЕ: только запись в outbox, доставка в фоне
+            provisioning_outbox.enqueue_add(vless_uuid, xray_targets(server_id))
             
             return vless_uuid
         
@@ -387,14 +368,15 @@ async def ensure_user_uuid(user_id: str, server_id: str = None) -> str:
         logger.info(f"🆕 Generating new UUID for user {user_id}: {new_uuid}")
         
         # Обновляем пользователя
-        user_ref.update({
+        saved = await update_user(user_id, {
             'vless_uuid': new_uuid,
             'updated_at': firestore.SERVER_TIMESTAMP
         })
+        if not saved:
+            raise Exception("Failed to save UUID")
         
         # Быстро добавляем на серверы
-        servers_to_add = [server_id] if server_id else list(XRAY_SERVERS.keys())
-        asyncio.create_task(fast_add_to_xray(new_uuid, servers_to_add))
+        provisioning_outbox.enqueue_add(new_uuid, xray_targets(server_id))
         
         return new_uuid
         
@@ -402,118 +384,41 @@ async def ensure_user_uuid(user_id: str, server_id: str = None) -> str:
         logger.error(f"❌ Error ensuring user UUID: {e}")
         raise
 
-async def fast_add_to_xray(user_uuid: str, servers_to_add):
-    """Быстрое добавление в Xray без блокировки основного потока"""
-    try:
-        for server_name in servers_to_add:
-            if server_name in XRAY_SERVERS:
-                try:
-                    async with httpx.AsyncClient() as client:
-                        await client.post(
-                            f"{XRAY_SERVERS[server_name]['url']}/user",
-                            headers={
-                                "X-API-Key": XRAY_SERVERS[server_name]["api_key"],
-                                "Content-Type": "application/json"
-                            },
-                            json={"uuid": user_uuid},
-                            timeout=5.0
-                        )
-                    logger.info(f"⚡ FAST: User {user_uuid} sent to {server_name}")
-                except Exception as e:
-                    logger.warning(f"⚠️ Fast add failed for {server_name}: {e}")
-    except Exception as e:
-        logger.error(f"❌ Error in fast_add_to_xray: {e}")
-
-def add_referral_bonus_immediately(referrer_id: str, referred_id: str):
-    if not db: 
-        return False
+async def add_user_to_xray(user_uuid: str, server_id: str = None) -> bool:
+    """Добавить пользователя в Xray с ожиданием ответа нод"""
+    async def add_to(server_name: str) -> int:
+        response = await xray_clients.post(server_name, "/user", json={"uuid": user_uuid})
+        return response.status_code
     
-    try:
-        update_user_balance(referrer_id, 50.0)
-        update_user_balance(referred_id, 100.0)
-        
-        referral_id = f"{referrer_id}_{referred_id}"
-        db.collection('referrals').document(referral_id).set({
-            'referrer_id': referrer_id,
-            'referred_id': referred_id,
-            'referrer_bonus': 50.0,
-            'referred_bonus': 100.0,
-            'bonus_paid': True,
-            'created_at': firestore.SERVER_TIMESTAMP
-        })
-        
-        logger.info(f"✅ Immediate referral bonuses applied")
-        return True
-        
-    except Exception as e:
-        logger.error(f"❌ Error adding immediate referral bonus: {e}")
-        return False
-
-def save_vless_key_to_db(user_id: str, server_id: str, vless_key: str, config_data: dict):
-    """Сохраняет VLESS ключ пользователя в базу данных"""
-    if not db:
-        return False
+    results = await xray_clients.fan_out(xray_targets(server_id), add_to, deadline=XRAY_MUTATION_DEADLINE)
     
-    try:
-        vless_key_id = f"{user_id}_{server_id}"
-        
-        vless_data = {
-            'user_id': user_id,
-            'server_id': server_id,
-            'vless_key': vless_key,
-            'config_data': config_data,
-            'created_at': firestore.SERVER_TIMESTAMP,
-            'updated_at': firestore.SERVER_TIMESTAMP,
-            'is_active': True
-        }
-        
-        db.collection('vless_keys').document(vless_key_id).set(vless_data)
-        return True
-        
-    except Exception as e:
-        logger.error(f"❌ Error saving VLESS key to DB: {e}")
-        return False
-
-def get_user_vless_keys(user_id: str):
-    """Получает все VLESS ключи пользователя из базы данных"""
-    if not db:
-        return []
+    added = False
+    for server_name, result in results.items():
+        if isinstance(result, Exception):
+            logger.warning(f"⚠️ Add failed for {server_name}: {result!r}")
+        elif result in [200, 201]:
+            added = True
+            logger.info(f"✅ User {user_uuid} added to {server_name}")
+        else:
+            logger.warning(f"⚠️ Add to {server_name} returned {result}")
     
-    try:
-        vless_keys_ref = db.collection('vless_keys').where('user_id', '==', user_id)
-        vless_keys = vless_keys_ref.stream()
-        
-        keys_list = []
-        for key_doc in vless_keys:
-            key_data = key_doc.to_dict()
-            keys_list.append(key_data)
-        
-        return keys_list
-        
-    except Exception as e:
-        logger.error(f"❌ Error getting VLESS keys: {e}")
-        return []
+    return added
 
-def update_vless_key_status(user_id: str, server_id: str, is_active: bool):
-    """Обновляет статус VLESS ключа"""
-    if not db:
-        return False
+async def deliver_to_xray(server_id: str, action: str, user_uuids: List[str]) -> List[str]:
+    """Доставка намерений из outbox на одну ноду, возвращает доставленные UUID"""
+    if action == ACTION_ADD:
+        results = await xray_batch(server_id, add=user_uuids)
+    else:
+        results = await xray_batch(server_id, remove=user_uuids)
+    delivered = [user_uuid for user_uuid in user_uuids if results.get(user_uuid)]
     
-    try:
-        vless_key_id = f"{user_id}_{server_id}"
-        
-        db.collection('vless_keys').document(vless_key_id).update({
-            'is_active': is_active,
-            'updated_at': firestore.SERVER_TIMESTAMP
-        })
-        
-        return True
-        
-    except Exception as e:
-        logger.error(f"❌ Error updating VLESS key status: {e}")
-        return False
+    logger.info(f"⚡ Outbox: {len(delivered)}/{len(user_uuids)} {action} delivered to {server_id}")
+    return delivered
+
+# Персистентная очередь операций добавления/удаления на нодах
+provisioning_outbox = ProvisioningOutbox(deliver_to_xray)
 
-def create_user_vless_configs(user_id: str, vless_uuid: str, server_id: str = None) -> List[dict]:
+async def create_user_vless_configs(user_id: str, vless_uuid: str, server_id: str = None) -> List[dict]:
     """Создает VLESS конфигурации для пользователя и сохраняет в БД"""
     
     configs = []
@@ -596,168 +501,293 @@ def create_user_vless_configs(user_id: str, vless_uuid: str, server_id: str = No
             "server_id": server["id"]
         }
         
-        save_vless_key_to_db(user_id, server["id"], vless_link, config)
+        await save_vless_key_to_db(user_id, server["id"], vless_link, config)
         
         configs.append(config_data)
     
     return configs
 
-def process_subscription_days(user_id: str) -> bool:
-    """Обработка дней подписки с удалением из Xray при окончании"""
-    if not db:
+async def revoke_subscription(user_id: str) -> bool:
+    """Отзыв истекшего доступа: снимает флаг подписки, удаляет из Xray и отключает ключи
+
+    Истечение перепроверяется по свежему документу в транзакции; если подписку
+    успели продлить, отзыв пропускается и новый срок ставится в индекс.
+    """
+    revoked, user = await database.revoke_expired_subscription(user_id)
+    if not revoked:
+        if user and user.get('has_subscription') and user.get('expires_at'):
+            expiry_index.schedule(user_id, user['expires_at'])
+            logger.info(f"⏭️ Subscription of user {user_id} renewed before revocation")
+        return False
+    
+    expiry_index.cancel(user_id)
+    access_index.remove_user(user_id)
+    if user.get('vless_uuid'):
+        provisioning_outbox.enqueue_remove([user['vless_uuid']], list(XRAY_SERVERS.keys()))
+    await set_user_vless_keys_status(user_id, False)
+    
+    logger.info(f"⏰ Subscription expired and revoked for user {user_id}")
+    return True
+
+async def revoke_if_expired(user_id: str, user: dict) -> bool:
+    """Отзывает истекшую подписку. Пишет в базу только в момент отзыва"""
+    if not user or not user.get('revocation_pending'):
         return False
     
     try:
-        user = get_user(user_id)
-        if not user:
-            return False
-            
-        has_subscription = user.get('has_subscription', False)
-        subscription_days = user.get('subscription_days', 0)
-        vless_uuid = user.get('vless_uuid')
-        last_check = user.get('last_subscription_check')
-        today = datetime.now().date()
-        
-        if not has_subscription or subscription_days <= 0:
-            return True
-            
-        if not last_check:
-            db.collection('users').document(user_id).update({
-                'last_subscription_check': today.isoformat()
-            })
-            return True
-        else:
-            try:
-                last_date = datetime.fromisoformat(last_check.replace('Z', '+00:00')).date()
-                days_passed = (today - last_date).days
-                
-                if days_passed > 0:
-                    new_days = max(0, subscription_days - days_passed)
-                    
-                    update_data = {
-                        'subscription_days': new_days,
-                        'last_subscription_check': today.isoformat()
-                    }
-                    
-                    if new_days == 0:
-                        update_data['has_subscription'] = False
-                        if vless_uuid:
-                            asyncio.create_task(remove_user_from_xray(vless_uuid))
-                            user_vless_keys = get_user_vless_keys(user_id)
-                            for key_data in user_vless_keys:
-                                update_vless_key_status(user_id, key_data['server_id'], False)
-                    
-                    db.collection('users').document(user_id).update(update_data)
-                    
-            except Exception as e:
-                logger.error(f"❌ Error processing subscription days: {e}")
-        
-        return True
-            
+        return await revoke_subscription(user_id)
     except Exception as e:
-        logger.error(f"❌ Error processing subscription: {e}")
+        # Повторим позже: индекс сработает снова, остальное подберет периодический проход
+        expiry_index.schedule(user_id, datetime.now(timezone.utc) + EXPIRY_RETRY_DELAY)
+        logger.error(f"❌ Error revoking expired subscription: {e}")
         return False
 
-async def check_all_subscriptions():
-    """Автоматическая проверка всех подписок"""
-    if not db:
-        return []
+async def revoke_expired_user(user_id: str):
+    """Срабатывание индекса сроков: перечитывает пользователя и отзывает доступ"""
+    user = await get_user(user_id)
+    await revoke_if_expired(user_id, user)
+
+# Индекс сроков окончания подписок для точного отзыва доступа
+EXPIRY_RETRY_DELAY = timedelta(minutes=1)
+expiry_index = ExpiryIndex(revoke_expired_user)
+access_index = AccessIndex()
+
+async def init_subscriptions():
+    """Миграция сроков подписок и загрузка индекса окончаний"""
+    await database.migrate_subscription_expiry()
+    await database.backfill_referral_counters()
     
-    try:
-        users_ref = db.collection('users').where('has_subscription', '==', True)
-        users = users_ref.stream()
-        
-        expired_users = []
-        
-        for user_doc in users:
-            user_data = user_doc.to_dict()
-            user_id = user_data.get('user_id')
-            
-            success = process_subscription_days(user_id)
-            
-            if success:
-                user_updated = get_user(user_id)
-                if not user_updated.get('has_subscription', False):
-                    expired_users.append(user_id)
-        
-        return expired_users
-        
-    except Exception as e:
-        logger.error(f"❌ Error checking subscriptions: {e}")
-        return []
+    await load_subscription_indexes()
+    expiry_index.start()
+
+async def load_subscription_indexes() -> bool:
+    """Полная загрузка индексов сроков и доступа из активных подписок
 
-def start_subscription_checker():
-    """Запуск периодической проверки подписок"""
+    Ошибка чтения оставляет access_index не готовым: проверки доступа идут
+    в Firestore, а загрузку повторяет sync_access_index по расписанию.
+    """
     try:
-        scheduler = BackgroundScheduler()
-        scheduler.add_job(
-            check_all_subscriptions,
-            'interval',
-            hours=6,
-            id='subscription_check'
-        )
-        scheduler.start()
-        logger.info("✅ Subscription checker started")
+        synced_at = datetime.now(timezone.utc)
+        users = [user for user in await database.load_subscribed_users() if user.get('user_id')]
+        expiry_index.load([(user['user_id'], user['expires_at']) for user in users])
+        access_index.load([(user['user_id'], user) for user in users], synced_at)
+        return True
     except Exception as e:
-        logger.error(f"❌ Error starting subscription checker: {e}")
+        logger.error(f"❌ Error loading subscription indexes: {e}")
+        return False
 
-def save_payment(payment_id: str, user_id: str, amount: float, tariff: str, payment_type: str = "tariff", payment_method: str = "yookassa", selected_server: str = None):
-    if not db: 
-        return
+async def sync_access_index() -> int:
+    """Дельта-загрузка пользователей, измененных с прошлой синхронизации"""
+    if not access_index.ready:
+        # Начальная загрузка не удалась - повторяем полную
+        await load_subscription_indexes()
+        return len(access_index)
     try:
-        payment_data = {
-            'payment_id': payment_id,
-            'user_id': user_id,
-            'amount': amount,
-            'tariff': tariff,
-            'status': 'pending',
-            'payment_type': payment_type,
-            'payment_method': payment_method,
-            'created_at': firestore.SERVER_TIMESTAMP,
-            'yookassa_id': None
-        }
-        
-        if selected_server:
-            payment_data['selected_server'] = selected_server
-        
-        db.collection('payments').document(payment_id).set(payment_data)
+        synced_at = datetime.now(timezone.utc)
+        users = await database.get_users_updated_since(access_index.last_sync - ACCESS_INDEX_SYNC_OVERLAP)
+        return access_index.apply_delta([(user['user_id'], user) for user in users], synced_at)
     except Exception as e:
-        logger.error(f"❌ Error saving payment: {e}")
+        logger.error(f"❌ Error syncing access index: {e}")
+        return 0
 
-def update_payment_status(payment_id: str, status: str, yookassa_id: str = None):
-    if not db: 
-        return
+async def check_all_subscriptions() -> dict:
+    """Периодический отзыв истекших подписок: постранично, батчами, одним вызовом на ноду"""
+    global last_subscription_sweep
+    
+    stats = {
+        "started_at": datetime.now().isoformat(),
+        "duration_ms": 0.0,
+        "pages": 0,
+        "writes": 0,
+        "revocations": 0,
+        "conflicts": 0,
+        "completed": False
+    }
+    
+    if not db:
+        return stats
+    
+    started = time.monotonic()
+    now = datetime.now(timezone.utc)
+    
     try:
-        update_data = {
-            'status': status,
-            'yookassa_id': yookassa_id
-        }
-        if status == 'succeeded':
-            update_data['confirmed_at'] = firestore.SERVER_TIMESTAMP
+        async for page in database.iter_expired_user_pages(now, SUBSCRIPTION_SWEEP_PAGE_SIZE):
+            stats["pages"] += 1
+            
+            expired = {}
+            for user_id, user_data, update_time in page:
+                if not user_data.get('has_subscription', False):
+                    continue
+                expired[user_id] = (user_data, update_time)
+            
+            # Снимаются только подписки, не измененные после чтения страницы
+            revoked_ids = await database.revoke_subscriptions_batch(
+                [(user_id, update_time) for user_id, (_, update_time) in expired.items()]
+            )
+            stats["writes"] += len(revoked_ids)
+            stats["revocations"] += len(revoked_ids)
+            stats["conflicts"] += len(expired) - len(revoked_ids)
+            expired_uuids = []
+            for user_id in revoked_ids:
+                expiry_index.cancel(user_id)
+                access_index.remove_user(user_id)
+                if expired[user_id][0].get('vless_uuid'):
+                    expired_uuids.append(expired[user_id][0]['vless_uuid'])
+            
+            if expired_uuids:
+                provisioning_outbox.enqueue_remove(expired_uuids, list(XRAY_SERVERS.keys()))
+            
+            # Остаток обработается следующим запуском, время одного прохода ограничено
+            if stats["pages"] >= SUBSCRIPTION_SWEEP_MAX_PAGES:
+                break
+        else:
+            stats["completed"] = True
         
-        db.collection('payments').document(payment_id).update(update_data)
     except Exception as e:
-        logger.error(f"❌ Error updating payment status: {e}")
-
-def get_payment(payment_id: str):
-    if not db: 
-        return None
+        logger.error(f"❌ Error checking subscriptions: {e}")
+    
+    stats["duration_ms"] = round((time.monotonic() - started) * 1000, 1)
+    last_subscription_sweep = stats
+    logger.info(
+        f"⏰ Subscription sweep: {stats['revocations']} revoked, {stats['pages']} pages, "
+        f"{stats['writes']} writes in {stats['duration_ms']} ms"
+    )
+    return stats
+
+def desired_node_uuids(users: List[dict]) -> dict:
+    """Желаемый набор UUID на каждой ноде по активным подпискам
+
+    Пользователь с известным preferred_server живет только на своей ноде,
+    остальные - на всех нодах, как при добавлении без выбора сервера.
+    """
+    desired = {server_id: set() for server_id in XRAY_SERVERS}
+    for user in users:
+        vless_uuid = user.get('vless_uuid')
+        if not vless_uuid or not user.get('has_subscription', False):
+            continue
+        for server_id in xray_targets(user.get('preferred_server')):
+            desired[server_id].add(vless_uuid)
+    return desired
+
+async def get_node_uuids(server_id: str) -> List[str]:
+    """Полный список UUID из конфига ноды одним запросом"""
+    response = await xray_clients.get(server_id, "/users", timeout=60.0)
+    if response.status_code != 200:
+        raise Exception(f"List users returned {response.status_code}")
+    return response.json().get("uuids", [])
+
+async def reconcile_node(server_id: str, desired: set, since: float = None) -> dict:
+    """Сверка одной ноды: дайджест, при расхождении - полный список и пакетная разница
+
+    since - начало прогона: намерения outbox, ожидающие или записанные после
+    снимка Firestore, важнее снимка и из разницы исключаются.
+    """
+    report = {"in_sync": False, "missing": 0, "extra": 0, "applied": 0}
+    
+    response = await xray_clients.get(server_id, "/users/digest")
+    if response.status_code == 200:
+        digest = response.json()
+        if digest.get("count") == len(desired) and digest.get("hash") == uuid_set_digest(desired):
+            report["in_sync"] = True
+            return report
+    
     try:
-        doc = db.collection('payments').document(payment_id).get()
-        return doc.to_dict() if doc.exists else None
+        actual = set(await get_node_uuids(server_id))
     except Exception as e:
-        logger.error(f"❌ Error getting payment: {e}")
-        return None
+        report["error"] = str(e)
+        return report
+    
+    since = since if since is not None else time.time()
+    pending_adds = provisioning_outbox.intent_uuids(server_id, ACTION_ADD, since)
+    pending_removes = provisioning_outbox.intent_uuids(server_id, ACTION_REMOVE, since)
+    missing = sorted(desired - actual - pending_removes)
+    extra = sorted(actual - desired - pending_adds)
+    report["missing"] = len(missing)
+    report["extra"] = len(extra)
+    
+    # Защита от пустого или неполного снимка: массовое удаление не применяем
+    if extra and (not desired or len(extra) > max(RECONCILE_MAX_REMOVE_RATIO * len(actual), RECONCILE_MIN_REMOVE_GUARD)):
+        report["error"] = f"Refusing to remove {len(extra)} of {len(actual)} users"
+        logger.error(f"❌ Xray reconcile {server_id}: {report['error']}")
+        extra = []
+    
+    if missing or extra:
+        results = await xray_batch(server_id, add=missing, remove=extra)
+        report["applied"] = sum(1 for success in results.values() if success)
+    
+    report["in_sync"] = "error" not in report and report["applied"] == len(missing) + len(extra)
+    return report
 
-def get_referrals(referrer_id: str):
-    if not db: 
-        return []
+async def reconcile_xray_nodes() -> dict:
+    """Приводит наборы пользователей на нодах к активным подпискам из Firestore"""
+    global last_reconcile
+    
+    if reconcile_lock.locked():
+        return {"skipped": True, "reason": "Reconciliation already running"}
+    
+    async with reconcile_lock:
+        started = time.monotonic()
+        report = {"started_at": datetime.now().isoformat(), "nodes": {}, "drift": 0}
+        
+        try:
+            # Отметка времени до снимка: намерения после нее снимок может не видеть
+            since = time.time()
+            desired = desired_node_uuids(await database.load_subscribed_users())
+            
+            results = await xray_clients.fan_out(
+                list(desired.keys()),
+                lambda server_id: reconcile_node(server_id, desired[server_id], since),
+                deadline=XRAY_RECONCILE_DEADLINE
+            )
+            for server_id, node_report in results.items():
+                if isinstance(node_report, Exception):
+                    node_report = {"in_sync": False, "error": repr(node_report)}
+                report["nodes"][server_id] = node_report
+                report["drift"] += node_report.get("missing", 0) + node_report.get("extra", 0)
+        except Exception as e:
+            logger.error(f"❌ Error reconciling Xray nodes: {e}")
+            report["error"] = str(e)
+        
+        report["duration_ms"] = round((time.monotonic() - started) * 1000, 1)
+        last_reconcile = report
+        logger.info(f"🔁 Xray reconcile: drift {report['drift']} in {report['duration_ms']} ms")
+        return report
+
+def start_background_jobs():
+    """Запуск периодических задач на event loop приложения"""
     try:
-        referrals = db.collection('referrals').where('referrer_id', '==', referrer_id).stream()
-        return [ref.to_dict() for ref in referrals]
+        scheduler.add_job(
+            check_all_subscriptions,
+            IntervalTrigger(hours=SUBSCRIPTION_SWEEP_INTERVAL_HOURS),
+            id='subscription_check',
+            max_instances=1,
+            coalesce=True
+        )
+        scheduler.add_job(
+            reconcile_xray_nodes,
+            IntervalTrigger(minutes=RECONCILE_INTERVAL_MINUTES),
+            id='xray_reconcile',
+            max_instances=1,
+            coalesce=True
+        )
+        scheduler.add_job(
+            reconcile_pending_payments,
+            IntervalTrigger(minutes=PAYMENT_RECONCILE_INTERVAL_MINUTES),
+            id='payment_reconcile',
+            max_instances=1,
+            coalesce=True
+        )
+        scheduler.add_job(
+            sync_access_index,
+            IntervalTrigger(seconds=ACCESS_INDEX_SYNC_SECONDS),
+            id='access_index_sync',
+            max_instances=1,
+            coalesce=True
+        )
+        scheduler.start()
+        logger.info("✅ Subscription checker, Xray and payment reconcilers started")
     except Exception as e:
-        logger.error(f"❌ Error getting referrals: {e}")
-        return []
+        logger.error(f"❌ Error starting background jobs: {e}")
 
 def extract_referrer_id(start_param: str) -> str:
     if not start_param:
@@ -788,28 +818,245 @@ def extract_referrer_id(start_param: str) -> str:
     
     return start_param
 
+async def debit_for_tariff(user_id: str, price: float, payment_id: str):
+    """Списание за тариф проводкой с ключом payment_id, при ошибке возвращает ответ"""
+    status, balance = await database.apply_balance_entry(user_id, -price, payment_id, "tariff")
+    if status == database.LEDGER_INSUFFICIENT:
+        await update_payment_status(payment_id, "canceled")
+        return JSONResponse(status_code=400, content={
+            "success": False,
+            "error": f"Недостаточно средств на балансе. На вашем балансе {balance}₽, а требуется {price}₽"
+        })
+    if status not in (database.LEDGER_APPLIED, database.LEDGER_DUPLICATE):
+        await update_payment_status(payment_id, "canceled")
+        return JSONResponse(status_code=404, content={"error": "User not found"})
+    return None
+
+async def refund_tariff(user_id: str, price: float, payment_id: str):
+    """Возврат списания, если подписку не удалось активировать"""
+    await update_user_balance(user_id, price, f"{payment_id}_refund", "tariff_refund")
+    await update_payment_status(payment_id, "canceled")
+
+def payment_status_response(payment_id: str, payment: dict, status: str) -> dict:
+    response = {
+        "success": True,
+        "status": status,
+        "payment_id": payment_id
+    }
+    if status == 'succeeded':
+        response["amount"] = payment['amount']
+        if payment['payment_type'] == 'balance':
+            response["balance_added"] = payment['amount']
+            response["message"] = f"Баланс успешно пополнен на {payment['amount']}₽!"
+        else:
+            response["days_added"] = TARIFFS.get(payment.get('tariff'), {}).get("days")
+            response["selected_server"] = payment.get('selected_server')
+    return response
+
+async def resolve_payment_status(payment_id: str, payment: dict) -> dict:
+    """Статус платежа: из базы, а для ожидающих оплат YooKassa без уведомлений - из шлюза"""
+    # Финальный статус, оплата с баланса или включенные уведомления - ответ из базы
+    if (payment['status'] in database.PAYMENT_FINAL_STATUSES
+            or payment.get('payment_method') != 'yookassa'
+            or not payment.get('yookassa_id')
+            or YOOKASSA_WEBHOOKS_ENABLED):
+        return payment_status_response(payment_id, payment, payment['status'])
+    
+    yookassa_data = await yookassa.get_payment(payment['yookassa_id'])
+    status = yookassa_data.get('status')
+    
+    if not await finalize_payment(payment_id, payment, status, payment['yookassa_id']):
+        raise Exception("Ошибка обработки платежа")
+    
+    return payment_status_response(payment_id, payment, status)
+
+async def finalize_payment(payment_id: str, payment: dict, status: str, yookassa_id: str) -> bool:
+    """Применяет статус YooKassa к платежу, зачисление или активация выполняются один раз"""
+    if status not in database.PAYMENT_FINAL_STATUSES:
+        # Промежуточный статус не перезаписывает уже завершенный платеж
+        if status != payment.get('status') and await database.claim_payment(payment_id, status, yookassa_id):
+            payment_events.publish(payment_id, payment_status_response(payment_id, payment, status))
+        return True
+    
+    if status == 'succeeded' and payment['payment_type'] == 'balance':
+        # Проводка идемпотентна по payment_id, поэтому зачисляем до отметки платежа:
+        # сбой между ними оставит платеж ожидающим, и повтор не зачислит дважды
+        if not await update_user_balance(payment['user_id'], payment['amount'], payment_id, "top_up"):
+            logger.error(f"❌ Failed to finalize payment {payment_id}")
+            return False
+        if await database.claim_payment(payment_id, status, yookassa_id):
+            payment_events.publish(payment_id, payment_status_response(payment_id, payment, status))
+        return True
+    
+    # Продление не идемпотентно: только вызов, переведший платеж в финальный статус,
+    # активирует тариф; до отметки applied платеж подхватит сверка
+    extra = database.payment_application_claim() if status == 'succeeded' else None
+    if not await database.claim_payment(payment_id, status, yookassa_id, extra):
+        return True
+    if status != 'succeeded':
+        payment_events.publish(payment_id, payment_status_response(payment_id, payment, status))
+        return True
+    
+    return await apply_tariff_payment(payment_id, payment)
+
+async def apply_tariff_payment(payment_id: str, payment: dict) -> bool:
+    """Активация оплаченного тарифа и отметка applied на платеже"""
+    user_id = payment['user_id']
+    tariff_days = TARIFFS[payment['tariff']]["days"]
+    if not await update_subscription_days(user_id, tariff_days, payment.get('selected_server')):
+        logger.error(f"❌ Failed to apply payment {payment_id}, reconciliation will retry")
+        return False
+    
+    await database.mark_payment_applied(payment_id)
+    
+    user = await get_user(user_id)
+    if user and user.get('referred_by'):
+        referrer_id = user['referred_by']
+        
+        if not await referral_exists(referrer_id, user_id):
+            await add_referral_bonus_immediately(referrer_id, user_id)
+    
+    payment_events.publish(payment_id, payment_status_response(payment_id, payment, 'succeeded'))
+    return True
+
+async def reapply_unapplied_payments(stats: dict):
+    """Повторная активация оплаченных тарифов, чья прошлая попытка не дошла до отметки applied"""
+    stale_before = datetime.now(timezone.utc) - PAYMENT_APPLY_LEASE
+    for payment_id, payment in await database.get_unapplied_payments(PAYMENT_RECONCILE_PAGE_SIZE):
+        if not await database.lease_payment_application(payment_id, stale_before):
+            continue
+        if await apply_tariff_payment(payment_id, payment):
+            stats["reapplied"] += 1
+        else:
+            stats["errors"] += 1
+
+async def reconcile_pending_payments() -> dict:
+    """Завершает платежи YooKassa, статус которых никто не запросил после оплаты"""
+    global last_payment_reconcile
+    
+    if not yookassa.configured:
+        return {"skipped": True, "reason": "Payment gateway not configured"}
+    if payment_reconcile_lock.locked():
+        return {"skipped": True, "reason": "Payment reconciliation already running"}
+    
+    async with payment_reconcile_lock:
+        started = time.monotonic()
+        now = datetime.now(timezone.utc)
+        stats = {
+            "started_at": now.isoformat(),
+            "pages": 0,
+            "checked": 0,
+            "succeeded": 0,
+            "canceled": 0,
+            "updated": 0,
+            "unchanged": 0,
+            "conflicts": 0,
+            "reapplied": 0,
+            "errors": 0,
+            "max_lag_seconds": 0.0
+        }
+        finalized_lag_total = 0.0
+        semaphore = asyncio.Semaphore(PAYMENT_RECONCILE_CONCURRENCY)
+        
+        async def check(payment: dict) -> dict:
+            async with semaphore:
+                return await yookassa.get_payment(payment['yookassa_id'])
+        
+        try:
+            await reapply_unapplied_payments(stats)
+            
+            pages = database.iter_open_payment_pages(
+                now - PAYMENT_RECONCILE_WINDOW, now - PAYMENT_RECONCILE_MIN_AGE, PAYMENT_RECONCILE_PAGE_SIZE
+            )
+            async for page in pages:
+                stats["pages"] += 1
+                page = [
+                    (payment_id, payment, update_time) for payment_id, payment, update_time in page
+                    if payment.get('payment_method') == 'yookassa' and payment.get('yookassa_id')
+                ]
+                results = await asyncio.gather(*(check(payment) for _, payment, _ in page), return_exceptions=True)
+                
+                status_writes = []
+                canceled = {}
+                for (payment_id, payment, update_time), result in zip(page, results):
+                    stats["checked"] += 1
+                    # Задержка: сколько платеж провисел незавершенным к моменту сверки
+                    lag = (now - database.to_utc(payment['created_at'])).total_seconds() if payment.get('created_at') else 0.0
+                    stats["max_lag_seconds"] = max(stats["max_lag_seconds"], round(lag, 1))
+                    
+                    if isinstance(result, CircuitOpenError):
+                        raise result
+                    if isinstance(result, Exception):
+                        stats["errors"] += 1
+                        continue
+                    
+                    status = result.get('status')
+                    if status == 'succeeded':
+                        # Зачисление и активация - через claim, как у webhook и опроса
+                        if await finalize_payment(payment_id, payment, status, payment['yookassa_id']):
+                            stats["succeeded"] += 1
+                            finalized_lag_total += lag
+                        else:
+                            stats["errors"] += 1
+                    elif status == 'canceled':
+                        status_writes.append((payment_id, status, update_time))
+                        canceled[payment_id] = (payment, lag)
+                    elif status != payment.get('status'):
+                        status_writes.append((payment_id, status, update_time))
+                        stats["updated"] += 1
+                    else:
+                        stats["unchanged"] += 1
+                
+                # Отмены и промежуточные статусы пишем батчем, только если платеж
+                # не изменился после чтения (например, его не забрал webhook)
+                written = await database.set_payment_statuses(status_writes)
+                for payment_id in written:
+                    if payment_id in canceled:
+                        payment, lag = canceled[payment_id]
+                        stats["canceled"] += 1
+                        finalized_lag_total += lag
+                        payment_events.publish(payment_id, payment_status_response(payment_id, payment, 'canceled'))
+                stats["conflicts"] += len(status_writes) - len(written)
+                
+                # Остаток обработается следующим запуском
+                if stats["pages"] >= PAYMENT_RECONCILE_MAX_PAGES:
+                    break
+        except Exception as e:
+            logger.error(f"❌ Error reconciling pending payments: {e}")
+            stats["error"] = str(e)
+        
+        duration = time.monotonic() - started
+        finalized = stats["succeeded"] + stats["canceled"]
+        stats["duration_ms"] = round(duration * 1000, 1)
+        stats["throughput_per_second"] = round(stats["checked"] / duration, 1) if duration > 0 else 0.0
+        stats["avg_finalized_lag_seconds"] = round(finalized_lag_total / finalized, 1) if finalized else 0.0
+        last_payment_reconcile = stats
+        logger.info(
+            f"💳 Payment reconcile: {stats['checked']} checked, {stats['succeeded']} succeeded, "
+            f"{stats['canceled']} canceled in {stats['duration_ms']} ms"
+        )
+        return stats
+
 async def update_subscription_days(user_id: str, additional_days: int, server_id: str = None) -> bool:
     """Обновление дней подписки с ГАРАНТИРОВАННЫМ добавлением в Xray - БЫСТРО"""
     if not db: 
         return False
     try:
-        user_ref = db.collection('users').document(user_id)
-        user = user_ref.get()
+        user_data = await get_user(user_id)
         
-        if user.exists:
-            user_data = user.to_dict()
-            current_days = user_data.get('subscription_days', 0)
-            new_days = current_days + additional_days
+        if user_data:
+            # Продление считается от текущего срока окончания, если он еще не прошел
+            now = datetime.now(timezone.utc)
+            current_expires_at = user_data.get('expires_at')
+            base = current_expires_at if current_expires_at and current_expires_at > now else now
+            expires_at = base + timedelta(days=additional_days)
             
-            has_subscription = user_data.get('has_subscription', False)
-            if not has_subscription and additional_days > 0:
-                has_subscription = True
+            has_subscription = expires_at > now
             
             update_data = {
-                'subscription_days': new_days,
+                'expires_at': expires_at,
                 'has_subscription': has_subscription,
-                'updated_at': firestore.SERVER_TIMESTAMP,
-                'last_subscription_check': datetime.now().date().isoformat()
+                'updated_at': firestore.SERVER_TIMESTAMP
             }
             
             if has_subscription:
@@ -825,7 +1072,11 @@ async def update_subscription_days(user_id: str, additional_days: int, server_id
                     logger.error(f"❌ FAILED to ensure UUID for user {user_id}: {e}")
                     return False
             
-            user_ref.update(update_data)
+            if not await update_user(user_id, update_data):
+                return False
+            expiry_index.schedule(user_id, expires_at)
+            if has_subscription:
+                access_index.put(user_id, update_data['vless_uuid'], expires_at)
             logger.info(f"✅ Subscription updated for user {user_id}: +{additional_days} days")
             return True
         else:
@@ -849,13 +1100,28 @@ async def startup_event():
     logger.info("🚀 VAC VPN Server starting up...")
     
     ensure_logo_exists()
-    start_subscription_checker()
+    xray_clients.start()
+    node_health.start()
+    provisioning_outbox.start()
+    asyncio.create_task(init_subscriptions())
+    start_background_jobs()
     
     logger.info("🔄 Starting Telegram bot automatically...")
     bot_thread = threading.Thread(target=run_bot, daemon=True)
     bot_thread.start()
     logger.info("✅ Telegram bot started successfully")
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Действия при остановке приложения"""
+    if scheduler.running:
+        scheduler.shutdown(wait=False)
+    await expiry_index.stop()
+    await node_health.stop()
+    await yookassa.close()
+    await provisioning_outbox.stop()
+    await xray_clients.close()
+
 # API ЭНДПОИНТЫ
 @app.get("/")
 async def root():
@@ -885,6 +1151,17 @@ async def health_check():
         "xray_users": xray_users_count,
         "available_servers": [server["name"] for server in VLESS_SERVERS],
         "database_connected": db is not None,
+        "user_cache": database.user_cache.stats(),
+        "subscription_sweep": last_subscription_sweep,
+        "expiry_index": expiry_index.stats(),
+        "access_index": access_index.stats(),
+        "payment_events": payment_events.stats(),
+        "yookassa": yookassa.stats(),
+        "xray_nodes": xray_clients.stats(),
+        "node_health": node_health.snapshot(),
+        "provisioning_outbox": provisioning_outbox.stats(),
+        "xray_reconcile": last_reconcile,
+        "payment_reconcile": last_payment_reconcile,
         "environment": "production"
     }
 
@@ -892,31 +1169,26 @@ async def health_check():
 async def get_available_servers():
     return {
         "success": True,
-        "servers": VLESS_SERVERS
+        "servers": VLESS_SERVERS,
+        "nodes": [
+            {"id": server_id, "display_name": server_config["display_name"], **node_health.snapshot()[server_id]}
+            for server_id, server_config in XRAY_SERVERS.items()
+        ]
     }
 
 @app.get("/debug-servers")
 async def debug_servers():
-    results = {}
-    for server_name, server_config in XRAY_SERVERS.items():
-        try:
-            async with httpx.AsyncClient() as client:
-                response = await client.get(
-                    f"{server_config['url']}/health",
-                    timeout=5.0
-                )
-                results[server_name] = {
-                    "status": response.status_code,
-                    "url": server_config['url'],
-                    "healthy": response.status_code == 200
-                }
-        except Exception as e:
-            results[server_name] = {
-                "error": str(e),
-                "url": server_config['url'],
-                "healthy": False
-            }
-    return results
+    # Состояние из кэша фонового опроса, без запросов к нодам
+    health = node_health.snapshot()
+    stats = xray_clients.stats()
+    return {
+        server_name: {
+            "url": server_config['url'],
+            **health[server_name],
+            "stats": stats[server_name]
+        }
+        for server_name, server_config in XRAY_SERVERS.items()
+    }
 
 @app.delete("/clear-referrals/{user_id}")
 async def clear_referrals(user_id: str):
@@ -924,15 +1196,7 @@ async def clear_referrals(user_id: str):
         if not db:
             return {"error": "Database not connected"}
         
-        referrals_ref = db.collection('referrals').where('referrer_id', '==', user_id)
-        referrals = referrals_ref.stream()
-        for ref in referrals:
-            ref.reference.delete()
-        
-        user_ref = db.collection('users').document(user_id)
-        user_ref.update({
-            'referred_by': firestore.DELETE_FIELD
-        })
+        await database.delete_user_referrals(user_id)
         
         return {"success": True, "message": "Referrals cleared"}
         
@@ -957,22 +1221,18 @@ async def init_user(request: InitUserRequest):
             referrer_id = extract_referrer_id(request.start_param)
             
             if referrer_id:
-                referrer = get_user(referrer_id)
+                referrer = await get_user(referrer_id)
                 
                 if referrer and referrer_id != request.user_id:
-                    referral_id = f"{referrer_id}_{request.user_id}"
-                    referral_exists = db.collection('referrals').document(referral_id).get().exists
-                    
-                    if not referral_exists:
+                    if not await referral_exists(referrer_id, request.user_id):
                         is_referral = True
-                        bonus_result = add_referral_bonus_immediately(referrer_id, request.user_id)
+                        bonus_result = await add_referral_bonus_immediately(referrer_id, request.user_id)
                         if bonus_result:
                             bonus_applied = True
         
-        user_ref = db.collection('users').document(request.user_id)
-        user_doc = user_ref.get()
+        existing_user = await get_user(request.user_id)
         
-        if not user_doc.exists:
+        if not existing_user:
             user_data = {
                 'user_id': request.user_id,
                 'username': request.username,
@@ -980,18 +1240,17 @@ async def init_user(request: InitUserRequest):
                 'last_name': request.last_name,
                 'balance': 100.0 if bonus_applied else 0.0,
                 'has_subscription': False,
-                'subscription_days': 0,
+                'expires_at': None,
                 'subscription_start': None,
                 'vless_uuid': None,
                 'preferred_server': None,
-                'last_subscription_check': datetime.now().date().isoformat(),
                 'created_at': firestore.SERVER_TIMESTAMP
             }
             
             if is_referral and referrer_id:
                 user_data['referred_by'] = referrer_id
             
-            user_ref.set(user_data)
+            await create_user(request.user_id, user_data)
             
             return {
                 "success": True, 
@@ -1001,8 +1260,7 @@ async def init_user(request: InitUserRequest):
                 "bonus_applied": bonus_applied
             }
         else:
-            user_data = user_doc.to_dict()
-            has_referrer = user_data.get('referred_by') is not None
+            has_referrer = existing_user.get('referred_by') is not None
             
             return {
                 "success": True, 
@@ -1025,9 +1283,7 @@ async def get_user_info(user_id: str):
         if not user_id or user_id == 'unknown':
             return JSONResponse(status_code=400, content={"error": "Invalid user ID"})
             
-        process_subscription_days(user_id)
-            
-        user = get_user(user_id)
+        user = await get_user(user_id)
         if not user:
             return {
                 "user_id": user_id,
@@ -1038,17 +1294,19 @@ async def get_user_info(user_id: str):
                 "preferred_server": None
             }
         
+        await revoke_if_expired(user_id, user)
+        
         has_subscription = user.get('has_subscription', False)
         subscription_days = user.get('subscription_days', 0)
         vless_uuid = user.get('vless_uuid')
         balance = user.get('balance', 0.0)
         preferred_server = user.get('preferred_server')
         
-        vless_keys = get_user_vless_keys(user_id)
+        vless_keys = await get_user_vless_keys(user_id)
         
-        referrals = get_referrals(user_id)
-        referral_count = len(referrals)
-        total_bonus_money = sum([ref.get('referrer_bonus', 0) for ref in referrals])
+        # Счетчики поддерживаются на документе пользователя, без чтения referrals
+        referral_count = user.get('referral_count', 0)
+        total_bonus_money = user.get('referral_bonus_total', 0.0)
         
         return {
             "user_id": user_id,
@@ -1076,7 +1334,7 @@ async def add_balance(request: AddBalanceRequest):
         if not db:
             return JSONResponse(status_code=500, content={"error": "Database not connected"})
             
-        user = get_user(request.user_id)
+        user = await get_user(request.user_id)
         if not user:
             return JSONResponse(status_code=404, content={"error": "User not found"})
         
@@ -1087,14 +1345,11 @@ async def add_balance(request: AddBalanceRequest):
             return JSONResponse(status_code=400, content={"error": "Максимальная сумма пополнения 50,000₽"})
         
         if request.payment_method == "yookassa":
-            SHOP_ID = os.getenv("SHOP_ID")
-            API_KEY = os.getenv("API_KEY")
-            
-            if not SHOP_ID or not API_KEY:
+            if not yookassa.configured:
                 return JSONResponse(status_code=500, content={"error": "Payment gateway not configured"})
             
             payment_id = str(uuid.uuid4())
-            save_payment(payment_id, request.user_id, request.amount, "balance", "balance", "yookassa")
+            await save_payment(payment_id, request.user_id, request.amount, "balance", "balance", "yookassa")
             
             yookassa_data = {
                 "amount": {"value": f"{request.amount:.2f}", "currency": "RUB"},
@@ -1109,21 +1364,11 @@ async def add_balance(request: AddBalanceRequest):
                 }
             }
             
-            async with httpx.AsyncClient() as client:
-                response = await client.post(
-                    "https://api.yookassa.ru/v3/payments",
-                    auth=(SHOP_ID, API_KEY),
-                    headers={
-                        "Content-Type": "application/json",
-                        "Idempotence-Key": payment_id
-                    },
-                    json=yookassa_data,
-                    timeout=30.0
-                )
+            response = await yookassa.create_payment(yookassa_data, payment_id)
             
             if response.status_code in [200, 201]:
                 payment_data = response.json()
-                update_payment_status(payment_id, "pending", payment_data.get("id"))
+                await update_payment_status(payment_id, "pending", payment_data.get("id"))
                 
                 return {
                     "success": True,
@@ -1148,7 +1393,7 @@ async def activate_tariff(request: ActivateTariffRequest):
         if not db:
             return JSONResponse(status_code=500, content={"error": "Database not connected"})
             
-        user = get_user(request.user_id)
+        user = await get_user(request.user_id)
         if not user:
             return JSONResponse(status_code=404, content={"error": "User not found"})
         
@@ -1159,7 +1404,7 @@ async def activate_tariff(request: ActivateTariffRequest):
         tariff_price = tariff_data["price"]
         tariff_days = tariff_data["days"]
         
-        selected_server = request.selected_server or user.get('preferred_server') or "moscow"
+        selected_server = request.selected_server or user.get('preferred_server') or node_health.pick_server()
         
         if request.payment_method == "balance":
             user_balance = user.get('balance', 0.0)
@@ -1168,25 +1413,25 @@ async def activate_tariff(request: ActivateTariffRequest):
                 return JSONResponse(status_code=400, content={"error": f"Недостаточно средств на балансе. Необходимо: {tariff_price}₽, доступно: {user_balance}₽"})
             
             payment_id = str(uuid.uuid4())
-            save_payment(payment_id, request.user_id, tariff_price, request.tariff, "tariff", "balance", selected_server)
+            await save_payment(payment_id, request.user_id, tariff_price, request.tariff, "tariff", "balance", selected_server)
             
-            update_user_balance(request.user_id, -tariff_price)
+            error = await debit_for_tariff(request.user_id, tariff_price, payment_id)
+            if error:
+                return error
             
             success = await update_subscription_days(request.user_id, tariff_days, selected_server)
             
             if not success:
+                await refund_tariff(request.user_id, tariff_price, payment_id)
                 return JSONResponse(status_code=500, content={"error": "Ошибка активации подписки"})
             
             if user.get('referred_by'):
                 referrer_id = user['referred_by']
-                referral_id = f"{referrer_id}_{request.user_id}"
-                
-                referral_exists = db.collection('referrals').document(referral_id).get().exists
                 
-                if not referral_exists:
-                    add_referral_bonus_immediately(referrer_id, request.user_id)
+                if not await referral_exists(referrer_id, request.user_id):
+                    await add_referral_bonus_immediately(referrer_id, request.user_id)
             
-            update_payment_status(payment_id, "succeeded")
+            await update_payment_status(payment_id, "succeeded")
             
             return {
                 "success": True,
@@ -1199,14 +1444,11 @@ async def activate_tariff(request: ActivateTariffRequest):
             }
         
         elif request.payment_method == "yookassa":
-            SHOP_ID = os.getenv("SHOP_ID")
-            API_KEY = os.getenv("API_KEY")
-            
-            if not SHOP_ID or not API_KEY:
+            if not yookassa.configured:
                 return JSONResponse(status_code=500, content={"error": "Payment gateway not configured"})
             
             payment_id = str(uuid.uuid4())
-            save_payment(payment_id, request.user_id, tariff_price, request.tariff, "tariff", "yookassa", selected_server)
+            await save_payment(payment_id, request.user_id, tariff_price, request.tariff, "tariff", "yookassa", selected_server)
             
             yookassa_data = {
                 "amount": {"value": f"{tariff_price:.2f}", "currency": "RUB"},
@@ -1223,21 +1465,11 @@ async def activate_tariff(request: ActivateTariffRequest):
                 }
             }
             
-            async with httpx.AsyncClient() as client:
-                response = await client.post(
-                    "https://api.yookassa.ru/v3/payments",
-                    auth=(SHOP_ID, API_KEY),
-                    headers={
-                        "Content-Type": "application/json",
-                        "Idempotence-Key": payment_id
-                    },
-                    json=yookassa_data,
-                    timeout=30.0
-                )
+            response = await yookassa.create_payment(yookassa_data, payment_id)
             
             if response.status_code in [200, 201]:
                 payment_data = response.json()
-                update_payment_status(payment_id, "pending", payment_data.get("id"))
+                await update_payment_status(payment_id, "pending", payment_data.get("id"))
                 
                 return {
                     "success": True,
@@ -1265,11 +1497,11 @@ async def buy_with_balance(request: BuyWithBalanceRequest):
         if not db:
             return JSONResponse(status_code=500, content={"error": "Database not connected"})
         
-        user = get_user(request.user_id)
+        user = await get_user(request.user_id)
         if not user:
             return JSONResponse(status_code=404, content={"error": "User not found"})
         
-        selected_server = request.selected_server or "moscow"
+        selected_server = request.selected_server or node_health.pick_server()
         
         user_balance = user.get('balance', 0.0)
         
@@ -1280,25 +1512,25 @@ async def buy_with_balance(request: BuyWithBalanceRequest):
             })
         
         payment_id = str(uuid.uuid4())
-        save_payment(payment_id, request.user_id, request.tariff_price, request.tariff_id, "tariff", "balance", selected_server)
+        await save_payment(payment_id, request.user_id, request.tariff_price, request.tariff_id, "tariff", "balance", selected_server)
         
-        update_user_balance(request.user_id, -request.tariff_price)
+        error = await debit_for_tariff(request.user_id, request.tariff_price, payment_id)
+        if error:
+            return error
         
         success = await update_subscription_days(request.user_id, request.tariff_days, selected_server)
         
         if not success:
+            await refund_tariff(request.user_id, request.tariff_price, payment_id)
             return JSONResponse(status_code=500, content={"error": "Ошибка активации подписки"})
         
         if user.get('referred_by'):
             referrer_id = user['referred_by']
-            referral_id = f"{referrer_id}_{request.user_id}"
-            
-            referral_exists = db.collection('referrals').document(referral_id).get().exists
             
-            if not referral_exists:
-                add_referral_bonus_immediately(referrer_id, request.user_id)
+            if not await referral_exists(referrer_id, request.user_id):
+                await add_referral_bonus_immediately(referrer_id, request.user_id)
         
-        update_payment_status(payment_id, "succeeded")
+        await update_payment_status(payment_id, "succeeded")
         
         return {
             "success": True,
@@ -1314,6 +1546,101 @@ async def buy_with_balance(request: BuyWithBalanceRequest):
         logger.error(f"❌ Error in buy-with-balance: {e}")
         return JSONResponse(status_code=500, content={"error": str(e)})
 
+@app.post("/yookassa/webhook")
+async def yookassa_webhook(request: Request):
+    """Уведомления YooKassa о смене статуса платежа"""
+    try:
+        notification = await request.json()
+        yookassa_id = (notification.get('object') or {}).get('id')
+        if not yookassa_id:
+            return JSONResponse(status_code=400, content={"error": "Invalid notification"})
+        
+        # Телу уведомления не доверяем: статус, сумму и метаданные берем из API YooKassa
+        yookassa_data = await yookassa.get_payment(yookassa_id, fresh=True)
+        payment_id = (yookassa_data.get('metadata') or {}).get('payment_id')
+        payment = await get_payment(payment_id) if payment_id else None
+        
+        if not payment or payment.get('yookassa_id') not in (None, yookassa_id):
+            logger.warning(f"⚠️ YooKassa notification for unknown payment {yookassa_id}")
+            return {"success": True, "ignored": True}
+        
+        if float(yookassa_data.get('amount', {}).get('value', 0)) != float(payment['amount']):
+            logger.warning(f"⚠️ YooKassa amount mismatch for payment {payment_id}")
+            return {"success": True, "ignored": True}
+        
+        status = yookassa_data.get('status')
+        if not await finalize_payment(payment_id, payment, status, yookassa_id):
+            # Ответ не 200 - YooKassa повторит уведомление позже
+            return JSONResponse(status_code=500, content={"error": "Payment finalization failed"})
+        
+        logger.info(f"🔔 YooKassa notification processed: {payment_id} -> {status}")
+        return {"success": True, "payment_id": payment_id, "status": status}
+        
+    except Exception as e:
+        logger.error(f"❌ Error processing YooKassa notification: {e}")
+        return JSONResponse(status_code=500, content={"error": str(e)})
+
+@app.get("/payment-events")
+async def payment_events_stream(payment_id: str, user_id: str):
+    """Server-Sent Events со статусом платежа: одно соединение вместо опроса"""
+    try:
+        if not db:
+            return JSONResponse(status_code=500, content={"error": "Database not connected"})
+        
+        if not payment_id or payment_id == 'undefined':
+            return JSONResponse(status_code=400, content={"error": "Invalid payment ID"})
+        
+        # Подписка до чтения платежа, чтобы не пропустить смену статуса между ними
+        future = payment_events.subscribe(payment_id)
+        payment = await get_payment(payment_id)
+        if not payment:
+            payment_events.unsubscribe(payment_id, future)
+            return JSONResponse(status_code=404, content={"error": "Payment not found"})
+        
+        def sse(event: dict) -> str:
+            return f"data: {json.dumps(event, default=str)}\n\n"
+        
+        async def stream():
+            nonlocal future
+            try:
+                event = payment_status_response(payment_id, payment, payment['status'])
+                yield sse(event)
+                if event['status'] in database.PAYMENT_FINAL_STATUSES:
+                    return
+                
+                started = time.monotonic()
+                next_check = started + PAYMENT_EVENTS_GATEWAY_INTERVAL
+                while time.monotonic() - started < PAYMENT_EVENTS_MAX_SECONDS:
+                    try:
+                        event = await asyncio.wait_for(asyncio.shield(future), timeout=PAYMENT_EVENTS_HEARTBEAT)
+                    except asyncio.TimeoutError:
+                        if not YOOKASSA_WEBHOOKS_ENABLED and time.monotonic() >= next_check:
+                            # Без уведомлений шлюз проверяет сервер; смена статуса придет через publish
+                            next_check = time.monotonic() + PAYMENT_EVENTS_GATEWAY_INTERVAL
+                            try:
+                                await resolve_payment_status(payment_id, await get_payment(payment_id))
+                            except Exception as e:
+                                logger.warning(f"⚠️ Payment events gateway check failed for {payment_id}: {e}")
+                        yield ": ping\n\n"
+                        continue
+                    
+                    future = payment_events.subscribe(payment_id)
+                    yield sse(event)
+                    if event['status'] in database.PAYMENT_FINAL_STATUSES:
+                        return
+            finally:
+                payment_events.unsubscribe(payment_id, future)
+        
+        return StreamingResponse(
+            stream(),
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+        )
+        
+    except Exception as e:
+        logger.error(f"❌ Error streaming payment events: {e}")
+        return JSONResponse(status_code=500, content={"error": str(e)})
+
 @app.get("/payment-status")
 async def check_payment(payment_id: str, user_id: str):
     try:
@@ -1323,7 +1650,7 @@ async def check_payment(payment_id: str, user_id: str):
         if not payment_id or payment_id == 'undefined':
             return JSONResponse(status_code=400, content={"error": "Invalid payment ID"})
             
-        payment = get_payment(payment_id)
+        payment = await get_payment(payment_id)
         if not payment:
             return JSONResponse(status_code=404, content={"error": "Payment not found"})
         
@@ -1332,97 +1659,7 @@ async def check_payment(payment_id: str, user_id: str):
         if not actual_user_id or actual_user_id == 'undefined':
             return JSONResponse(status_code=400, content={"error": "Invalid user ID"})
         
-        if payment['status'] == 'succeeded':
-            if payment['payment_type'] == 'balance':
-                return {
-                    "success": True,
-                    "status": "succeeded",
-                    "payment_id": payment_id,
-                    "amount": payment['amount'],
-                    "balance_added": payment['amount']
-                }
-            else:
-                return {
-                    "success": True,
-                    "status": "succeeded",
-                    "payment_id": payment_id,
-                    "amount": payment['amount'],
-                    "selected_server": payment.get('selected_server')
-                }
-        
-        if payment.get('payment_method') == 'yookassa':
-            yookassa_id = payment.get('yookassa_id')
-            if yookassa_id:
-                SHOP_ID = os.getenv("SHOP_ID")
-                API_KEY = os.getenv("API_KEY")
-                
-                if not SHOP_ID or not API_KEY:
-                    return JSONResponse(status_code=500, content={"error": "Payment gateway not configured"})
-                
-                async with httpx.AsyncClient() as client:
-                    response = await client.get(
-                        f"https://api.yookassa.ru/v3/payments/{yookassa_id}",
-                        auth=(SHOP_ID, API_KEY),
-                        timeout=30.0
-                    )
-                    
-                    if response.status_code == 200:
-                        yookassa_data = response.json()
-                        status = yookassa_data.get('status')
-                        
-                        update_payment_status(payment_id, status, yookassa_id)
-                        
-                        if status == 'succeeded':
-                            if payment['payment_type'] == 'balance':
-                                amount = payment['amount']
-                                success = update_user_balance(actual_user_id, amount)
-                                
-                                if success:
-                                    return {
-                                        "success": True,
-                                        "status": status,
-                                        "payment_id": payment_id,
-                                        "amount": amount,
-                                        "balance_added": amount,
-                                        "message": f"Баланс успешно пополнен на {amount}₽!"
-                                    }
-                                else:
-                                    return JSONResponse(status_code=500, content={"error": "Ошибка пополнения баланса"})
-                            
-                            tariff_user_id = payment.get('user_id', actual_user_id)
-                            tariff = payment['tariff']
-                            tariff_days = TARIFFS[tariff]["days"]
-                            selected_server = payment.get('selected_server')
-                            
-                            success = await update_subscription_days(tariff_user_id, tariff_days, selected_server)
-                            
-                            if not success:
-                                return JSONResponse(status_code=500, content={"error": "Failed to activate subscription"})
-                            
-                            user = get_user(tariff_user_id)
-                            if user and user.get('referred_by'):
-                                referrer_id = user['referred_by']
-                                referral_id = f"{referrer_id}_{tariff_user_id}"
-                                
-                                referral_exists = db.collection('referrals').document(referral_id).get().exists
-                                
-                                if not referral_exists:
-                                    add_referral_bonus_immediately(referrer_id, tariff_user_id)
-                            
-                            return {
-                                "success": True,
-                                "status": status,
-                                "payment_id": payment_id,
-                                "amount": payment['amount'],
-                                "days_added": tariff_days,
-                                "selected_server": selected_server
-                            }
-        
-        return {
-            "success": True,
-            "status": payment['status'],
-            "payment_id": payment_id
-        }
+        return await resolve_payment_status(payment_id, payment)
         
     except Exception as e:
         logger.error(f"❌ Error checking payment: {e}")
@@ -1434,12 +1671,12 @@ async def get_vless_config(user_id: str, server_id: str = None):
         if not db:
             return JSONResponse(status_code=500, content={"error": "Database not connected"})
             
-        process_subscription_days(user_id)
-            
-        user = get_user(user_id)
+        user = await get_user(user_id)
         if not user:
             return JSONResponse(status_code=404, content={"error": "User not found"})
         
+        await revoke_if_expired(user_id, user)
+        
         if not user.get('has_subscription', False):
             return JSONResponse(status_code=400, content={"error": "No active subscription"})
         
@@ -1447,7 +1684,7 @@ async def get_vless_config(user_id: str, server_id: str = None):
         vless_uuid = await ensure_user_uuid(user_id, server_id)
         
         # Мгновенное создание конфигов
-        configs = create_user_vless_configs(user_id, vless_uuid, server_id)
+        configs = await create_user_vless_configs(user_id, vless_uuid, server_id)
         
         return {
             "success": True,
@@ -1471,7 +1708,7 @@ async def save_vless_key(request: SaveVlessKeyRequest):
         if not db:
             return JSONResponse(status_code=500, content={"error": "Database not connected"})
         
-        success = save_vless_key_to_db(
+        success = await save_vless_key_to_db(
             request.user_id, 
             request.server_id, 
             request.vless_key, 
@@ -1496,7 +1733,7 @@ async def get_user_vless_keys_endpoint(user_id: str):
         if not db:
             return JSONResponse(status_code=500, content={"error": "Database not connected"})
         
-        vless_keys = get_user_vless_keys(user_id)
+        vless_keys = await get_user_vless_keys(user_id)
         
         return {
             "success": True,
@@ -1512,19 +1749,26 @@ async def get_user_vless_keys_endpoint(user_id: str):
 @app.get("/check-user-access")
 async def check_user_access(user_uuid: str):
     try:
-        users_ref = db.collection('users')
-        query = users_ref.where('vless_uuid', '==', user_uuid).limit(1)
-        results = query.stream()
+        if access_index.ready:
+            # Горячий путь для авторизации на нодах: только память
+            access = access_index.check(user_uuid)
+            if access:
+                return {"success": True, "has_access": True, **access}
+            return {
+                "success": True,
+                "has_access": False,
+                "reason": "No active subscription"
+            }
         
-        for doc in results:
-            user_data = doc.to_dict()
+        user_data = await find_user_by_uuid(user_uuid)
+        
+        if user_data:
             user_id = user_data.get('user_id')
             
-            process_subscription_days(user_id)
+            await revoke_if_expired(user_id, user_data)
             
-            user_updated = get_user(user_id)
-            has_subscription = user_updated.get('has_subscription', False)
-            subscription_days = user_updated.get('subscription_days', 0)
+            has_subscription = user_data.get('has_subscription', False)
+            subscription_days = user_data.get('subscription_days', 0)
             
             if has_subscription and subscription_days > 0:
                 return {
@@ -1546,16 +1790,56 @@ async def check_user_access(user_uuid: str):
             content={"success": False, "error": str(e)}
         )
 
+@app.post("/check-user-access/batch")
+async def check_user_access_batch(request: AccessBatchRequest):
+    """Проверка доступа для списка UUID за один запрос (например, после перезапуска ноды)"""
+    try:
+        if len(request.uuids) > ACCESS_BATCH_MAX_ITEMS:
+            return JSONResponse(
+                status_code=400,
+                content={"success": False, "error": f"Too many UUIDs, max {ACCESS_BATCH_MAX_ITEMS}"}
+            )
+        
+        uuids = list(dict.fromkeys(request.uuids))
+        access = {}
+        if access_index.ready:
+            now = datetime.now(timezone.utc)
+            for user_uuid in uuids:
+                result = access_index.check(user_uuid, now)
+                if result:
+                    access[user_uuid] = result
+        else:
+            for user_uuid, user_data in (await database.find_users_by_uuids(uuids)).items():
+                if user_data.get('has_subscription') and user_data.get('subscription_days', 0) > 0:
+                    access[user_uuid] = {
+                        "user_id": user_data['user_id'],
+                        "subscription_days": user_data['subscription_days']
+                    }
+        
+        return {
+            "success": True,
+            "checked": len(uuids),
+            "allowed": len(access),
+            "results": {
+                user_uuid: {"has_access": True, **access[user_uuid]} if user_uuid in access else {"has_access": False}
+                for user_uuid in uuids
+            }
+        }
+        
+    except Exception as e:
+        logger.error(f"❌ Error in check-user-access batch: {e}")
+        return JSONResponse(
+            status_code=500,
+            content={"success": False, "error": str(e)}
+        )
+
 @app.get("/active-users")
 async def get_active_users():
     try:
-        users_ref = db.collection('users')
-        query = users_ref.where('has_subscription', '==', True)
-        results = query.stream()
+        users = await get_subscribed_users()
         
         active_users = []
-        for doc in results:
-            user_data = doc.to_dict()
+        for user_data in users:
             if user_data.get('subscription_days', 0) > 0:
                 active_users.append({
                     "user_id": user_data.get('user_id'),
@@ -1578,7 +1862,7 @@ async def get_active_users():
 @app.post("/force-add-to-xray")
 async def force_add_to_xray(user_id: str, server_id: str = None):
     try:
-        user = get_user(user_id)
+        user = await get_user(user_id)
         if not user:
             return JSONResponse(status_code=404, content={"error": "User not found"})
         
@@ -1603,10 +1887,30 @@ async def force_add_to_xray(user_id: str, server_id: str = None):
         logger.error(f"❌ Error in force-add-to-xray: {e}")
         return JSONResponse(status_code=500, content={"error": str(e)})
 
+@app.post("/admin/reconcile-xray")
+async def reconcile_xray():
+    """Сверка нод Xray по запросу"""
+    try:
+        report = await reconcile_xray_nodes()
+        return {"success": "error" not in report, **report}
+    except Exception as e:
+        logger.error(f"❌ Error in reconcile-xray: {e}")
+        return JSONResponse(status_code=500, content={"error": str(e)})
+
+@app.post("/admin/reconcile-payments")
+async def reconcile_payments():
+    """Сверка незавершенных платежей со шлюзом по запросу"""
+    try:
+        report = await reconcile_pending_payments()
+        return {"success": "error" not in report, **report}
+    except Exception as e:
+        logger.error(f"❌ Error in reconcile-payments: {e}")
+        return JSONResponse(status_code=500, content={"error": str(e)})
+
 @app.post("/emergency-add-to-xray")
 async def emergency_add_to_xray(user_id: str):
     try:
-        user = get_user(user_id)
+        user = await get_user(user_id)
         if not user:
             return JSONResponse(status_code=404, content={"error": "User not found"})
         
@@ -1614,24 +1918,25 @@ async def emergency_add_to_xray(user_id: str):
         if not vless_uuid:
             return JSONResponse(status_code=400, content={"error": "User has no UUID"})
         
+        results = await xray_clients.fan_out(
+            list(XRAY_SERVERS.keys()),
+            lambda server_name: xray_batch(server_name, add=[vless_uuid]),
+            deadline=XRAY_MUTATION_DEADLINE
+        )
         success_count = 0
-        for server_name, server_config in XRAY_SERVERS.items():
-            try:
-                success = await add_user_to_xray(vless_uuid, server_name)
-                if success:
-                    success_count += 1
-            except Exception as e:
-                logger.error(f"❌ Emergency add failed for {server_name}: {e}")
+        for server_name, result in results.items():
+            if isinstance(result, Exception):
+                logger.error(f"❌ Emergency add failed for {server_name}: {result!r}")
+            elif result.get(vless_uuid):
+                success_count += 1
         
-        user_vless_keys = get_user_vless_keys(user_id)
-        for key_data in user_vless_keys:
-            update_vless_key_status(user_id, key_data['server_id'], True)
+        keys_activated = await set_user_vless_keys_status(user_id, True)
         
         return {
             "success": True,
             "message": f"User {user_id} emergency added to {success_count} servers",
             "servers_added": success_count,
-            "keys_activated": len(user_vless_keys)
+            "keys_activated": keys_activated
         }
             
     except Exception as e:
@@ -1644,27 +1949,26 @@ async def admin_cancel_subscription(user_id: str):
         if not db:
             return JSONResponse(status_code=500, content={"error": "Database not connected"})
         
-        user_ref = db.collection('users').document(user_id)
-        user = user_ref.get()
+        user_data = await get_user(user_id)
         
-        if not user.exists:
+        if not user_data:
             return JSONResponse(status_code=404, content={"error": "User not found"})
         
-        user_data = user.to_dict()
         vless_uuid = user_data.get('vless_uuid')
         
         update_data = {
             'has_subscription': False,
             'subscription_days': 0,
+            'expires_at': None,
             'subscription_start': None,
             'updated_at': firestore.SERVER_TIMESTAMP
         }
         
-        user_ref.update(update_data)
+        await update_user(user_id, update_data)
+        expiry_index.cancel(user_id)
+        access_index.remove_user(user_id)
         
-        user_vless_keys = get_user_vless_keys(user_id)
-        for key_data in user_vless_keys:
-            update_vless_key_status(user_id, key_data['server_id'], False)
+        await set_user_vless_keys_status(user_id, False)
         
         return {
             "success": True,
@@ -1679,30 +1983,27 @@ async def admin_cancel_subscription(user_id: str):
         logger.error(f"❌ Error cancelling subscription: {e}")
         return JSONResponse(status_code=500, content={"error": str(e)})
 @app.get("/admin/last-added-users")
-async def get_last_added_users(limit: int = 10):
+async def get_last_added_users(limit: int = 10, cursor: str = None):
     """Получить последних добавленных пользователей"""
     try:
         if not db:
             return JSONResponse(status_code=500, content={"error": "Database not connected"})
         
         # Получаем пользователей отсортированных по дате создания
-        users_ref = db.collection('users').order_by('created_at', direction=firestore.Query.DESCENDING).limit(limit)
-        users = users_ref.stream()
+        users, next_cursor = await get_last_users(limit, cursor)
+        # Ключи всех пользователей страницы одним проходом запросов 'in'
+        keys_by_user = await database.get_vless_keys_for_users([user_data['user_id'] for user_data in users])
         
         last_users = []
-        for user_doc in users:
-            user_data = user_doc.to_dict()
-            user_data['user_id'] = user_doc.id
-            
+        for user_data in users:
             # Получаем информацию о подписке
             has_subscription = user_data.get('has_subscription', False)
             subscription_days = user_data.get('subscription_days', 0)
             
-            # Получаем VLESS ключи пользователя
-            vless_keys = get_user_vless_keys(user_doc.id)
+            vless_keys = keys_by_user.get(user_data['user_id'], [])
             
             last_users.append({
-                'user_id': user_doc.id,
+                'user_id': user_data['user_id'],
                 'username': user_data.get('username', ''),
                 'first_name': user_data.get('first_name', ''),
                 'last_name': user_data.get('last_name', ''),
@@ -1718,7 +2019,8 @@ async def get_last_added_users(limit: int = 10):
         return {
             "success": True,
             "total_count": len(last_users),
-            "users": last_users
+            "users": last_users,
+            "next_cursor": next_cursor
         }
         
     except Exception as e:
@@ -1726,22 +2028,20 @@ async def get_last_added_users(limit: int = 10):
         return JSONResponse(status_code=500, content={"error": str(e)})
 
 @app.get("/admin/recent-configs")
-async def get_recent_configs(limit: int = 20):
+async def get_recent_configs(limit: int = 20, cursor: str = None):
     """Получить последние созданные конфиги"""
     try:
         if not db:
             return JSONResponse(status_code=500, content={"error": "Database not connected"})
         
         # Получаем последние VLESS ключи
-        vless_keys_ref = db.collection('vless_keys').order_by('created_at', direction=firestore.Query.DESCENDING).limit(limit)
-        vless_keys = vless_keys_ref.stream()
+        vless_keys, next_cursor = await get_recent_vless_keys(limit, cursor)
+        # Владельцы ключей страницы одним пакетным чтением
+        users = await database.get_users_by_ids([key_data['user_id'] for key_data in vless_keys if key_data.get('user_id')])
         
         recent_configs = []
-        for key_doc in vless_keys:
-            key_data = key_doc.to_dict()
-            
-            # Получаем информацию о пользователе
-            user_data = get_user(key_data.get('user_id'))
+        for key_data in vless_keys:
+            user_data = users.get(key_data.get('user_id'))
             
             recent_configs.append({
                 'user_id': key_data.get('user_id'),
@@ -1755,7 +2055,8 @@ async def get_recent_configs(limit: int = 20):
         return {
             "success": True,
             "total_count": len(recent_configs),
-            "configs": recent_configs
+            "configs": recent_configs,
+            "next_cursor": next_cursor
         }
         
     except Exception as e:
@@ -1769,11 +2070,11 @@ async def get_user_configs(user_id: str):
         if not db:
             return JSONResponse(status_code=500, content={"error": "Database not connected"})
         
-        user = get_user(user_id)
+        user = await get_user(user_id)
         if not user:
             return JSONResponse(status_code=404, content={"error": "User not found"})
         
-        vless_keys = get_user_vless_keys(user_id)
+        vless_keys = await get_user_vless_keys(user_id)
         
         return {
             "success": True,
@@ -1796,41 +2097,54 @@ async def get_user_configs(user_id: str):
         return JSONResponse(status_code=500, content={"error": str(e)})
 
 @app.get("/admin/xray-current-users")
-async def get_xray_current_users():
-    """Получить всех пользователей из Xray конфигурации"""
+async def get_xray_current_users(server_id: str = None, offset: int = 0, limit: int = XRAY_USERS_PAGE_SIZE):
+    """Получить пользователей из Xray конфигурации постранично, потоковым JSON"""
     try:
-        current_uuids = get_current_uuids()
-        
-        # Получаем дополнительную информацию о пользователях из базы
-        users_info = []
-        for uuid in current_uuids:
-            # Находим пользователя в базе по UUID
-            users_ref = db.collection('users')
-            query = users_ref.where('vless_uuid', '==', uuid).limit(1)
-            results = query.stream()
-            
-            user_data = None
-            for doc in results:
-                user_data = doc.to_dict()
-                user_data['user_id'] = doc.id
-                break
-            
-            users_info.append({
-                'uuid': uuid,
-                'user_id': user_data.get('user_id') if user_data else 'Unknown',
-                'username': user_data.get('username', '') if user_data else '',
-                'first_name': user_data.get('first_name', '') if user_data else '',
-                'has_subscription': user_data.get('has_subscription', False) if user_data else False,
-                'subscription_days': user_data.get('subscription_days', 0) if user_data else 0
-            })
+        server_id = server_id if server_id in XRAY_SERVERS else next(iter(XRAY_SERVERS))
+        offset = max(offset, 0)
+        limit = min(max(limit, 1), XRAY_USERS_PAGE_MAX)
         
-        return {
+        current_uuids = sorted(await get_node_uuids(server_id))
+        page = current_uuids[offset:offset + limit]
+        next_offset = offset + limit if offset + limit < len(current_uuids) else None
+        
+        header = {
             "success": True,
+            "server_id": server_id,
             "total_users": len(current_uuids),
-            "users": users_info,
+            "offset": offset,
+            "limit": limit,
+            "next_offset": next_offset,
             "timestamp": datetime.now().isoformat()
         }
         
+        async def stream_users():
+            # Заголовок без закрывающей скобки, дальше массив users по частям
+            yield json.dumps(header)[:-1] + ', "users": ['
+            first = True
+            for start in range(0, len(page), XRAY_USERS_STREAM_CHUNK):
+                chunk = page[start:start + XRAY_USERS_STREAM_CHUNK]
+                # Данные из базы запросами 'in' по 30 UUID вместо запроса на каждый
+                users = await database.find_users_by_uuids(chunk)
+                
+                items = []
+                for user_uuid in chunk:
+                    user_data = users.get(user_uuid) or {}
+                    items.append(json.dumps({
+                        'uuid': user_uuid,
+                        'user_id': user_data.get('user_id', 'Unknown'),
+                        'username': user_data.get('username', ''),
+                        'first_name': user_data.get('first_name', ''),
+                        'has_subscription': user_data.get('has_subscription', False),
+                        'subscription_days': user_data.get('subscription_days', 0)
+                    }, default=str))
+                
+                yield ("" if first else ", ") + ", ".join(items)
+                first = False
+            yield "]}"
+        
+        return StreamingResponse(stream_users(), media_type="application/json")
+        
     except Exception as e:
         logger.error(f"❌ Error getting Xray users: {e}")
         return JSONResponse(status_code=500, content={"error": str(e)})
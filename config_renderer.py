@@ -0,0 +1,46 @@
+import json
+from typing import Iterable
+
+COMPACT = (',', ':')
+
+
+class ConfigRenderer:
+    """Потоковая запись конфига Xray из шаблона и набора клиентов
+
+    Все части конфига, кроме списка клиентов первого inbound, сериализуются
+    один раз при создании. При записи меняется только сегмент клиентов,
+    который пишется частями из заранее закодированных строк.
+    """
+    
+    MARKER = "__XRAY_CLIENTS__"
+    
+    def __init__(self, config: dict, inbound_index: int = 0):
+        template = dict(config)
+        template['inbounds'] = list(config['inbounds'])
+        inbound = dict(template['inbounds'][inbound_index])
+        inbound['settings'] = dict(inbound['settings'], clients=self.MARKER)
+        template['inbounds'][inbound_index] = inbound
+        
+        text = json.dumps(template, separators=COMPACT, ensure_ascii=False)
+        self.prefix, self.suffix = text.split(json.dumps(self.MARKER))
+    
+    @staticmethod
+    def encode_client(client: dict) -> str:
+        return json.dumps(client, separators=COMPACT, ensure_ascii=False)
+    
+    def write(self, f, encoded_clients: Iterable[str], chunk_size: int = 1000):
+        """Пишет конфиг в открытый файл, клиентов - порциями по chunk_size"""
+        f.write(self.prefix)
+        f.write("[")
+        chunk = []
+        first = True
+        for encoded in encoded_clients:
+            chunk.append(encoded)
+            if len(chunk) >= chunk_size:
+                f.write(("" if first else ",") + ",".join(chunk))
+                first = False
+                chunk = []
+        if chunk:
+            f.write(("" if first else ",") + ",".join(chunk))
+        f.write("]")
+        f.write(self.suffix)
@@ -0,0 +1,903 @@
+import os
+import math
+import time
+import uuid
+import logging
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from typing import List
+
+import firebase_admin
+from firebase_admin import credentials, firestore, firestore_async
+from google.api_core import exceptions as google_exceptions
+
+logger = logging.getLogger(__name__)
+
+# Асинхронный клиент Firestore. Все функции модуля - корутины,
+# поэтому event loop никогда не ждет gRPC ответа синхронно.
+db = None
+
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "10000"))
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "30"))
+
+
+class UserCache:
+    """LRU кэш документов пользователей с TTL и сбросом при записи"""
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        # Поколение ключа растет при каждом сбросе, чтобы чтение,
+        # начатое до записи, не положило в кэш устаревший документ
+        self._generations = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, user_id: str):
+        entry = self._entries.get(user_id)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        expires_at, user_data = entry
+        if expires_at < time.monotonic():
+            del self._entries[user_id]
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(user_id)
+        self.hits += 1
+        return dict(user_data)
+
+    def generation(self, user_id: str) -> int:
+        return self._generations.get(user_id, 0)
+
+    def put(self, user_id: str, user_data: dict, generation: int):
+        if generation != self.generation(user_id):
+            return
+
+        self._entries[user_id] = (time.monotonic() + self.ttl, dict(user_data))
+        self._entries.move_to_end(user_id)
+
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, user_id: str):
+        self._entries.pop(user_id, None)
+        self._generations[user_id] = self.generation(user_id) + 1
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0
+        }
+
+
+user_cache = UserCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+
+
+# Подписка хранится как момент окончания expires_at, а has_subscription
+# и subscription_days вычисляются при чтении без записи в базу
+def to_utc(value) -> datetime:
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value
+
+def legacy_expires_at(user_data: dict):
+    """Срок окончания для документов старой схемы subscription_days + last_subscription_check"""
+    subscription_days = user_data.get('subscription_days') or 0
+    if not user_data.get('has_subscription', False) or subscription_days <= 0:
+        return None
+
+    last_check = user_data.get('last_subscription_check')
+    start = to_utc(last_check) if last_check else datetime.now(timezone.utc)
+    return start + timedelta(days=subscription_days)
+
+def get_expires_at(user_data: dict):
+    if 'expires_at' not in user_data:
+        return legacy_expires_at(user_data)
+    expires_at = user_data.get('expires_at')
+    return to_utc(expires_at) if expires_at else None
+
+def with_subscription_state(user_data: dict) -> dict:
+    """Подставляет в документ вычисленные has_subscription и subscription_days"""
+    expires_at = get_expires_at(user_data)
+    remaining = (expires_at - datetime.now(timezone.utc)).total_seconds() if expires_at else 0
+    is_active = remaining > 0
+
+    # Флаг в базе остается True до отзыва доступа, поэтому истекшая,
+    # но еще не отозванная подписка помечается для отзыва
+    user_data['revocation_pending'] = user_data.get('has_subscription', False) and not is_active
+    user_data['has_subscription'] = is_active
+    user_data['subscription_days'] = math.ceil(remaining / 86400) if is_active else 0
+    user_data['expires_at'] = expires_at
+    return user_data
+
+
+def init_firebase():
+    """Инициализация Firebase и асинхронного клиента Firestore"""
+    global db
+
+    try:
+        if not firebase_admin._apps:
+            logger.info("🚀 Initializing Firebase for Railway")
+
+            firebase_config = {
+                "type": "service_account",
+                "project_id": os.getenv("FIREBASE_PROJECT_ID"),
+                "private_key_id": os.getenv("FIREBASE_PRIVATE_KEY_ID"),
+                "private_key": os.getenv("FIREBASE_PRIVATE_KEY", "").replace('\\n', '\n'),
+                "client_email": os.getenv("FIREBASE_CLIENT_EMAIL"),
+                "client_id": os.getenv("FIREBASE_CLIENT_ID"),
+                "auth_uri": "https://accounts.google.com/o/oauth2/auth",
+                "token_uri": "https://oauth2.googleapis.com/token",
+                "auth_provider_x509_cert_url": "https://www.googleapis.com/oauth2/v1/certs",
+                "client_x509_cert_url": os.getenv("FIREBASE_CLIENT_X509_CERT_URL"),
+                "universe_domain": "googleapis.com"
+            }
+
+            required_fields = ["project_id", "private_key", "client_email"]
+            for field in required_fields:
+                if not firebase_config.get(field):
+                    raise ValueError(f"Missing required Firebase config field: {field}")
+
+            cred = credentials.Certificate(firebase_config)
+            firebase_admin.initialize_app(cred)
+
+        db = firestore_async.client()
+        logger.info("✅ Firebase initialized successfully")
+
+    except Exception as e:
+        logger.error(f"❌ Firebase initialization failed: {str(e)}")
+        db = None
+
+    return db
+
+# Пользователи
+async def get_user(user_id: str):
+    if not db:
+        return None
+
+    cached = user_cache.get(user_id)
+    if cached is not None:
+        return with_subscription_state(cached)
+
+    try:
+        generation = user_cache.generation(user_id)
+        doc = await db.collection('users').document(user_id).get()
+        if not doc.exists:
+            return None
+
+        user_data = doc.to_dict()
+        user_cache.put(user_id, user_data, generation)
+        return with_subscription_state(user_data)
+    except Exception as e:
+        logger.error(f"❌ Error getting user: {e}")
+        return None
+
+async def create_user(user_id: str, user_data: dict) -> bool:
+    if not db:
+        return False
+    try:
+        await db.collection('users').document(user_id).set(user_data)
+        user_cache.invalidate(user_id)
+        return True
+    except Exception as e:
+        logger.error(f"❌ Error creating user: {e}")
+        return False
+
+async def update_user(user_id: str, update_data: dict) -> bool:
+    if not db:
+        return False
+    try:
+        await db.collection('users').document(user_id).update(update_data)
+        user_cache.invalidate(user_id)
+        return True
+    except Exception as e:
+        logger.error(f"❌ Error updating user: {e}")
+        return False
+
+@firestore.async_transactional
+async def _revoke_expired_subscription(transaction, user_ref):
+    # Перезапуск при конкурентной записи: продление перечитается и отзыв не состоится
+    user = await user_ref.get(transaction=transaction)
+    if not user.exists:
+        return False, None
+
+    user_data = with_subscription_state(user.to_dict())
+    if not user_data['revocation_pending']:
+        return False, user_data
+
+    transaction.update(user_ref, {
+        'has_subscription': False,
+        'subscription_days': 0,
+        'expires_at': None,
+        'updated_at': firestore.SERVER_TIMESTAMP
+    })
+    return True, user_data
+
+async def revoke_expired_subscription(user_id: str) -> tuple:
+    """Снимает истекшую подписку по свежему чтению в транзакции, без кэша
+
+    Возвращает (отозвана ли, документ на момент отзыва): подписка,
+    продленная после чтения вызывающим, не отзывается.
+    """
+    if not db:
+        raise Exception("Database not connected")
+    user_ref = db.collection('users').document(user_id)
+    revoked, user_data = await _revoke_expired_subscription(db.transaction(), user_ref)
+    if revoked:
+        user_cache.invalidate(user_id)
+    return revoked, user_data
+
+# Результаты проводки по балансу
+LEDGER_APPLIED = "applied"
+LEDGER_DUPLICATE = "duplicate"
+LEDGER_INSUFFICIENT = "insufficient"
+LEDGER_NOT_FOUND = "not_found"
+# Попытки транзакции при конкурентных проводках одного пользователя
+LEDGER_MAX_ATTEMPTS = 20
+
+@firestore.async_transactional
+async def _apply_ledger_entry(transaction, user_ref, entry_ref, amount: float, reason: str):
+    # Транзакция перезапускается при конкурентной записи пользователя или проводки
+    entry = await entry_ref.get(transaction=transaction)
+    if entry.exists:
+        return LEDGER_DUPLICATE, entry.to_dict().get('balance_after')
+
+    user = await user_ref.get(transaction=transaction)
+    if not user.exists:
+        return LEDGER_NOT_FOUND, None
+
+    new_balance = (user.to_dict().get('balance') or 0.0) + amount
+    if amount < 0 and new_balance < 0:
+        return LEDGER_INSUFFICIENT, new_balance - amount
+
+    transaction.create(entry_ref, {
+        'user_id': user_ref.id,
+        'amount': amount,
+        'reason': reason,
+        'balance_after': new_balance,
+        'created_at': firestore.SERVER_TIMESTAMP
+    })
+    transaction.update(user_ref, {
+        'balance': new_balance,
+        'updated_at': firestore.SERVER_TIMESTAMP
+    })
+    return LEDGER_APPLIED, new_balance
+
+async def apply_balance_entry(user_id: str, amount: float, entry_id: str, reason: str = "adjustment"):
+    """Атомарная проводка по балансу, возвращает (статус, баланс)
+
+    Каждая проводка - документ balance_ledger с ключом entry_id (обычно
+    payment_id), поэтому повтор той же операции не меняет баланс. Поле
+    balance пользователя - материализованная сумма проводок.
+    """
+    if not db:
+        return LEDGER_NOT_FOUND, None
+    user_ref = db.collection('users').document(user_id)
+    entry_ref = db.collection('balance_ledger').document(entry_id)
+    status, balance = await _apply_ledger_entry(db.transaction(max_attempts=LEDGER_MAX_ATTEMPTS), user_ref, entry_ref, amount, reason)
+    if status == LEDGER_APPLIED:
+        user_cache.invalidate(user_id)
+        logger.info(f"💰 Balance updated for user {user_id}: {amount:+} ({reason}) -> {balance}")
+    return status, balance
+
+async def update_user_balance(user_id: str, amount: float, entry_id: str = None, reason: str = "adjustment"):
+    """Зачисление/списание; True, если проводка применена сейчас или ранее"""
+    try:
+        status, _ = await apply_balance_entry(user_id, amount, entry_id or str(uuid.uuid4()), reason)
+        return status in (LEDGER_APPLIED, LEDGER_DUPLICATE)
+    except Exception as e:
+        logger.error(f"❌ Error updating balance: {e}")
+        return False
+
+async def find_user_by_uuid(user_uuid: str):
+    """Находит пользователя по VLESS UUID"""
+    if not db:
+        return None
+    try:
+        query = db.collection('users').where('vless_uuid', '==', user_uuid).limit(1)
+        async for doc in query.stream():
+            user_data = doc.to_dict()
+            user_data['user_id'] = user_data.get('user_id') or doc.id
+            return with_subscription_state(user_data)
+        return None
+    except Exception as e:
+        logger.error(f"❌ Error finding user by UUID: {e}")
+        return None
+
+async def find_users_by_uuids(user_uuids: List[str]) -> dict:
+    """Пользователи по списку VLESS UUID запросами 'in', результат UUID -> данные"""
+    if not db:
+        return {}
+    users = {}
+    for start in range(0, len(user_uuids), IN_QUERY_LIMIT):
+        chunk = user_uuids[start:start + IN_QUERY_LIMIT]
+        query = db.collection('users').where('vless_uuid', 'in', chunk)
+        async for doc in query.stream():
+            user_data = doc.to_dict()
+            user_data['user_id'] = user_data.get('user_id') or doc.id
+            users[user_data['vless_uuid']] = with_subscription_state(user_data)
+    return users
+
+async def load_subscribed_users() -> List[dict]:
+    """Все пользователи с флагом активной подписки; ошибка чтения пробрасывается
+
+    Для сверок, где пустой список означал бы "у всех нет доступа".
+    """
+    if not db:
+        raise Exception("Database not connected")
+    query = db.collection('users').where('has_subscription', '==', True)
+    return [with_subscription_state(doc.to_dict()) async for doc in query.stream()]
+
+async def get_subscribed_users() -> List[dict]:
+    """Все пользователи с флагом активной подписки"""
+    if not db:
+        return []
+    try:
+        return await load_subscribed_users()
+    except Exception as e:
+        logger.error(f"❌ Error getting subscribed users: {e}")
+        return []
+
+async def get_users_updated_since(since: datetime) -> List[dict]:
+    """Пользователи, измененные после момента since (для дельта-загрузки индексов)"""
+    if not db:
+        return []
+    users = []
+    query = db.collection('users').where('updated_at', '>', since)
+    async for user_doc in query.stream():
+        user_data = user_doc.to_dict()
+        user_data['user_id'] = user_doc.id
+        users.append(with_subscription_state(user_data))
+    return users
+
+async def paginate(collection: str, query, limit: int, cursor: str = None):
+    """Страница запроса после документа cursor, возвращает (документы, следующий курсор)"""
+    if cursor:
+        cursor_doc = await db.collection(collection).document(cursor).get()
+        if cursor_doc.exists:
+            query = query.start_after(cursor_doc)
+    docs = [doc async for doc in query.limit(limit).stream()]
+    next_cursor = docs[-1].id if len(docs) == limit else None
+    return docs, next_cursor
+
+async def get_last_users(limit: int, cursor: str = None):
+    """Последние созданные пользователи, возвращает (пользователи, следующий курсор)"""
+    if not db:
+        return [], None
+    query = db.collection('users').order_by('created_at', direction=firestore.Query.DESCENDING)
+    docs, next_cursor = await paginate('users', query, limit, cursor)
+    users = []
+    for user_doc in docs:
+        user_data = user_doc.to_dict()
+        user_data['user_id'] = user_doc.id
+        users.append(with_subscription_state(user_data))
+    return users, next_cursor
+
+async def get_users_by_ids(user_ids: List[str]) -> dict:
+    """Пакетное чтение пользователей одним get_all, результат user_id -> данные"""
+    if not db or not user_ids:
+        return {}
+    refs = [db.collection('users').document(user_id) for user_id in dict.fromkeys(user_ids)]
+    users = {}
+    async for user_doc in db.get_all(refs):
+        if user_doc.exists:
+            user_data = user_doc.to_dict()
+            user_data['user_id'] = user_doc.id
+            users[user_doc.id] = with_subscription_state(user_data)
+    return users
+
+# Лимиты Firestore: 500 операций в одном батче и 30 значений в запросе 'in'
+BATCH_WRITE_LIMIT = 500
+IN_QUERY_LIMIT = 30
+
+async def commit_batched(updates: List[tuple]) -> int:
+    """Применяет список (ref, data) батчами по BATCH_WRITE_LIMIT, возвращает число записей"""
+    written = 0
+    for start in range(0, len(updates), BATCH_WRITE_LIMIT):
+        batch = db.batch()
+        chunk = updates[start:start + BATCH_WRITE_LIMIT]
+        for ref, data in chunk:
+            batch.update(ref, data)
+        await batch.commit()
+        written += len(chunk)
+    return written
+
+async def commit_conditional(updates: List[tuple]) -> List[str]:
+    """Применяет (ref, data, update_time) только к документам, не менявшимся с чтения
+
+    Батч с предусловиями атомарен: при конфликте документы этого батча
+    пишутся по одному, а измененные после чтения пропускаются до следующего
+    прохода. Возвращает id записанных документов.
+    """
+    written = []
+    for start in range(0, len(updates), BATCH_WRITE_LIMIT):
+        chunk = updates[start:start + BATCH_WRITE_LIMIT]
+        batch = db.batch()
+        for ref, data, update_time in chunk:
+            batch.update(ref, data, option=db.write_option(last_update_time=update_time))
+        try:
+            await batch.commit()
+            written.extend(ref.id for ref, _, _ in chunk)
+            continue
+        except (google_exceptions.FailedPrecondition, google_exceptions.NotFound):
+            pass
+
+        for ref, data, update_time in chunk:
+            try:
+                await ref.update(data, option=db.write_option(last_update_time=update_time))
+                written.append(ref.id)
+            except (google_exceptions.FailedPrecondition, google_exceptions.NotFound):
+                logger.info(f"⏭️ Skipping {ref.id}: changed since it was read")
+    return written
+
+async def iter_expired_user_pages(now: datetime, page_size: int):
+    """Постранично отдает (user_id, данные, update_time) пользователей с истекшим expires_at
+
+    Курсор - последний документ страницы.
+    """
+    if not db:
+        return
+
+    cursor = None
+    while True:
+        query = db.collection('users').where('expires_at', '<=', now).order_by('expires_at').limit(page_size)
+        if cursor is not None:
+            query = query.start_after(cursor)
+
+        docs = [doc async for doc in query.stream()]
+        if not docs:
+            return
+
+        yield [(doc.id, doc.to_dict(), doc.update_time) for doc in docs]
+
+        if len(docs) < page_size:
+            return
+        cursor = docs[-1]
+
+async def revoke_subscriptions_batch(users: List[tuple]) -> List[str]:
+    """Снимает подписку и отключает VLESS ключи для группы (user_id, update_time) батчами
+
+    Пользователь, измененный после чтения (например, продливший подписку),
+    пропускается и будет перепроверен следующим проходом.
+    Возвращает id пользователей, у которых подписка снята.
+    """
+    if not db or not users:
+        return []
+
+    user_ids = await commit_conditional([
+        (db.collection('users').document(user_id), {
+            'has_subscription': False,
+            'subscription_days': 0,
+            'expires_at': None,
+            'updated_at': firestore.SERVER_TIMESTAMP
+        }, update_time)
+        for user_id, update_time in users
+    ])
+    for user_id in user_ids:
+        user_cache.invalidate(user_id)
+
+    updates = []
+    for start in range(0, len(user_ids), IN_QUERY_LIMIT):
+        chunk = user_ids[start:start + IN_QUERY_LIMIT]
+        keys_query = db.collection('vless_keys').where('user_id', 'in', chunk)
+        async for key_doc in keys_query.stream():
+            updates.append((key_doc.reference, {
+                'is_active': False,
+                'updated_at': firestore.SERVER_TIMESTAMP
+            }))
+
+    await commit_batched(updates)
+    return user_ids
+
+async def migrate_subscription_expiry() -> int:
+    """Переводит подписки старой схемы на expires_at, возвращает число обновленных документов"""
+    if not db:
+        return 0
+
+    migrated = 0
+    try:
+        batch = db.batch()
+        pending = 0
+
+        query = db.collection('users').where('has_subscription', '==', True)
+        async for doc in query.stream():
+            user_data = doc.to_dict()
+            if 'expires_at' in user_data:
+                continue
+
+            batch.update(doc.reference, {
+                'expires_at': legacy_expires_at(user_data),
+                'updated_at': firestore.SERVER_TIMESTAMP
+            })
+            user_cache.invalidate(doc.id)
+            pending += 1
+
+            if pending >= 400:
+                await batch.commit()
+                migrated += pending
+                batch = db.batch()
+                pending = 0
+
+        if pending:
+            await batch.commit()
+            migrated += pending
+
+        logger.info(f"✅ Subscription expiry migration finished: {migrated} users migrated")
+    except Exception as e:
+        logger.error(f"❌ Error migrating subscription expiry: {e}")
+
+    return migrated
+
+# Рефералы
+async def get_referrals(referrer_id: str):
+    if not db:
+        return []
+    try:
+        referrals = db.collection('referrals').where('referrer_id', '==', referrer_id).stream()
+        return [ref.to_dict() async for ref in referrals]
+    except Exception as e:
+        logger.error(f"❌ Error getting referrals: {e}")
+        return []
+
+async def referral_exists(referrer_id: str, referred_id: str) -> bool:
+    if not db:
+        return False
+    referral_id = f"{referrer_id}_{referred_id}"
+    doc = await db.collection('referrals').document(referral_id).get()
+    return doc.exists
+
+async def add_referral_bonus_immediately(referrer_id: str, referred_id: str):
+    if not db:
+        return False
+
+    try:
+        referral_id = f"{referrer_id}_{referred_id}"
+        await update_user_balance(referrer_id, 50.0, f"referral_{referral_id}_referrer", "referral_bonus")
+        await update_user_balance(referred_id, 100.0, f"referral_{referral_id}_referred", "referral_bonus")
+
+        # Документ реферала и счетчики пригласившего пишутся одним батчем;
+        # create не даст конкурентному дублю второй раз увеличить счетчики
+        batch = db.batch()
+        batch.create(db.collection('referrals').document(referral_id), {
+            'referrer_id': referrer_id,
+            'referred_id': referred_id,
+            'referrer_bonus': 50.0,
+            'referred_bonus': 100.0,
+            'bonus_paid': True,
+            'created_at': firestore.SERVER_TIMESTAMP
+        })
+        batch.update(db.collection('users').document(referrer_id), {
+            'referral_count': firestore.Increment(1),
+            'referral_bonus_total': firestore.Increment(50.0)
+        })
+        await batch.commit()
+        user_cache.invalidate(referrer_id)
+
+        logger.info(f"✅ Immediate referral bonuses applied")
+        return True
+
+    except google_exceptions.AlreadyExists:
+        logger.info(f"ℹ️ Referral {referrer_id} -> {referred_id} already recorded")
+        return False
+    except Exception as e:
+        logger.error(f"❌ Error adding immediate referral bonus: {e}")
+        return False
+
+async def delete_user_referrals(user_id: str):
+    """Удаляет рефералов пользователя и ссылку на пригласившего"""
+    referrals = db.collection('referrals').where('referrer_id', '==', user_id)
+    async for ref in referrals.stream():
+        await ref.reference.delete()
+
+    await db.collection('users').document(user_id).update({
+        'referred_by': firestore.DELETE_FIELD,
+        'referral_count': 0,
+        'referral_bonus_total': 0.0
+    })
+    user_cache.invalidate(user_id)
+
+REFERRAL_BACKFILL_MARKER = ('migrations', 'referral_counters')
+
+async def backfill_referral_counters() -> int:
+    """Разовое заполнение referral_count и referral_bonus_total по коллекции referrals"""
+    if not db:
+        return 0
+
+    try:
+        marker_ref = db.collection(REFERRAL_BACKFILL_MARKER[0]).document(REFERRAL_BACKFILL_MARKER[1])
+        if (await marker_ref.get()).exists:
+            return 0
+
+        counters = {}
+        async for ref in db.collection('referrals').stream():
+            referral = ref.to_dict()
+            count, bonus = counters.get(referral.get('referrer_id'), (0, 0.0))
+            counters[referral.get('referrer_id')] = (count + 1, bonus + referral.get('referrer_bonus', 0))
+        counters.pop(None, None)
+
+        # batch.update падает на отсутствующем документе, пишем только существующим
+        existing = await get_users_by_ids(list(counters))
+        updates = [
+            (db.collection('users').document(user_id), {
+                'referral_count': counters[user_id][0],
+                'referral_bonus_total': counters[user_id][1]
+            })
+            for user_id in existing
+        ]
+        written = await commit_batched(updates)
+        for user_id in existing:
+            user_cache.invalidate(user_id)
+
+        await marker_ref.set({'completed_at': firestore.SERVER_TIMESTAMP, 'users': written})
+        logger.info(f"✅ Referral counters backfilled for {written} users")
+        return written
+    except Exception as e:
+        logger.error(f"❌ Error backfilling referral counters: {e}")
+        return 0
+
+# VLESS ключи
+async def save_vless_key_to_db(user_id: str, server_id: str, vless_key: str, config_data: dict):
+    """Сохраняет VLESS ключ пользователя в базу данных"""
+    if not db:
+        return False
+
+    try:
+        vless_key_id = f"{user_id}_{server_id}"
+
+        vless_data = {
+            'user_id': user_id,
+            'server_id': server_id,
+            'vless_key': vless_key,
+            'config_data': config_data,
+            'created_at': firestore.SERVER_TIMESTAMP,
+            'updated_at': firestore.SERVER_TIMESTAMP,
+            'is_active': True
+        }
+
+        await db.collection('vless_keys').document(vless_key_id).set(vless_data)
+        return True
+
+    except Exception as e:
+        logger.error(f"❌ Error saving VLESS key to DB: {e}")
+        return False
+
+async def get_user_vless_keys(user_id: str):
+    """Получает все VLESS ключи пользователя из базы данных"""
+    if not db:
+        return []
+
+    try:
+        vless_keys = db.collection('vless_keys').where('user_id', '==', user_id).stream()
+        return [key_doc.to_dict() async for key_doc in vless_keys]
+
+    except Exception as e:
+        logger.error(f"❌ Error getting VLESS keys: {e}")
+        return []
+
+async def update_vless_key_status(user_id: str, server_id: str, is_active: bool):
+    """Обновляет статус VLESS ключа"""
+    if not db:
+        return False
+
+    try:
+        vless_key_id = f"{user_id}_{server_id}"
+
+        await db.collection('vless_keys').document(vless_key_id).update({
+            'is_active': is_active,
+            'updated_at': firestore.SERVER_TIMESTAMP
+        })
+
+        return True
+
+    except Exception as e:
+        logger.error(f"❌ Error updating VLESS key status: {e}")
+        return False
+
+async def set_user_vless_keys_status(user_id: str, is_active: bool) -> int:
+    """Меняет статус всех VLESS ключей пользователя, возвращает их количество"""
+    user_vless_keys = await get_user_vless_keys(user_id)
+    for key_data in user_vless_keys:
+        await update_vless_key_status(user_id, key_data['server_id'], is_active)
+    return len(user_vless_keys)
+
+async def get_recent_vless_keys(limit: int, cursor: str = None):
+    """Последние созданные VLESS ключи, возвращает (ключи, следующий курсор)"""
+    if not db:
+        return [], None
+    query = db.collection('vless_keys').order_by('created_at', direction=firestore.Query.DESCENDING)
+    docs, next_cursor = await paginate('vless_keys', query, limit, cursor)
+    return [key_doc.to_dict() for key_doc in docs], next_cursor
+
+async def get_vless_keys_for_users(user_ids: List[str]) -> dict:
+    """VLESS ключи группы пользователей запросами 'in', результат user_id -> список"""
+    if not db:
+        return {}
+    user_ids = list(dict.fromkeys(user_ids))
+    keys = {user_id: [] for user_id in user_ids}
+    for start in range(0, len(user_ids), IN_QUERY_LIMIT):
+        chunk = user_ids[start:start + IN_QUERY_LIMIT]
+        async for key_doc in db.collection('vless_keys').where('user_id', 'in', chunk).stream():
+            key_data = key_doc.to_dict()
+            keys.setdefault(key_data.get('user_id'), []).append(key_data)
+    return keys
+
+# Платежи
+async def save_payment(payment_id: str, user_id: str, amount: float, tariff: str, payment_type: str = "tariff", payment_method: str = "yookassa", selected_server: str = None):
+    if not db:
+        return
+    try:
+        payment_data = {
+            'payment_id': payment_id,
+            'user_id': user_id,
+            'amount': amount,
+            'tariff': tariff,
+            'status': 'pending',
+            'payment_type': payment_type,
+            'payment_method': payment_method,
+            'created_at': firestore.SERVER_TIMESTAMP,
+            'yookassa_id': None
+        }
+
+        if selected_server:
+            payment_data['selected_server'] = selected_server
+
+        await db.collection('payments').document(payment_id).set(payment_data)
+    except Exception as e:
+        logger.error(f"❌ Error saving payment: {e}")
+
+async def update_payment_status(payment_id: str, status: str, yookassa_id: str = None):
+    if not db:
+        return
+    try:
+        update_data = {
+            'status': status,
+            'yookassa_id': yookassa_id
+        }
+        if status == 'succeeded':
+            update_data['confirmed_at'] = firestore.SERVER_TIMESTAMP
+
+        await db.collection('payments').document(payment_id).update(update_data)
+    except Exception as e:
+        logger.error(f"❌ Error updating payment status: {e}")
+
+# Статусы, после которых платеж больше не меняется
+PAYMENT_FINAL_STATUSES = ('succeeded', 'canceled')
+
+@firestore.async_transactional
+async def _claim_payment(transaction, payment_ref, status: str, yookassa_id: str, extra: dict):
+    payment = await payment_ref.get(transaction=transaction)
+    if not payment.exists or payment.to_dict().get('status') in PAYMENT_FINAL_STATUSES:
+        return False
+
+    update_data = {'status': status, 'yookassa_id': yookassa_id, **extra}
+    if status == 'succeeded':
+        update_data['confirmed_at'] = firestore.SERVER_TIMESTAMP
+    transaction.update(payment_ref, update_data)
+    return True
+
+async def claim_payment(payment_id: str, status: str, yookassa_id: str = None, extra: dict = None) -> bool:
+    """Переводит еще не завершенный платеж в статус status
+
+    Для финального статуса True получает только один из конкурентных
+    вызовов (webhook, опрос статуса, сверка), и только он выполняет
+    активацию. Завершенный платеж не перезаписывается никогда.
+    """
+    if not db:
+        return False
+    payment_ref = db.collection('payments').document(payment_id)
+    return await _claim_payment(db.transaction(), payment_ref, status, yookassa_id, extra or {})
+
+def payment_application_claim() -> dict:
+    """Поля claim для оплаченного тарифа: активация еще не применена, аренда у вызвавшего"""
+    return {'applied': False, 'applying_at': firestore.SERVER_TIMESTAMP}
+
+async def mark_payment_applied(payment_id: str) -> bool:
+    """Отметка, что активация по оплаченному платежу выполнена"""
+    try:
+        await db.collection('payments').document(payment_id).update({
+            'applied': True,
+            'applied_at': firestore.SERVER_TIMESTAMP,
+            'applying_at': firestore.DELETE_FIELD
+        })
+        return True
+    except Exception as e:
+        logger.error(f"❌ Error marking payment {payment_id} applied: {e}")
+        return False
+
+@firestore.async_transactional
+async def _lease_payment_application(transaction, payment_ref, stale_before: datetime):
+    payment = await payment_ref.get(transaction=transaction)
+    if not payment.exists:
+        return False
+    data = payment.to_dict()
+    if data.get('status') != 'succeeded' or data.get('applied') is not False:
+        return False
+    applying_at = data.get('applying_at')
+    if applying_at and to_utc(applying_at) > stale_before:
+        return False
+
+    transaction.update(payment_ref, {'applying_at': firestore.SERVER_TIMESTAMP})
+    return True
+
+async def lease_payment_application(payment_id: str, stale_before: datetime) -> bool:
+    """Забирает повторную активацию платежа, если прошлая попытка не отметилась до stale_before"""
+    payment_ref = db.collection('payments').document(payment_id)
+    return await _lease_payment_application(db.transaction(), payment_ref, stale_before)
+
+async def get_unapplied_payments(limit: int) -> List[tuple]:
+    """Оплаченные платежи без отметки applied: (payment_id, данные)"""
+    if not db:
+        return []
+    query = db.collection('payments').where('applied', '==', False).limit(limit)
+    return [(doc.id, doc.to_dict()) async for doc in query.stream()]
+
+# Статусы YooKassa, при которых платеж еще может завершиться
+PAYMENT_OPEN_STATUSES = ['pending', 'waiting_for_capture']
+
+async def iter_open_payment_pages(created_from: datetime, created_to: datetime, page_size: int):
+    """Постранично отдает (payment_id, данные, update_time) незавершенных платежей,
+    созданных в окне [created_from, created_to]
+
+    Требует составного индекса payments(status, created_at).
+    """
+    if not db:
+        return
+
+    cursor = None
+    while True:
+        query = (db.collection('payments')
+                 .where('status', 'in', PAYMENT_OPEN_STATUSES)
+                 .where('created_at', '>=', created_from)
+                 .where('created_at', '<=', created_to)
+                 .order_by('created_at')
+                 .limit(page_size))
+        if cursor is not None:
+            query = query.start_after(cursor)
+
+        docs = [doc async for doc in query.stream()]
+        if not docs:
+            return
+
+        yield [(doc.id, doc.to_dict(), doc.update_time) for doc in docs]
+
+        if len(docs) < page_size:
+            return
+        cursor = docs[-1]
+
+async def set_payment_statuses(statuses: List[tuple]) -> List[str]:
+    """Батчевая запись статусов (payment_id, status, update_time) без побочных эффектов
+
+    Пишется только в платежи, не менявшиеся с чтения: статус, который
+    тем временем выставил claim_payment, не перезаписывается.
+    Возвращает id обновленных платежей.
+    """
+    if not db or not statuses:
+        return []
+    return await commit_conditional([
+        (db.collection('payments').document(payment_id), {'status': status}, update_time)
+        for payment_id, status, update_time in statuses
+    ])
+
+async def get_payment(payment_id: str):
+    if not db:
+        return None
+    try:
+        doc = await db.collection('payments').document(payment_id).get()
+        return doc.to_dict() if doc.exists else None
+    except Exception as e:
+        logger.error(f"❌ Error getting payment: {e}")
+        return None
@@ -0,0 +1,113 @@
+import asyncio
+import heapq
+import logging
+from datetime import datetime, timezone
+
+logger = logging.getLogger(__name__)
+
+
+class ExpiryIndex:
+    """Мин-куча сроков окончания подписок: отзыв через секунды после истечения"""
+
+    # Верхняя граница сна, чтобы перепроверять кучу даже без событий
+    MAX_SLEEP = 300.0
+
+    def __init__(self, on_expire):
+        self.on_expire = on_expire
+        self._heap = []
+        # Актуальный срок по пользователю. Записи кучи, не совпадающие
+        # с ним, считаются устаревшими и пропускаются при извлечении
+        self._expiry = {}
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self.fired = 0
+
+    def __len__(self):
+        return len(self._expiry)
+
+    def schedule(self, user_id: str, expires_at: datetime):
+        """Добавляет или переносит срок пользователя, O(log n)"""
+        if expires_at is None:
+            self.cancel(user_id)
+            return
+
+        self._expiry[user_id] = expires_at
+        heapq.heappush(self._heap, (expires_at, user_id))
+
+        # Переносы оставляют в куче устаревшие записи, периодически сжимаем
+        if len(self._heap) > 2 * len(self._expiry) + 1024:
+            self._heap = [(when, uid) for uid, when in self._expiry.items()]
+            heapq.heapify(self._heap)
+
+        if self._heap[0][1] == user_id:
+            self._wakeup.set()
+
+    def cancel(self, user_id: str):
+        self._expiry.pop(user_id, None)
+
+    def load(self, users: list):
+        """Начальная загрузка из списка (user_id, expires_at)"""
+        for user_id, expires_at in users:
+            if expires_at is not None:
+                self._expiry[user_id] = expires_at
+                self._heap.append((expires_at, user_id))
+        heapq.heapify(self._heap)
+        self._wakeup.set()
+        logger.info(f"✅ Expiry index loaded: {len(self._expiry)} subscriptions")
+
+    def _pop_due(self, now: datetime) -> list:
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            expires_at, user_id = heapq.heappop(self._heap)
+            if self._expiry.get(user_id) != expires_at:
+                continue
+            del self._expiry[user_id]
+            due.append(user_id)
+        return due
+
+    def _next_delay(self, now: datetime) -> float:
+        # Выбрасываем устаревшие записи с вершины, чтобы не спать на них
+        while self._heap and self._expiry.get(self._heap[0][1]) != self._heap[0][0]:
+            heapq.heappop(self._heap)
+        if not self._heap:
+            return self.MAX_SLEEP
+        return min(max((self._heap[0][0] - now).total_seconds(), 0.0), self.MAX_SLEEP)
+
+    async def run(self):
+        while True:
+            now = datetime.now(timezone.utc)
+            for user_id in self._pop_due(now):
+                try:
+                    await self.on_expire(user_id)
+                    self.fired += 1
+                except Exception as e:
+                    logger.error(f"❌ Error revoking expired subscription {user_id}: {e}")
+
+            self._wakeup.clear()
+            try:
+                delay = self._next_delay(datetime.now(timezone.utc))
+                await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def stats(self) -> dict:
+        next_expiry = self._heap[0][0].isoformat() if self._heap else None
+        return {
+            "tracked": len(self._expiry),
+            "heap_size": len(self._heap),
+            "fired": self.fired,
+            "next_expiry": next_expiry
+        }
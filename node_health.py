@@ -0,0 +1,151 @@
+import os
+import time
+import asyncio
+import logging
+from collections import deque
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+NODE_PROBE_INTERVAL = float(os.getenv("NODE_PROBE_INTERVAL", "15"))
+NODE_PROBE_TIMEOUT = float(os.getenv("NODE_PROBE_TIMEOUT", "3"))
+# Скользящие окна: задержки для перцентилей и результаты для доли успехов
+NODE_RTT_WINDOW = 100
+NODE_RESULT_WINDOW = 20
+# Нода считается здоровой, если последний опрос успешен и успехов в окне не меньше порога
+NODE_HEALTHY_RATIO = 0.8
+
+
+def percentile(samples: list, q: float) -> float:
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    index = min(int(round(q * (len(ordered) - 1))), len(ordered) - 1)
+    return ordered[index]
+
+
+class NodeHealth:
+    """Скользящее состояние одной ноды"""
+
+    def __init__(self):
+        self.rtts = deque(maxlen=NODE_RTT_WINDOW)
+        self.results = deque(maxlen=NODE_RESULT_WINDOW)
+        self.users = None
+        self.last_ok = False
+        self.last_error = None
+        self.last_checked = None
+
+    def record(self, rtt: float, users: int = None, error: str = None):
+        ok = error is None
+        self.results.append(ok)
+        self.last_ok = ok
+        self.last_error = error
+        self.last_checked = datetime.now().isoformat()
+        if ok:
+            self.rtts.append(rtt)
+            if users is not None:
+                self.users = users
+
+    @property
+    def success_ratio(self) -> float:
+        return sum(self.results) / len(self.results) if self.results else 0.0
+
+    @property
+    def healthy(self) -> bool:
+        return self.last_ok and self.success_ratio >= NODE_HEALTHY_RATIO
+
+    def as_dict(self) -> dict:
+        samples = list(self.rtts)
+        return {
+            "healthy": self.healthy,
+            "success_ratio": round(self.success_ratio, 2),
+            "users": self.users,
+            "rtt_p50_ms": round(percentile(samples, 0.5) * 1000, 1),
+            "rtt_p95_ms": round(percentile(samples, 0.95) * 1000, 1),
+            "rtt_p99_ms": round(percentile(samples, 0.99) * 1000, 1),
+            "last_error": self.last_error,
+            "last_checked": self.last_checked
+        }
+
+
+class NodeHealthProber:
+    """Фоновый опрос /health всех нод; запросы читают только кэш"""
+
+    def __init__(self, registry, interval: float = NODE_PROBE_INTERVAL):
+        self.registry = registry
+        self.interval = interval
+        self._health = {server_id: NodeHealth() for server_id in registry.servers}
+        self._task = None
+
+    async def _probe(self, server_id: str):
+        started = time.monotonic()
+        response = await self.registry.get(server_id, "/health", timeout=NODE_PROBE_TIMEOUT)
+        rtt = time.monotonic() - started
+        if response.status_code != 200:
+            raise Exception(f"HTTP {response.status_code}")
+        return rtt, response.json().get("users")
+
+    async def probe_all(self):
+        results = await self.registry.fan_out(
+            list(self._health.keys()), self._probe, deadline=NODE_PROBE_TIMEOUT
+        )
+        for server_id, result in results.items():
+            if isinstance(result, Exception):
+                self._health[server_id].record(0.0, error=str(result) or repr(result))
+            else:
+                rtt, users = result
+                self._health[server_id].record(rtt, users)
+
+    async def run(self):
+        while True:
+            try:
+                await self.probe_all()
+            except Exception as e:
+                logger.error(f"❌ Error probing Xray nodes: {e}")
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self.run())
+            logger.info(f"✅ Node health prober started: {len(self._health)} nodes every {self.interval}s")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def is_healthy(self, server_id: str) -> bool:
+        health = self._health.get(server_id)
+        return health is not None and health.healthy
+
+    def users_count(self, server_id: str = None) -> int:
+        """Последнее известное число пользователей на ноде или на всех нодах"""
+        if server_id is not None:
+            health = self._health.get(server_id)
+            return (health.users or 0) if health else 0
+        return sum(health.users or 0 for health in self._health.values())
+
+    def pick_server(self, candidates: list = None) -> str:
+        """Здоровая нода с наименьшей нагрузкой, при равенстве - с меньшей задержкой
+
+        Если здоровых нод нет, берется нода с лучшей долей успешных опросов.
+        """
+        candidates = [server_id for server_id in (candidates or self._health) if server_id in self._health]
+        if not candidates:
+            return None
+
+        def load_key(server_id):
+            health = self._health[server_id]
+            return (health.users or 0, percentile(list(health.rtts), 0.5))
+
+        healthy = [server_id for server_id in candidates if self._health[server_id].healthy]
+        if healthy:
+            return min(healthy, key=load_key)
+        return max(candidates, key=lambda server_id: self._health[server_id].success_ratio)
+
+    def snapshot(self) -> dict:
+        return {server_id: health.as_dict() for server_id, health in self._health.items()}
@@ -0,0 +1,46 @@
+import asyncio
+import logging
+from collections import defaultdict
+
+logger = logging.getLogger(__name__)
+
+
+class PaymentEvents:
+    """Pub/sub статусов платежей внутри процесса
+
+    Ожидающий клиент держит future на payment_id; публикация завершает все
+    future этого платежа сразу, без опроса базы или шлюза.
+    """
+
+    def __init__(self):
+        self._waiters = defaultdict(set)
+        self.published = 0
+        self.delivered = 0
+
+    def subscribe(self, payment_id: str) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        self._waiters[payment_id].add(future)
+        return future
+
+    def unsubscribe(self, payment_id: str, future: asyncio.Future):
+        waiters = self._waiters.get(payment_id)
+        if waiters is None:
+            return
+        waiters.discard(future)
+        if not waiters:
+            del self._waiters[payment_id]
+
+    def publish(self, payment_id: str, event: dict):
+        self.published += 1
+        for future in self._waiters.pop(payment_id, ()):
+            if not future.done():
+                future.set_result(event)
+                self.delivered += 1
+
+    def stats(self) -> dict:
+        return {
+            "payments": len(self._waiters),
+            "waiters": sum(len(waiters) for waiters in self._waiters.values()),
+            "published": self.published,
+            "delivered": self.delivered
+        }
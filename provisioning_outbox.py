@@ -0,0 +1,212 @@
+import os
+import time
+import asyncio
+import logging
+import sqlite3
+from collections import defaultdict
+from typing import List
+
+logger = logging.getLogger(__name__)
+
+OUTBOX_PATH = os.getenv("OUTBOX_PATH", "provisioning_outbox.db")
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", "500"))
+OUTBOX_POLL_INTERVAL = 5.0
+OUTBOX_RETRY_BASE = 2.0
+OUTBOX_RETRY_MAX = 300.0
+OUTBOX_MAX_ATTEMPTS = 20
+# Сколько помнить недавние намерения в памяти (для сверки нод)
+OUTBOX_RECENT_WINDOW = 3600.0
+
+ACTION_ADD = "add"
+ACTION_REMOVE = "remove"
+
+
+class ProvisioningOutbox:
+    """Персистентная очередь добавлений/удалений пользователей на нодах Xray
+
+    Запрос только записывает намерение в локальный SQLite, доставку
+    выполняет фоновый воркер. На пару (нода, UUID) хранится одно
+    намерение: новое заменяет ожидающее, поэтому дубликаты схлопываются,
+    а add с последующим remove превращается в один remove.
+    """
+
+    def __init__(self, deliver, path: str = OUTBOX_PATH):
+        # deliver(server_id, action, uuids) -> список доставленных UUID
+        self.deliver = deliver
+        self.path = path
+        self._conn = None
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self.delivered = 0
+        self.failed = 0
+        self.dropped = 0
+        # (нода, UUID) -> (действие, время записи): намерения, уже доставленные
+        # и удаленные из таблицы, но еще не видимые в снимке Firestore
+        self._recent = {}
+
+    def open(self):
+        if self._conn is not None:
+            return
+        self._conn = sqlite3.connect(self.path, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS outbox (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                server_id TEXT NOT NULL,
+                user_uuid TEXT NOT NULL,
+                action TEXT NOT NULL,
+                version INTEGER NOT NULL DEFAULT 0,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt_at REAL NOT NULL,
+                last_error TEXT,
+                UNIQUE (server_id, user_uuid)
+            )
+        """)
+
+    def enqueue(self, action: str, user_uuids: List[str], server_ids: List[str]):
+        """Записывает намерения для всех пар (нода, UUID) одной транзакцией"""
+        self.open()
+        now = time.time()
+        rows = [(server_id, user_uuid, action, now) for server_id in server_ids for user_uuid in user_uuids]
+        with self._conn:
+            self._conn.execute("BEGIN")
+            self._conn.executemany("""
+                INSERT INTO outbox (server_id, user_uuid, action, next_attempt_at)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT (server_id, user_uuid) DO UPDATE SET
+                    action = excluded.action,
+                    version = version + 1,
+                    attempts = 0,
+                    next_attempt_at = excluded.next_attempt_at,
+                    last_error = NULL
+            """, rows)
+
+        if len(self._recent) > 100000:
+            self._recent = {key: value for key, value in self._recent.items() if now - value[1] < OUTBOX_RECENT_WINDOW}
+        for server_id, user_uuid, _, _ in rows:
+            self._recent[(server_id, user_uuid)] = (action, now)
+        self._wakeup.set()
+
+    def enqueue_add(self, user_uuid: str, server_ids: List[str]):
+        self.enqueue(ACTION_ADD, [user_uuid], server_ids)
+
+    def enqueue_remove(self, user_uuids: List[str], server_ids: List[str]):
+        self.enqueue(ACTION_REMOVE, user_uuids, server_ids)
+
+    def _due(self, now: float) -> list:
+        return self._conn.execute("""
+            SELECT id, server_id, user_uuid, action, version, attempts
+            FROM outbox WHERE next_attempt_at <= ?
+            ORDER BY next_attempt_at LIMIT ?
+        """, (now, OUTBOX_BATCH_SIZE)).fetchall()
+
+    def _next_delay(self, now: float) -> float:
+        row = self._conn.execute("SELECT MIN(next_attempt_at) FROM outbox").fetchone()
+        if row[0] is None:
+            return OUTBOX_POLL_INTERVAL
+        return min(max(row[0] - now, 0.0), OUTBOX_POLL_INTERVAL)
+
+    async def drain_once(self) -> int:
+        """Доставляет готовые намерения, сгруппированные по ноде и действию"""
+        self.open()
+        rows = self._due(time.time())
+        if not rows:
+            return 0
+
+        groups = defaultdict(list)
+        for row in rows:
+            groups[(row[1], row[3])].append(row)
+
+        # Группы разных нод доставляются параллельно, медленная нода не держит остальные
+        outcomes = await asyncio.gather(*(
+            self.deliver(server_id, action, [row[2] for row in group])
+            for (server_id, action), group in groups.items()
+        ), return_exceptions=True)
+
+        for ((server_id, action), group), outcome in zip(groups.items(), outcomes):
+            error = None
+            if isinstance(outcome, Exception):
+                delivered = set()
+                error = str(outcome) or repr(outcome)
+            else:
+                delivered = set(outcome)
+
+            with self._conn:
+                self._conn.execute("BEGIN")
+                for row_id, _, user_uuid, _, version, attempts in group:
+                    if user_uuid in delivered:
+                        # Версия защищает намерение, записанное во время доставки
+                        self._conn.execute("DELETE FROM outbox WHERE id = ? AND version = ?", (row_id, version))
+                        self.delivered += 1
+                    elif attempts + 1 >= OUTBOX_MAX_ATTEMPTS:
+                        self._conn.execute("DELETE FROM outbox WHERE id = ? AND version = ?", (row_id, version))
+                        self.dropped += 1
+                        logger.error(f"❌ Outbox gave up on {action} {user_uuid} for {server_id}: {error}")
+                    else:
+                        delay = min(OUTBOX_RETRY_BASE * 2 ** attempts, OUTBOX_RETRY_MAX)
+                        self._conn.execute("""
+                            UPDATE outbox SET attempts = attempts + 1, next_attempt_at = ?, last_error = ?
+                            WHERE id = ? AND version = ?
+                        """, (time.time() + delay, error or "not delivered", row_id, version))
+                        self.failed += 1
+
+        return len(rows)
+
+    async def run(self):
+        while True:
+            try:
+                await self.drain_once()
+                delay = self._next_delay(time.time())
+            except Exception as e:
+                logger.error(f"❌ Error draining provisioning outbox: {e}")
+                delay = OUTBOX_POLL_INTERVAL
+
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
+
+    def start(self):
+        self.open()
+        if self._task is None:
+            self._task = asyncio.create_task(self.run())
+            logger.info(f"✅ Provisioning outbox started: {self.pending()} pending intents")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def intent_uuids(self, server_id: str, action: str, since: float) -> set:
+        """UUID с ожидающим намерением action на ноде или записанным после since"""
+        self.open()
+        rows = self._conn.execute(
+            "SELECT user_uuid FROM outbox WHERE server_id = ? AND action = ?", (server_id, action)
+        ).fetchall()
+        uuids = {row[0] for row in rows}
+        uuids.update(
+            user_uuid for (node, user_uuid), (intent, at) in self._recent.items()
+            if node == server_id and intent == action and at >= since
+        )
+        return uuids
+
+    def pending(self) -> int:
+        self.open()
+        return self._conn.execute("SELECT COUNT(*) FROM outbox").fetchone()[0]
+
+    def stats(self) -> dict:
+        return {
+            "pending": self.pending(),
+            "delivered": self.delivered,
+            "retried": self.failed,
+            "dropped": self.dropped
+        }
@@ -0,0 +1,73 @@
+"""Пропускная способность /user-data: блокирующий доступ к Firestore против асинхронного
+
+Каждое чтение документа в подделке занимает FIRESTORE_DELAY секунд.
+"blocking" моделирует прежний синхронный клиент внутри async-обработчика
+(time.sleep останавливает event loop), "async" - текущий слой database.py.
+
+    python tests/bench_user_data.py [N ...]
+"""
+import os
+import sys
+import time
+import asyncio
+import logging
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import conftest  # noqa: F401  поддельный firebase_admin и окружение
+
+import httpx
+
+import fake_firestore
+import app
+import database
+
+FIRESTORE_DELAY = float(os.getenv("FIRESTORE_DELAY", "0.02"))
+
+_store_get = fake_firestore.DocumentReference.get
+
+
+async def blocking_get(self, transaction=None):
+    time.sleep(FIRESTORE_DELAY)
+    return self.store.snapshot(self)
+
+
+async def async_get(self, transaction=None):
+    await asyncio.sleep(FIRESTORE_DELAY)
+    return self.store.snapshot(self)
+
+
+async def measure(mode: str, concurrency: int) -> tuple:
+    database.db.store = fake_firestore.Store()
+    for i in range(concurrency):
+        await database.db.collection('users').document(f"u{i}").set({
+            'user_id': f"u{i}", 'balance': 0.0, 'has_subscription': False
+        })
+    # Без кэша: измеряется именно обращение к Firestore
+    database.user_cache = database.UserCache(database.USER_CACHE_SIZE, 0)
+    fake_firestore.DocumentReference.get = blocking_get if mode == "blocking" else async_get
+
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app.app), base_url="http://bench") as client:
+        started = time.perf_counter()
+        responses = await asyncio.gather(*(
+            client.get("/user-data", params={"user_id": f"u{i}"}) for i in range(concurrency)
+        ))
+        elapsed = time.perf_counter() - started
+
+    fake_firestore.DocumentReference.get = _store_get
+    assert all(response.status_code == 200 for response in responses)
+    return elapsed, concurrency / elapsed
+
+
+def main():
+    logging.disable(logging.CRITICAL)
+    levels = [int(arg) for arg in sys.argv[1:]] or [1, 10, 50, 200]
+    print(f"Firestore read delay: {FIRESTORE_DELAY * 1000:.0f} ms")
+    print(f"{'N':>6} {'blocking req/s':>16} {'async req/s':>14} {'speedup':>9}")
+    for concurrency in levels:
+        _, blocking_rps = asyncio.run(measure("blocking", concurrency))
+        _, async_rps = asyncio.run(measure("async", concurrency))
+        print(f"{concurrency:>6} {blocking_rps:>16.1f} {async_rps:>14.1f} {async_rps / blocking_rps:>8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+"""Добавление 10k пользователей на локальную ноду: xray_batch против поштучных POST /user
+
+Нода - xray_node_api.py в отдельном процессе с настоящим XrayManager:
+конфиг во временном каталоге, XRAY_BIN - заглушка, которая принимает
+`xray api adu/rmu` и сразу завершается (запуск процесса остается в цене).
+Приложение ходит к ней через общий пул xray_clients, как к боевой ноде.
+
+    python tests/bench_xray_batch.py [USERS] [SINGLE_USERS]
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import socket
+import asyncio
+import logging
+import tempfile
+import subprocess
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(TESTS_DIR)
+NODE_PORT = int(os.getenv("BENCH_NODE_PORT", "18001"))
+
+
+def run_node(workdir: str, commit_window: float):
+    """Процесс ноды: XrayManager на временном конфиге и заглушке xray"""
+    sys.path.insert(0, ROOT)
+    import uvicorn
+    import xray_node_api
+    from xray_manager import XrayManager, XrayApiClient
+
+    xray_node_api.manager = XrayManager(
+        api_client=XrayApiClient(xray_bin=os.path.join(workdir, "xray-stub")),
+        config_path=os.path.join(workdir, "config.json"),
+        commit_window=commit_window
+    )
+    uvicorn.run(xray_node_api.app, host="127.0.0.1", port=NODE_PORT, log_level="error")
+
+
+def prepare(workdir: str):
+    stub = os.path.join(workdir, "xray-stub")
+    with open(stub, "w") as f:
+        f.write("#!/bin/sh\nexit 0\n")
+    os.chmod(stub, 0o755)
+    with open(os.path.join(workdir, "config.json"), "w") as f:
+        json.dump({"inbounds": [{"tag": "inbound-1", "protocol": "vless", "settings": {"clients": []}}]}, f)
+
+
+def start_node(workdir: str, commit_window: float) -> subprocess.Popen:
+    prepare(workdir)
+    node = subprocess.Popen([sys.executable, __file__, "--node", workdir, str(commit_window)])
+    for _ in range(100):
+        try:
+            socket.create_connection(("127.0.0.1", NODE_PORT), timeout=0.1).close()
+            return node
+        except OSError:
+            time.sleep(0.1)
+    node.kill()
+    raise RuntimeError("Node did not start")
+
+
+async def measure(mode: str, users: int) -> float:
+    import app
+    from xray_nodes import XRAY_MAX_CONNECTIONS
+
+    app.xray_clients.servers["moscow"]["url"] = f"http://127.0.0.1:{NODE_PORT}"
+    await app.xray_clients.close()
+    uuids = [str(uuid.uuid4()) for _ in range(users)]
+
+    started = time.perf_counter()
+    if mode == "batch":
+        results = await app.xray_batch("moscow", add=uuids)
+    elif mode == "single":
+        results = await app.xray_single_requests("moscow", uuids, [])
+    else:
+        # Поштучные запросы, но параллельно на весь пул соединений
+        chunks = [uuids[i::XRAY_MAX_CONNECTIONS] for i in range(XRAY_MAX_CONNECTIONS)]
+        results = {}
+        for part in await asyncio.gather(*(app.xray_single_requests("moscow", chunk, []) for chunk in chunks)):
+            results.update(part)
+    elapsed = time.perf_counter() - started
+
+    await app.xray_clients.close()
+    assert len(results) == users and all(results.values()), f"{mode}: failed adds"
+    return elapsed
+
+
+def bench(mode: str, users: int, commit_window: float) -> float:
+    with tempfile.TemporaryDirectory() as workdir:
+        node = start_node(workdir, commit_window)
+        try:
+            return asyncio.run(measure(mode, users))
+        finally:
+            node.terminate()
+            node.wait()
+
+
+def main():
+    sys.path.insert(0, TESTS_DIR)
+    import conftest  # noqa: F401  поддельный firebase_admin для импорта app
+    logging.disable(logging.CRITICAL)
+
+    users = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    single_users = int(sys.argv[2]) if len(sys.argv) > 2 else users
+    from xray_manager import XRAY_COMMIT_WINDOW
+
+    print(f"{'mode':<34} {'users':>6} {'seconds':>9} {'users/s':>9}")
+    runs = [
+        ("batch", users, XRAY_COMMIT_WINDOW, "xray_batch (1000 per request)"),
+        ("parallel", single_users, XRAY_COMMIT_WINDOW, "POST /user x pool, coalesced"),
+        ("single", single_users, 0.0, "POST /user sequential, no window"),
+    ]
+    for mode, count, window, title in runs:
+        elapsed = bench(mode, count, window)
+        print(f"{title:<34} {count:>6} {elapsed:>9.2f} {count / elapsed:>9.0f}")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "--node":
+        run_node(sys.argv[2], float(sys.argv[3]))
+    else:
+        main()
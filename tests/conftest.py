@@ -0,0 +1,16 @@
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import fake_firestore
+
+# До импорта database/app: поддельный Firestore и конфиг, при котором init_firebase проходит
+fake_firestore.install()
+os.environ.setdefault("FIREBASE_PROJECT_ID", "test")
+os.environ.setdefault("FIREBASE_PRIVATE_KEY", "test")
+os.environ.setdefault("FIREBASE_CLIENT_EMAIL", "test@test")
+os.environ.setdefault("OUTBOX_PATH", os.path.join(tempfile.mkdtemp(), "outbox.db"))
@@ -0,0 +1,336 @@
+"""In-memory подделка асинхронного Firestore для тестов database.py
+
+Повторяет ровно то, чем пользуется модуль: документы и запросы,
+батчи с предусловиями, транзакции с перезапуском, Increment /
+SERVER_TIMESTAMP / DELETE_FIELD и update_time документов.
+
+Транзакции, как у серверных клиентов Firestore, блокируют прочитанные
+документы до конца попытки: конкурентные транзакции ждут друг друга.
+Запись вне транзакции блокировку не ждет, и такая транзакция при
+коммите прерывается (Aborted) и перезапускается.
+install() подменяет firebase_admin в sys.modules до импорта database.
+"""
+import sys
+import types
+import random
+import asyncio
+import operator
+import itertools
+from datetime import datetime, timezone
+
+from google.api_core import exceptions as google_exceptions
+
+SERVER_TIMESTAMP = object()
+DELETE_FIELD = object()
+
+
+class Increment:
+    def __init__(self, value):
+        self.value = value
+
+
+class Query:
+    ASCENDING = "ASCENDING"
+    DESCENDING = "DESCENDING"
+
+
+class WriteOption:
+    def __init__(self, last_update_time):
+        self.last_update_time = last_update_time
+
+
+class Snapshot:
+    def __init__(self, reference, data, update_time):
+        self.reference = reference
+        self.id = reference.id
+        self._data = data
+        self.exists = data is not None
+        self.update_time = update_time
+
+    def to_dict(self):
+        return dict(self._data) if self._data is not None else None
+
+
+class Store:
+    def __init__(self):
+        self.docs = {}
+        self.times = {}
+        self._clock = itertools.count(1)
+        self.aborts = 0
+        self.lock_waits = 0
+        self._locks = {}
+
+    def lock(self, path) -> asyncio.Lock:
+        if path not in self._locks:
+            self._locks[path] = asyncio.Lock()
+        return self._locks[path]
+
+    def snapshot(self, ref):
+        return Snapshot(ref, self.docs.get(ref.path), self.times.get(ref.path))
+
+    def check(self, ref, kind, option=None):
+        exists = ref.path in self.docs
+        if kind == "create" and exists:
+            raise google_exceptions.AlreadyExists(f"Document already exists: {ref.path}")
+        if kind == "update" and not exists:
+            raise google_exceptions.NotFound(f"No document to update: {ref.path}")
+        if option is not None and self.times.get(ref.path) != option.last_update_time:
+            raise google_exceptions.FailedPrecondition(f"Document changed: {ref.path}")
+
+    def write(self, ref, kind, data):
+        if kind == "delete":
+            self.docs.pop(ref.path, None)
+            self.times.pop(ref.path, None)
+            return
+        current = dict(self.docs.get(ref.path) or {}) if kind == "update" else {}
+        for field, value in data.items():
+            if value is DELETE_FIELD:
+                current.pop(field, None)
+            elif value is SERVER_TIMESTAMP:
+                current[field] = datetime.now(timezone.utc)
+            elif isinstance(value, Increment):
+                current[field] = current.get(field, 0) + value.value
+            else:
+                current[field] = value
+        self.docs[ref.path] = current
+        self.times[ref.path] = next(self._clock)
+
+    def apply(self, writes):
+        """Атомарно: сначала все предусловия, потом все записи"""
+        for ref, kind, data, option in writes:
+            self.check(ref, kind, option)
+        for ref, kind, data, option in writes:
+            self.write(ref, kind, data)
+
+
+async def _yield():
+    # Точка переключения между задачами, чтобы гонки действительно случались
+    await asyncio.sleep(random.random() * 0.001)
+
+
+class DocumentReference:
+    def __init__(self, store, collection, doc_id):
+        self.store = store
+        self.collection_name = collection
+        self.id = doc_id
+        self.path = (collection, doc_id)
+
+    async def get(self, transaction=None):
+        if transaction is not None:
+            await transaction._lock(self.path)
+        await _yield()
+        snapshot = self.store.snapshot(self)
+        if transaction is not None:
+            transaction._reads[self.path] = snapshot.update_time
+        return snapshot
+
+    async def set(self, data, merge=False):
+        await _yield()
+        self.store.apply([(self, "update" if merge and self.path in self.store.docs else "set", data, None)])
+
+    async def create(self, data):
+        await _yield()
+        self.store.apply([(self, "create", data, None)])
+
+    async def update(self, data, option=None):
+        await _yield()
+        self.store.apply([(self, "update", data, option)])
+
+    async def delete(self):
+        await _yield()
+        self.store.apply([(self, "delete", None, None)])
+
+
+_OPERATORS = {
+    '==': operator.eq,
+    '!=': operator.ne,
+    '<': operator.lt,
+    '<=': operator.le,
+    '>': operator.gt,
+    '>=': operator.ge,
+    'in': lambda value, values: value in values,
+}
+
+
+class CollectionQuery:
+    def __init__(self, store, collection, filters=(), order=None, descending=False, limit=None, after=None):
+        self.store = store
+        self.collection = collection
+        self.filters = list(filters)
+        self.order = order
+        self.descending = descending
+        self._limit = limit
+        self.after = after
+
+    def _copy(self, **changes):
+        params = dict(filters=self.filters, order=self.order, descending=self.descending,
+                      limit=self._limit, after=self.after)
+        params.update(changes)
+        return CollectionQuery(self.store, self.collection, **params)
+
+    def where(self, field, op, value):
+        return self._copy(filters=self.filters + [(field, op, value)])
+
+    def order_by(self, field, direction=Query.ASCENDING):
+        return self._copy(order=field, descending=direction == Query.DESCENDING)
+
+    def limit(self, count):
+        return self._copy(limit=count)
+
+    def start_after(self, snapshot):
+        return self._copy(after=snapshot)
+
+    async def stream(self):
+        await _yield()
+        rows = [
+            (doc_id, data) for (collection, doc_id), data in self.store.docs.items()
+            if collection == self.collection and all(
+                field in data and _OPERATORS[op](data[field], value) for field, op, value in self.filters
+            )
+        ]
+        if self.order:
+            rows = [row for row in rows if self.order in row[1]]
+            rows.sort(key=lambda row: (row[1][self.order], row[0]), reverse=self.descending)
+            if self.after is not None:
+                cursor = (self.after.to_dict()[self.order], self.after.id)
+                if self.descending:
+                    rows = [row for row in rows if (row[1][self.order], row[0]) < cursor]
+                else:
+                    rows = [row for row in rows if (row[1][self.order], row[0]) > cursor]
+        if self._limit:
+            rows = rows[:self._limit]
+        for doc_id, _ in rows:
+            yield self.store.snapshot(DocumentReference(self.store, self.collection, doc_id))
+
+
+class CollectionReference(CollectionQuery):
+    _ids = itertools.count(1)
+
+    def __init__(self, store, collection):
+        super().__init__(store, collection)
+
+    def document(self, doc_id=None):
+        return DocumentReference(self.store, self.collection, doc_id or f"auto{next(self._ids)}")
+
+
+class WriteBatch:
+    def __init__(self, store):
+        self.store = store
+        self._writes = []
+
+    def create(self, ref, data):
+        self._writes.append((ref, "create", data, None))
+
+    def set(self, ref, data, merge=False):
+        self._writes.append((ref, "set", data, None))
+
+    def update(self, ref, data, option=None):
+        self._writes.append((ref, "update", data, option))
+
+    def delete(self, ref):
+        self._writes.append((ref, "delete", None, None))
+
+    async def commit(self):
+        await _yield()
+        self.store.apply(self._writes)
+
+
+class Transaction(WriteBatch):
+    def __init__(self, store, max_attempts=5):
+        super().__init__(store)
+        self.max_attempts = max_attempts
+        self._reads = {}
+        self._held = []
+
+    def _begin(self):
+        self._reads = {}
+        self._writes = []
+
+    async def _lock(self, path):
+        lock = self.store.lock(path)
+        if lock in self._held:
+            return
+        if lock.locked():
+            self.store.lock_waits += 1
+        await lock.acquire()
+        self._held.append(lock)
+
+    def _release(self):
+        for lock in self._held:
+            lock.release()
+        self._held = []
+
+    def _commit(self):
+        # Прочитанные документы не изменили записи вне транзакций
+        for path, update_time in self._reads.items():
+            if self.store.times.get(path) != update_time:
+                raise google_exceptions.Aborted("Transaction contention")
+        self.store.apply(self._writes)
+
+
+def async_transactional(func):
+    async def wrapper(transaction, *args, **kwargs):
+        for attempt in range(transaction.max_attempts):
+            transaction._begin()
+            try:
+                result = await func(transaction, *args, **kwargs)
+                await _yield()
+                transaction._commit()
+                return result
+            except google_exceptions.Aborted:
+                transaction.store.aborts += 1
+            finally:
+                transaction._release()
+        raise google_exceptions.Aborted("Transaction retries exhausted")
+    return wrapper
+
+
+class AsyncClient:
+    def __init__(self):
+        self.store = Store()
+
+    def collection(self, name):
+        return CollectionReference(self.store, name)
+
+    def batch(self):
+        return WriteBatch(self.store)
+
+    def transaction(self, max_attempts=5):
+        return Transaction(self.store, max_attempts)
+
+    def write_option(self, last_update_time):
+        return WriteOption(last_update_time)
+
+    async def get_all(self, refs):
+        for ref in refs:
+            yield await ref.get()
+
+
+def install():
+    """Подменяет firebase_admin в sys.modules; вызывать до импорта database"""
+    firebase_admin = types.ModuleType("firebase_admin")
+    firebase_admin._apps = {}
+    firebase_admin.initialize_app = lambda *args, **kwargs: None
+
+    credentials = types.ModuleType("firebase_admin.credentials")
+    credentials.Certificate = lambda *args, **kwargs: None
+
+    firestore = types.ModuleType("firebase_admin.firestore")
+    firestore.SERVER_TIMESTAMP = SERVER_TIMESTAMP
+    firestore.DELETE_FIELD = DELETE_FIELD
+    firestore.Increment = Increment
+    firestore.Query = Query
+    firestore.async_transactional = async_transactional
+
+    firestore_async = types.ModuleType("firebase_admin.firestore_async")
+    firestore_async.client = lambda *args, **kwargs: AsyncClient()
+
+    firebase_admin.credentials = credentials
+    firebase_admin.firestore = firestore
+    firebase_admin.firestore_async = firestore_async
+    sys.modules.update({
+        "firebase_admin": firebase_admin,
+        "firebase_admin.credentials": credentials,
+        "firebase_admin.firestore": firestore,
+        "firebase_admin.firestore_async": firestore_async,
+    })
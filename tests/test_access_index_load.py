@@ -0,0 +1,49 @@
+"""Загрузка индекса доступа при ошибке чтения Firestore"""
+import asyncio
+import logging
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import fake_firestore
+import app
+import database
+
+
+@pytest.fixture(autouse=True)
+def store(monkeypatch):
+    logging.disable(logging.CRITICAL)
+    database.db.store = fake_firestore.Store()
+    monkeypatch.setattr(database, "user_cache", database.UserCache(database.USER_CACHE_SIZE, database.USER_CACHE_TTL))
+    monkeypatch.setattr(app, "expiry_index", app.ExpiryIndex(app.revoke_expired_user))
+    monkeypatch.setattr(app, "access_index", app.AccessIndex())
+    yield database.db.store
+    logging.disable(logging.NOTSET)
+
+
+def test_failed_load_keeps_index_not_ready_and_retries(monkeypatch):
+    async def failing_load():
+        raise Exception("Firestore unavailable")
+
+    async def scenario():
+        await database.db.collection('users').document('u1').set({
+            'user_id': 'u1',
+            'has_subscription': True,
+            'expires_at': datetime.now(timezone.utc) + timedelta(days=30),
+            'vless_uuid': 'uuid-u1'
+        })
+
+        with monkeypatch.context() as patch:
+            patch.setattr(database, "load_subscribed_users", failing_load)
+            assert not await app.load_subscription_indexes()
+            assert not app.access_index.ready
+            # Пока индекс не готов, проверка доступа идет в Firestore
+            response = await app.check_user_access('uuid-u1')
+            assert response['has_access']
+
+        # Плановая синхронизация повторяет полную загрузку
+        assert await app.sync_access_index() == 1
+        assert app.access_index.ready
+        assert app.access_index.check('uuid-u1')
+
+    asyncio.run(scenario())
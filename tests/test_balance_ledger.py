@@ -0,0 +1,84 @@
+"""Проводки по балансу под конкурентной нагрузкой на in-memory Firestore"""
+import asyncio
+import logging
+
+import pytest
+
+import fake_firestore
+import database
+
+
+@pytest.fixture(autouse=True)
+def store(monkeypatch):
+    logging.disable(logging.CRITICAL)
+    monkeypatch.setattr(database, "db", fake_firestore.AsyncClient())
+    monkeypatch.setattr(database, "user_cache", database.UserCache(database.USER_CACHE_SIZE, database.USER_CACHE_TTL))
+    yield database.db.store
+    logging.disable(logging.NOTSET)
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+async def create_user(user_id: str, balance: float):
+    await database.db.collection('users').document(user_id).set({'user_id': user_id, 'balance': balance})
+
+
+def ledger(store, user_id: str) -> list:
+    return [
+        entry for (collection, _), entry in store.docs.items()
+        if collection == 'balance_ledger' and entry['user_id'] == user_id
+    ]
+
+
+def test_parallel_debits_never_overdraw(store):
+    async def scenario():
+        await create_user('u1', 200.0)
+        return await asyncio.gather(*(
+            database.apply_balance_entry('u1', -1.0, f"debit_{i}", "tariff") for i in range(300)
+        ))
+
+    results = run(scenario())
+    statuses = [status for status, _ in results]
+    assert statuses.count(database.LEDGER_APPLIED) == 200
+    assert statuses.count(database.LEDGER_INSUFFICIENT) == 100
+    assert store.docs[('users', 'u1')]['balance'] == 0.0
+    assert sum(entry['amount'] for entry in ledger(store, 'u1')) == -200.0
+    # Транзакции действительно пересекались и ждали блокировку документа
+    assert store.lock_waits > 0
+
+
+def test_insufficient_funds_leaves_balance_untouched(store):
+    async def scenario():
+        await create_user('u1', 50.0)
+        return await database.apply_balance_entry('u1', -80.0, "debit", "tariff")
+
+    status, balance = run(scenario())
+    assert status == database.LEDGER_INSUFFICIENT
+    assert balance == 50.0
+    assert store.docs[('users', 'u1')]['balance'] == 50.0
+    assert ledger(store, 'u1') == []
+
+
+def test_duplicate_entry_id_applies_once(store):
+    async def scenario():
+        await create_user('u1', 0.0)
+        return await asyncio.gather(*(
+            database.apply_balance_entry('u1', 150.0, "payment_1", "top_up") for _ in range(20)
+        ))
+
+    results = run(scenario())
+    statuses = [status for status, _ in results]
+    assert statuses.count(database.LEDGER_APPLIED) == 1
+    assert statuses.count(database.LEDGER_DUPLICATE) == 19
+    assert {balance for _, balance in results} == {150.0}
+    assert store.docs[('users', 'u1')]['balance'] == 150.0
+    assert len(ledger(store, 'u1')) == 1
+
+
+def test_unknown_user(store):
+    status, balance = run(database.apply_balance_entry('missing', 10.0, "entry", "top_up"))
+    assert status == database.LEDGER_NOT_FOUND
+    assert balance is None
+    assert ledger(store, 'missing') == []
@@ -0,0 +1,163 @@
+"""Гонка webhook и опроса статуса против локального поддельного шлюза YooKassa"""
+import asyncio
+import logging
+from types import SimpleNamespace
+from datetime import timedelta
+
+import httpx
+import pytest
+
+import fake_firestore
+import app
+import database
+from yookassa_client import YooKassaClient
+
+TOP_UP = {
+    'payment_id': 'p1', 'user_id': 'u1', 'amount': 150.0, 'payment_type': 'balance',
+    'payment_method': 'yookassa', 'status': 'pending', 'yookassa_id': 'y1'
+}
+TARIFF = {
+    'payment_id': 'p2', 'user_id': 'u1', 'amount': 150.0, 'payment_type': 'tariff', 'tariff': '1month',
+    'payment_method': 'yookassa', 'status': 'pending', 'yookassa_id': 'y2'
+}
+
+
+class FakeGateway:
+    """GET /payments/{id} отдает заданный статус, считает обращения"""
+
+    def __init__(self):
+        self.payments = {}
+        self.calls = 0
+
+    def set(self, yookassa_id: str, payment_id: str, status: str, amount: str = "150.00"):
+        self.payments[yookassa_id] = {
+            'id': yookassa_id, 'status': status,
+            'amount': {'value': amount}, 'metadata': {'payment_id': payment_id}
+        }
+
+    async def handle(self, request: httpx.Request) -> httpx.Response:
+        self.calls += 1
+        await asyncio.sleep(0.001)
+        yookassa_id = request.url.path.rsplit('/', 1)[-1]
+        if yookassa_id not in self.payments:
+            return httpx.Response(404, json={'type': 'error'})
+        return httpx.Response(200, json=self.payments[yookassa_id])
+
+
+@pytest.fixture
+def env(monkeypatch):
+    logging.disable(logging.CRITICAL)
+    monkeypatch.setenv("SHOP_ID", "shop")
+    monkeypatch.setenv("API_KEY", "key")
+    database.db.store = fake_firestore.Store()
+    monkeypatch.setattr(database, "user_cache", database.UserCache(database.USER_CACHE_SIZE, database.USER_CACHE_TTL))
+
+    gateway = FakeGateway()
+    client = YooKassaClient(api_url="http://gateway/v3")
+    client._client = httpx.AsyncClient(transport=httpx.MockTransport(gateway.handle), base_url=client.api_url)
+    monkeypatch.setattr(app, "yookassa", client)
+
+    state = SimpleNamespace(gateway=gateway, activations=[], fail_activation=False)
+
+    async def fake_subscription_days(user_id, days, server_id=None):
+        state.activations.append(user_id)
+        return not state.fail_activation
+
+    monkeypatch.setattr(app, "update_subscription_days", fake_subscription_days)
+    yield state
+    logging.disable(logging.NOTSET)
+
+
+async def put(collection: str, doc_id: str, data: dict):
+    await database.db.collection(collection).document(doc_id).set(data)
+
+
+def doc(collection: str, doc_id: str) -> dict:
+    return database.db.store.docs[(collection, doc_id)]
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+async def send(requests):
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app.app), base_url="http://test") as client:
+        return await asyncio.gather(*(request(client) for request in requests))
+
+
+def webhook(yookassa_id):
+    return lambda client: client.post("/yookassa/webhook", json={"event": "payment.succeeded", "object": {"id": yookassa_id}})
+
+
+def poll(payment_id):
+    return lambda client: client.get("/payment-status", params={"payment_id": payment_id, "user_id": "u1"})
+
+
+def test_concurrent_webhooks_and_polls_apply_once(env):
+    gateway, activations = env.gateway, env.activations
+
+    async def scenario():
+        await put('users', 'u1', {'user_id': 'u1', 'balance': 0.0})
+        await put('payments', 'p1', dict(TOP_UP))
+        await put('payments', 'p2', dict(TARIFF))
+        gateway.set('y1', 'p1', 'succeeded')
+        gateway.set('y2', 'p2', 'succeeded')
+
+        requests = [webhook(y) for y in ('y1', 'y2') for _ in range(20)]
+        requests += [poll(p) for p in ('p1', 'p2') for _ in range(20)]
+        return await send(requests)
+
+    responses = run(scenario())
+    assert {response.status_code for response in responses} == {200}
+    assert doc('users', 'u1')['balance'] == 150.0
+    assert activations == ['u1']
+    assert doc('payments', 'p1')['status'] == 'succeeded'
+    assert doc('payments', 'p2')['status'] == 'succeeded'
+    assert doc('payments', 'p2')['applied'] is True
+
+
+def test_failed_activation_is_reapplied_by_reconciliation(env, monkeypatch):
+    gateway, activations = env.gateway, env.activations
+    env.fail_activation = True
+
+    async def scenario():
+        await put('users', 'u1', {'user_id': 'u1', 'balance': 0.0})
+        await put('payments', 'p2', dict(TARIFF))
+        gateway.set('y2', 'p2', 'succeeded')
+
+        first, = await send([webhook('y2')])
+        assert first.status_code == 500
+        assert doc('payments', 'p2')['applied'] is False
+
+        # Пока аренда первой попытки свежая, сверка активацию не повторяет
+        env.fail_activation = False
+        await app.reapply_unapplied_payments({"reapplied": 0, "errors": 0})
+        assert activations == ['u1']
+
+        monkeypatch.setattr(app, "PAYMENT_APPLY_LEASE", timedelta(0))
+        stats = {"reapplied": 0, "errors": 0}
+        await app.reapply_unapplied_payments(stats)
+        await app.reapply_unapplied_payments(stats)
+        return stats
+
+    stats = run(scenario())
+    assert stats == {"reapplied": 1, "errors": 0}
+    assert activations == ['u1', 'u1']
+    assert doc('payments', 'p2')['applied'] is True
+
+
+def test_late_intermediate_status_does_not_reopen_payment(env):
+    gateway = env.gateway
+
+    async def scenario():
+        await put('users', 'u1', {'user_id': 'u1', 'balance': 0.0})
+        await put('payments', 'p1', dict(TOP_UP))
+        gateway.set('y1', 'p1', 'succeeded')
+        await send([webhook('y1')])
+
+        # Устаревший снимок платежа со статусом pending и запоздалый промежуточный статус
+        assert await app.finalize_payment('p1', dict(TOP_UP), 'waiting_for_capture', 'y1')
+
+    run(scenario())
+    assert doc('payments', 'p1')['status'] == 'succeeded'
+    assert doc('users', 'u1')['balance'] == 150.0
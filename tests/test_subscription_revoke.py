@@ -0,0 +1,62 @@
+"""Отзыв истекшей подписки одновременно с продлением"""
+import asyncio
+import logging
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import fake_firestore
+import app
+import database
+
+
+@pytest.fixture(autouse=True)
+def store(monkeypatch):
+    logging.disable(logging.CRITICAL)
+    database.db.store = fake_firestore.Store()
+    monkeypatch.setattr(database, "user_cache", database.UserCache(database.USER_CACHE_SIZE, database.USER_CACHE_TTL))
+    monkeypatch.setattr(app, "expiry_index", app.ExpiryIndex(app.revoke_expired_user))
+    monkeypatch.setattr(app, "access_index", app.AccessIndex())
+    yield database.db.store
+    logging.disable(logging.NOTSET)
+
+
+async def create_expired_user(user_id: str):
+    await database.db.collection('users').document(user_id).set({
+        'user_id': user_id,
+        'has_subscription': True,
+        'expires_at': datetime.now(timezone.utc) - timedelta(minutes=1),
+        'vless_uuid': f"uuid-{user_id}"
+    })
+
+
+# Порядок чередования задач в подделке случайный, поэтому сценарий повторяется
+@pytest.mark.parametrize("attempt", range(20))
+def test_revoke_does_not_undo_concurrent_renewal(store, attempt):
+    async def scenario():
+        await create_expired_user('u1')
+        # Кэш держит истекшее состояние, как при срабатывании индекса сроков
+        assert (await database.get_user('u1'))['revocation_pending']
+        return await asyncio.gather(
+            app.revoke_expired_user('u1'),
+            app.update_subscription_days('u1', 30)
+        )
+
+    _, renewed = asyncio.run(scenario())
+    user = store.docs[('users', 'u1')]
+    assert renewed
+    assert user['has_subscription'] is True
+    assert user['expires_at'] > datetime.now(timezone.utc) + timedelta(days=29)
+    assert app.expiry_index.stats()['tracked'] == 1
+    assert app.access_index.check('uuid-u1')
+
+
+def test_revoke_expired_subscription(store):
+    async def scenario():
+        await create_expired_user('u1')
+        return await app.revoke_if_expired('u1', await database.get_user('u1'))
+
+    assert asyncio.run(scenario())
+    user = store.docs[('users', 'u1')]
+    assert user['has_subscription'] is False
+    assert user['expires_at'] is None
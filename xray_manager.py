@@ -1,7 +1,268 @@
+import os
+import json
+import hashlib
+import uuid
+import time
+import asyncio
+import logging
+import subprocess
+import tempfile
+from typing import List
+
+from config_renderer import ConfigRenderer
+
+logger = logging.getLogger(__name__)
+
+XRAY_CONFIG_PATH = "/usr/local/etc/xray/config.json"
+XRAY_BIN = os.getenv("XRAY_BIN", "/usr/local/bin/xray")
+XRAY_API_SERVER = os.getenv("XRAY_API_SERVER", "127.0.0.1:10085")
+XRAY_HOT_RELOAD = os.getenv("XRAY_HOT_RELOAD", "true").lower() == "true"
+# Окно, в течение которого изменения копятся в одну запись конфига
+XRAY_COMMIT_WINDOW = float(os.getenv("XRAY_COMMIT_WINDOW", "0.5"))
+
+
+def uuid_set_digest(uuids) -> str:
+    """Хэш набора UUID, одинаковый на ноде и в приложении"""
+    return hashlib.sha256("\n".join(sorted(uuids)).encode()).hexdigest()
+
+
+class XrayApiClient:
+    """HandlerService запущенного Xray через `xray api adu/rmu`
+
+    Добавление и удаление клиентов без перезапуска процесса. Для тестов
+    XRAY_BIN можно указать на локальную заглушку с тем же интерфейсом.
+    """
+    
+    def __init__(self, server: str = XRAY_API_SERVER, xray_bin: str = XRAY_BIN):
+        self.server = server
+        self.xray_bin = xray_bin
+    
+    async def _run(self, command: str, *args) -> bool:
+        # Флаги Go разбираются только до первого позиционного аргумента
+        process = await asyncio.create_subprocess_exec(
+            self.xray_bin, "api", command, f"--server={self.server}", *args,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE
+        )
+        stdout, stderr = await asyncio.wait_for(process.communicate(), timeout=10)
+        if process.returncode != 0:
+            logger.error(f"❌ xray api {command} failed: {stderr.decode().strip()}")
+            return False
+        return True
+    
+    async def add_users(self, inbound: dict, clients: List[dict]) -> bool:
+        """AlterInbound AddUser для списка клиентов одного inbound"""
+        inbound_patch = dict(inbound)
+        inbound_patch['settings'] = dict(inbound.get('settings', {}), clients=clients)
+        
+        with tempfile.NamedTemporaryFile('w', suffix='.json', delete=False) as f:
+            json.dump({"inbounds": [inbound_patch]}, f)
+            patch_path = f.name
+        try:
+            return await self._run("adu", patch_path)
+        finally:
+            os.unlink(patch_path)
+    
+    async def remove_users(self, tag: str, emails: List[str]) -> bool:
+        """AlterInbound RemoveUser по email"""
+        return await self._run("rmu", f"-tag={tag}", *emails)
+
+
 class XrayManager:
-    def __init__(self):
+    """Управление клиентами Xray через единую очередь изменений
+
+    Все изменения применяются к конфигу в памяти одним воркером. За окно
+    XRAY_COMMIT_WINDOW они копятся и фиксируются одной атомарной записью
+    файла и одним обновлением запущенного Xray.
+    """
+    
+    def __init__(self, api_client: XrayApiClient = None, hot_reload: bool = XRAY_HOT_RELOAD,
+                 config_path: str = XRAY_CONFIG_PATH, commit_window: float = XRAY_COMMIT_WINDOW):
         self.script_path = "/usr/local/bin/add_vpn_user"
+        self.api_client = api_client or XrayApiClient()
+        self.hot_reload = hot_reload
+        self.config_path = config_path
+        self.commit_window = commit_window
+        self._config = None
+        # Индексы клиентов первого inbound: id -> клиент и email -> id.
+        # Порядок словаря совпадает с порядком списка в конфиге
+        self._clients = {}
+        self._id_by_email = {}
+        # Закодированные в JSON клиенты для потоковой записи конфига
+        self._encoded = {}
+        self._renderer = None
+        self._digest = None
+        self._queue = None
+        self._worker = None
+        self.commits = 0
+        self.mutations = 0
+        self.last_commit = {}
+    
+    def _load_config(self) -> dict:
+        if self._config is None:
+            with open(self.config_path, 'r') as f:
+                config = json.load(f)
+            
+            self._clients = {}
+            self._id_by_email = {}
+            self._encoded = {}
+            for client in config['inbounds'][0]['settings']['clients']:
+                user_uuid = client.get('id')
+                if user_uuid in self._clients:
+                    logger.warning(f"⚠️ Duplicate client {user_uuid} in config, keeping the first one")
+                    continue
+                self._clients[user_uuid] = client
+                self._encoded[user_uuid] = ConfigRenderer.encode_client(client)
+                if client.get('email'):
+                    self._id_by_email[client['email']] = user_uuid
+            
+            # Клиенты живут в индексе, в конфиге остается только шаблон
+            config['inbounds'][0]['settings']['clients'] = []
+            self._renderer = ConfigRenderer(config)
+            self._config = config
+        return self._config
+    
+    def _inbound(self) -> dict:
+        return self._load_config()['inbounds'][0]
+    
+    def _write_config_atomic(self, encoded_clients: List[str]):
+        """Запись через временный файл, fsync и rename: файл всегда целый"""
+        tmp_path = f"{self.config_path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            self._renderer.write(f, encoded_clients)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.config_path)
+        
+        dir_fd = os.open(os.path.dirname(os.path.abspath(self.config_path)), os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+    
+    async def apply_runtime(self, inbound: dict, added: List[dict], removed_emails: List[str]):
+        """Применяет изменения к запущенному Xray: через API, при ошибке перезапуском"""
+        if not added and not removed_emails:
+            return
+        
+        # Клиента без email через API не удалить - его уберет только перезапуск
+        emails = [email for email in removed_emails if email]
+        if self.hot_reload and len(emails) == len(removed_emails):
+            try:
+                tag = inbound.get('tag', 'inbound-1')
+                ok = True
+                if emails:
+                    ok = await self.api_client.remove_users(tag, emails)
+                if ok and added:
+                    ok = await self.api_client.add_users(inbound, added)
+                if ok:
+                    logger.info(f"⚡ Hot update: +{len(added)} / -{len(removed_emails)} users without restart")
+                    return
+            except Exception as e:
+                logger.error(f"❌ Hot update failed: {e}")
+            logger.warning("⚠️ Falling back to Xray restart")
+        
+        await self.restart_xray()
+        
+    async def _submit(self, mutations: List[tuple]) -> List[dict]:
+        """Ставит изменения в очередь и ждет их фиксации"""
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.create_task(self._commit_loop())
+        
+        loop = asyncio.get_running_loop()
+        futures = []
+        for mutation in mutations:
+            future = loop.create_future()
+            self._queue.put_nowait((mutation, future))
+            futures.append(future)
+        return list(await asyncio.gather(*futures))
+    
+    def _apply(self, mutation: tuple, added: dict, removed_emails: List[str]) -> dict:
+        """Применяет одно изменение к конфигу в памяти, копит итоговую разницу для Xray"""
+        action, value = mutation
+        self._load_config()
+        self._digest = None
+        
+        if action == "add":
+            user_uuid = value['id']
+            if user_uuid in self._clients:
+                return {"uuid": user_uuid, "action": "add", "success": True, "status": "exists"}
+            if value.get('email') in self._id_by_email:
+                # Xray требует уникальный email внутри inbound
+                return {"uuid": user_uuid, "action": "add", "success": False, "status": "email_conflict"}
+            self._clients[user_uuid] = value
+            self._encoded[user_uuid] = ConfigRenderer.encode_client(value)
+            if value.get('email'):
+                self._id_by_email[value['email']] = user_uuid
+            added[user_uuid] = value
+            return {"uuid": user_uuid, "action": "add", "success": True, "status": "added"}
         
+        user_uuid = value if action == "remove" else self._id_by_email.get(value)
+        client = self._clients.pop(user_uuid, None)
+        if client is None:
+            return {"uuid": value, "action": "remove", "success": True, "status": "not_found"}
+        
+        self._id_by_email.pop(client.get('email'), None)
+        self._encoded.pop(user_uuid, None)
+        # Добавленный в этом же окне клиент еще не попал в Xray
+        if added.pop(user_uuid, None) is None:
+            removed_emails.append(client.get('email'))
+        return {"uuid": value, "action": "remove", "success": True, "status": "removed"}
+    
+    async def _commit_loop(self):
+        while True:
+            batch = [await self._queue.get()]
+            await asyncio.sleep(self.commit_window)
+            while not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            
+            started = time.monotonic()
+            added = {}
+            removed_emails = []
+            results = []
+            try:
+                for mutation, _ in batch:
+                    results.append(self._apply(mutation, added, removed_emails))
+                
+                if added or removed_emails:
+                    await asyncio.to_thread(self._write_config_atomic, list(self._encoded.values()))
+                    await self.apply_runtime(self._inbound(), list(added.values()), removed_emails)
+            except Exception as e:
+                logger.error(f"❌ Error committing Xray config: {e}")
+                # Конфиг в памяти мог разойтись с файлом - перечитываем
+                self._config = None
+                self._digest = None
+                results = [
+                    {"uuid": mutation[1]['id'] if mutation[0] == "add" else mutation[1],
+                     "action": "add" if mutation[0] == "add" else "remove",
+                     "success": False, "status": "error", "error": str(e)}
+                    for mutation, _ in batch
+                ]
+            
+            self.commits += 1
+            self.mutations += len(batch)
+            self.last_commit = {
+                "mutations": len(batch),
+                "added": len(added),
+                "removed": len(removed_emails),
+                "duration_ms": round((time.monotonic() - started) * 1000, 1)
+            }
+            logger.info(f"💾 Xray commit absorbed {len(batch)} mutations (+{len(added)} / -{len(removed_emails)})")
+            
+            for (_, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+    
+    def stats(self) -> dict:
+        return {
+            "commits": self.commits,
+            "mutations": self.mutations,
+            "avg_mutations_per_commit": round(self.mutations / self.commits, 2) if self.commits else 0.0,
+            "last_commit": self.last_commit
+        }
+    
     async def add_user(self, email: str, uuid_str: str = None) -> bool:
         """Добавляет пользователя через скрипт"""
         try:
@@ -22,27 +283,15 @@ class XrayManager:
             if not uuid_str:
                 uuid_str = str(uuid.uuid4())
             
-            config_path = "/usr/local/etc/xray/config.json"
-            
-            # Читаем конфиг
-            with open(config_path, 'r') as f:
-                config = json.load(f)
-            
             new_user = {
                 "id": uuid_str,
                 "email": email,
                 "flow": ""
             }
             
-            # Добавляем пользователя в первый inbound
-            config['inbounds'][0]['settings']['clients'].append(new_user)
-            
-            # Сохраняем конфиг
-            with open(config_path, 'w') as f:
-                json.dump(config, f, indent=2)
-            
-            # На Railway перезапускаем Xray через pkill + запуск в фоне
-            await self.restart_xray()
+            result = (await self._submit([("add", new_user)]))[0]
+            if not result["success"]:
+                return False, None
             
             logger.info(f"✅ User {email} successfully added directly to config")
             return True, uuid_str
@@ -55,14 +304,14 @@ class XrayManager:
         """Перезапускает Xray на Railway"""
         try:
             # Ищем процесс Xray и убиваем его
-            subprocess.run(["pkill", "-f", "xray"], capture_output=True)
+            subprocess.run(["pkill", "-x", "xray"], capture_output=True)
             
             # Ждем немного
             await asyncio.sleep(2)
             
             # Запускаем Xray в фоне
             subprocess.Popen([
-                "/usr/local/bin/xray", "run", "-config", "/usr/local/etc/xray/config.json"
+                "/usr/local/bin/xray", "run", "-config", self.config_path
             ])
             
             logger.info("✅ Xray restarted")
@@ -75,35 +324,49 @@ class XrayManager:
         try:
             logger.info(f"🔄 Removing user from config: {email}")
             
-            config_path = "/usr/local/etc/xray/config.json"
-            
-            # Читаем конфиг
-            with open(config_path, 'r') as f:
-                config = json.load(f)
+            result = (await self._submit([("remove_email", email)]))[0]
+            if result["status"] == "removed":
+                logger.info(f"✅ Removed user {email} from config")
             
-            # Удаляем пользователя
-            for inbound in config['inbounds']:
-                if inbound.get('tag') == 'inbound-1':
-                    original_count = len(inbound['settings']['clients'])
-                    inbound['settings']['clients'] = [
-                        client for client in inbound['settings']['clients'] 
-                        if client.get('email') != email
-                    ]
-                    new_count = len(inbound['settings']['clients'])
-                    
-                    if new_count < original_count:
-                        logger.info(f"✅ Removed user {email} from config")
-                    break
-            
-            # Сохраняем конфиг
-            with open(config_path, 'w') as f:
-                json.dump(config, f, indent=2)
-            
-            # Перезапускаем Xray
-            await self.restart_xray()
-            
-            return True
+            return result["success"]
             
         except Exception as e:
             logger.error(f"❌ Error removing user: {e}")
             return False
+    
+    async def apply_batch(self, add: List[dict], remove: List[str]) -> List[dict]:
+        """Добавляет и удаляет группу пользователей через общую очередь изменений"""
+        logger.info(f"🔄 Applying batch: +{len(add)} / -{len(remove)} users")
+        
+        # Сначала удаления, затем добавления - тот же порядок, что и в apply_runtime
+        mutations = [("remove", user_uuid) for user_uuid in remove]
+        mutations += [
+            ("add", {"id": item['uuid'], "email": item.get('email') or item['uuid'], "flow": ""})
+            for item in add
+        ]
+        return await self._submit(mutations)
+    
+    def user_exists(self, user_uuid: str) -> bool:
+        """Проверяет наличие пользователя в конфиге"""
+        self._load_config()
+        return user_uuid in self._clients
+    
+    def list_uuids(self) -> List[str]:
+        """Все UUID клиентов в конфиге"""
+        self._load_config()
+        return list(self._clients)
+    
+    def users_count(self) -> int:
+        """Количество клиентов без копирования списка"""
+        self._load_config()
+        return len(self._clients)
+    
+    def digest(self) -> dict:
+        """Количество клиентов и sha256 отсортированных UUID, кэшируется до изменения"""
+        self._load_config()
+        if self._digest is None:
+            self._digest = {
+                "count": len(self._clients),
+                "hash": uuid_set_digest(self._clients)
+            }
+        return self._digest
@@ -0,0 +1,108 @@
+from fastapi import FastAPI, Header
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel
+from typing import List, Optional
+import os
+import logging
+from datetime import datetime
+
+from xray_manager import XrayManager
+
+# API ноды Xray: добавление/удаление пользователей поверх XrayManager
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+app = FastAPI(title="VAC VPN Xray Node API")
+
+NODE_API_KEY = os.getenv("XRAY_API_KEY", "")
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "10000"))
+
+manager = XrayManager()
+
+class UserRequest(BaseModel):
+    uuid: str
+    email: Optional[str] = None
+
+class BatchRequest(BaseModel):
+    add: List[UserRequest] = []
+    remove: List[str] = []
+
+def unauthorized(x_api_key: Optional[str]):
+    if NODE_API_KEY and x_api_key != NODE_API_KEY:
+        return JSONResponse(status_code=401, content={"error": "Invalid API key"})
+    return None
+
+@app.get("/health")
+async def health():
+    return {
+        "status": "healthy",
+        "timestamp": datetime.now().isoformat(),
+        "users": manager.users_count(),
+        "commits": manager.stats()
+    }
+
+@app.get("/user/{user_uuid}")
+async def get_user(user_uuid: str, x_api_key: Optional[str] = Header(None)):
+    error = unauthorized(x_api_key)
+    if error:
+        return error
+    return {"uuid": user_uuid, "exists": manager.user_exists(user_uuid)}
+
+@app.get("/users/digest")
+async def users_digest(x_api_key: Optional[str] = Header(None)):
+    """Дайджест набора пользователей: неизменившаяся нода сверяется одним запросом"""
+    error = unauthorized(x_api_key)
+    if error:
+        return error
+    return manager.digest()
+
+@app.get("/users")
+async def list_users(x_api_key: Optional[str] = Header(None)):
+    error = unauthorized(x_api_key)
+    if error:
+        return error
+    uuids = manager.list_uuids()
+    return {"count": len(uuids), "uuids": uuids}
+
+@app.post("/user")
+async def add_user(request: UserRequest, x_api_key: Optional[str] = Header(None)):
+    error = unauthorized(x_api_key)
+    if error:
+        return error
+    results = await manager.apply_batch([request.model_dump()], [])
+    return results[0]
+
+@app.delete("/user/{user_uuid}")
+async def remove_user(user_uuid: str, x_api_key: Optional[str] = Header(None)):
+    error = unauthorized(x_api_key)
+    if error:
+        return error
+    results = await manager.apply_batch([], [user_uuid])
+    return results[0]
+
+@app.post("/users/batch")
+async def batch_users(request: BatchRequest, x_api_key: Optional[str] = Header(None)):
+    """Пакетное добавление/удаление: одна запись конфига на весь запрос, результат по каждому UUID"""
+    error = unauthorized(x_api_key)
+    if error:
+        return error
+    
+    if len(request.add) + len(request.remove) > BATCH_MAX_ITEMS:
+        return JSONResponse(status_code=400, content={"error": f"Batch is limited to {BATCH_MAX_ITEMS} items"})
+    
+    results = await manager.apply_batch([item.model_dump() for item in request.add], request.remove)
+    
+    return {
+        "success": all(item["success"] for item in results),
+        "added": sum(1 for item in results if item["status"] == "added"),
+        "removed": sum(1 for item in results if item["status"] == "removed"),
+        "results": results
+    }
+
+if __name__ == "__main__":
+    import uvicorn
+    port = int(os.environ.get("PORT", 8001))
+    uvicorn.run(app, host="0.0.0.0", port=port)
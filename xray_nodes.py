@@ -0,0 +1,157 @@
+import os
+import time
+import asyncio
+import logging
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+# Настройки пула соединений к API нод Xray
+XRAY_MAX_CONNECTIONS = int(os.getenv("XRAY_MAX_CONNECTIONS", "20"))
+XRAY_MAX_KEEPALIVE = int(os.getenv("XRAY_MAX_KEEPALIVE", "10"))
+XRAY_KEEPALIVE_EXPIRY = float(os.getenv("XRAY_KEEPALIVE_EXPIRY", "60"))
+XRAY_HTTP2 = os.getenv("XRAY_HTTP2", "false").lower() == "true"
+XRAY_DEFAULT_TIMEOUT = float(os.getenv("XRAY_DEFAULT_TIMEOUT", "5"))
+# Параллельные запросы к нескольким нодам
+XRAY_FANOUT_CONCURRENCY = int(os.getenv("XRAY_FANOUT_CONCURRENCY", "10"))
+XRAY_FANOUT_DEADLINE = float(os.getenv("XRAY_FANOUT_DEADLINE", "5"))
+
+
+class NodeStats:
+    """Счетчики запросов к одной ноде"""
+
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.total_latency = 0.0
+        self.last_latency = 0.0
+        self.max_latency = 0.0
+
+    def record(self, latency: float, error: bool):
+        self.requests += 1
+        if error:
+            self.errors += 1
+        self.total_latency += latency
+        self.last_latency = latency
+        self.max_latency = max(self.max_latency, latency)
+
+    def as_dict(self) -> dict:
+        return {
+            "requests": self.requests,
+            "errors": self.errors,
+            "avg_latency_ms": round(self.total_latency / self.requests * 1000, 1) if self.requests else 0.0,
+            "last_latency_ms": round(self.last_latency * 1000, 1),
+            "max_latency_ms": round(self.max_latency * 1000, 1)
+        }
+
+
+class NodeClientRegistry:
+    """Один долгоживущий keep-alive клиент httpx на каждую ноду Xray"""
+
+    def __init__(self, servers: dict):
+        self.servers = servers
+        self._clients = {}
+        self._stats = {server_id: NodeStats() for server_id in servers}
+
+    def start(self):
+        http2 = XRAY_HTTP2
+        if http2:
+            try:
+                import h2  # noqa: F401
+            except ImportError:
+                logger.warning("⚠️ XRAY_HTTP2 enabled but 'h2' is not installed, using HTTP/1.1")
+                http2 = False
+
+        limits = httpx.Limits(
+            max_connections=XRAY_MAX_CONNECTIONS,
+            max_keepalive_connections=XRAY_MAX_KEEPALIVE,
+            keepalive_expiry=XRAY_KEEPALIVE_EXPIRY
+        )
+
+        for server_id, server_config in self.servers.items():
+            if server_id in self._clients:
+                continue
+            self._clients[server_id] = httpx.AsyncClient(
+                base_url=server_config["url"],
+                headers={"X-API-Key": server_config["api_key"]},
+                limits=limits,
+                timeout=XRAY_DEFAULT_TIMEOUT,
+                http2=http2
+            )
+
+        logger.info(f"✅ Xray node clients started: {len(self._clients)} nodes, http2={http2}")
+
+    async def close(self):
+        for client in self._clients.values():
+            await client.aclose()
+        self._clients.clear()
+
+    def client(self, server_id: str) -> httpx.AsyncClient:
+        if server_id not in self._clients:
+            # Ленивая инициализация, если запрос пришел до startup
+            self.start()
+        return self._clients[server_id]
+
+    async def request(self, server_id: str, method: str, path: str, **kwargs) -> httpx.Response:
+        """Запрос к ноде через общий клиент с учетом задержки и ошибок"""
+        started = time.monotonic()
+        error = True
+        try:
+            response = await self.client(server_id).request(method, path, **kwargs)
+            error = response.status_code >= 500
+            return response
+        finally:
+            self._stats[server_id].record(time.monotonic() - started, error)
+
+    async def get(self, server_id: str, path: str, **kwargs) -> httpx.Response:
+        return await self.request(server_id, "GET", path, **kwargs)
+
+    async def post(self, server_id: str, path: str, **kwargs) -> httpx.Response:
+        return await self.request(server_id, "POST", path, **kwargs)
+
+    def stats(self) -> dict:
+        return {server_id: stats.as_dict() for server_id, stats in self._stats.items()}
+
+    async def fan_out(self, server_ids: list, call, deadline: float = XRAY_FANOUT_DEADLINE,
+                      concurrency: int = XRAY_FANOUT_CONCURRENCY) -> dict:
+        """Вызывает call(server_id) на всех нодах параллельно и ждет всех
+
+        Возвращает server_id -> результат или исключение. Нода, не ответившая
+        за deadline, получает asyncio.TimeoutError и не задерживает остальные.
+        """
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def run(server_id):
+            async with semaphore:
+                return await asyncio.wait_for(call(server_id), timeout=deadline)
+
+        results = await asyncio.gather(*(run(server_id) for server_id in server_ids), return_exceptions=True)
+        return dict(zip(server_ids, results))
+
+    async def first_success(self, server_ids: list, call, predicate=bool,
+                            deadline: float = XRAY_FANOUT_DEADLINE,
+                            concurrency: int = XRAY_FANOUT_CONCURRENCY):
+        """Параллельный опрос нод до первого результата, прошедшего predicate
+
+        Возвращает (server_id, результат) или None. Оставшиеся запросы отменяются.
+        """
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def run(server_id):
+            async with semaphore:
+                return server_id, await asyncio.wait_for(call(server_id), timeout=deadline)
+
+        tasks = [asyncio.create_task(run(server_id)) for server_id in server_ids]
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                try:
+                    server_id, result = await next_done
+                except Exception:
+                    continue
+                if predicate(result):
+                    return server_id, result
+            return None
+        finally:
+            for task in tasks:
+                task.cancel()
@@ -0,0 +1,188 @@
+import os
+import time
+import asyncio
+import logging
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+YOOKASSA_API_URL = os.getenv("YOOKASSA_API_URL", "https://api.yookassa.ru/v3")
+YOOKASSA_TIMEOUT = float(os.getenv("YOOKASSA_TIMEOUT", "10"))
+# Одновременных запросов к шлюзу: медленный шлюз не займет все задачи event loop
+YOOKASSA_MAX_CONCURRENCY = int(os.getenv("YOOKASSA_MAX_CONCURRENCY", "20"))
+# Сколько держать в кэше нефинальный статус платежа
+YOOKASSA_STATUS_TTL = float(os.getenv("YOOKASSA_STATUS_TTL", "5"))
+YOOKASSA_BREAKER_THRESHOLD = 5
+YOOKASSA_BREAKER_RESET = 30.0
+
+FINAL_STATUSES = ('succeeded', 'canceled')
+
+
+class CircuitOpenError(Exception):
+    """Шлюз временно отключен после серии ошибок"""
+
+
+class CircuitBreaker:
+    """Размыкается после threshold ошибок подряд, через reset_timeout пропускает пробный запрос"""
+
+    def __init__(self, threshold: int = YOOKASSA_BREAKER_THRESHOLD, reset_timeout: float = YOOKASSA_BREAKER_RESET):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+        self.rejected = 0
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half_open"
+        return "open"
+
+    def allow(self) -> bool:
+        """Пропускает запрос или бросает CircuitOpenError; True - это пробный запрос"""
+        state = self.state
+        if state == "closed":
+            return False
+        if state == "half_open" and not self._probing:
+            self._probing = True
+            return True
+        self.rejected += 1
+        raise CircuitOpenError("Payment gateway temporarily unavailable")
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+
+    def record_failure(self):
+        self.failures += 1
+        self._probing = False
+        if self.failures >= self.threshold:
+            if self.opened_at is None:
+                logger.error(f"❌ YooKassa circuit opened after {self.failures} failures")
+            self.opened_at = time.monotonic()
+
+    def release(self):
+        """Пробный запрос прерван без результата: следующий вызов снова может пробовать"""
+        self._probing = False
+
+
+class YooKassaClient:
+    """Общий клиент YooKassa: пул соединений, single-flight и кэш статусов"""
+
+    def __init__(self, api_url: str = YOOKASSA_API_URL):
+        self.api_url = api_url
+        self._client = None
+        self._semaphore = asyncio.Semaphore(YOOKASSA_MAX_CONCURRENCY)
+        self.breaker = CircuitBreaker()
+        # yookassa_id -> задача запроса, которую разделяют конкурентные вызовы
+        self._inflight = {}
+        # yookassa_id -> (момент истечения, данные платежа)
+        self._status_cache = {}
+        self.requests = 0
+        self.shared = 0
+        self.cache_hits = 0
+
+    @property
+    def configured(self) -> bool:
+        return bool(os.getenv("SHOP_ID") and os.getenv("API_KEY"))
+
+    def client(self) -> httpx.AsyncClient:
+        if self._client is None:
+            if not self.configured:
+                raise Exception("Payment gateway not configured")
+            self._client = httpx.AsyncClient(
+                base_url=self.api_url,
+                auth=(os.getenv("SHOP_ID"), os.getenv("API_KEY")),
+                limits=httpx.Limits(max_connections=YOOKASSA_MAX_CONCURRENCY, max_keepalive_connections=10),
+                timeout=YOOKASSA_TIMEOUT
+            )
+        return self._client
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def request(self, method: str, path: str, **kwargs) -> httpx.Response:
+        """Запрос через предохранитель: 5xx и сетевые ошибки считаются отказом шлюза"""
+        probe = self.breaker.allow()
+        try:
+            async with self._semaphore:
+                self.requests += 1
+                try:
+                    response = await self.client().request(method, path, **kwargs)
+                except Exception:
+                    self.breaker.record_failure()
+                    raise
+            if response.status_code >= 500:
+                self.breaker.record_failure()
+            else:
+                self.breaker.record_success()
+            return response
+        finally:
+            # Отмена (CancelledError) не должна оставить предохранитель в пробе навсегда
+            if probe:
+                self.breaker.release()
+
+    async def create_payment(self, data: dict, idempotence_key: str) -> httpx.Response:
+        return await self.request("POST", "/payments", json=data, headers={"Idempotence-Key": idempotence_key})
+
+    async def _fetch_payment(self, yookassa_id: str) -> dict:
+        response = await self.request("GET", f"/payments/{yookassa_id}")
+        if response.status_code != 200:
+            raise Exception(f"Payment gateway error: {response.status_code}")
+        data = response.json()
+        if data.get('status') not in FINAL_STATUSES:
+            now = time.monotonic()
+            if len(self._status_cache) > 10000:
+                self._status_cache = {key: entry for key, entry in self._status_cache.items() if entry[0] > now}
+            self._status_cache[yookassa_id] = (now + YOOKASSA_STATUS_TTL, data)
+        else:
+            self._status_cache.pop(yookassa_id, None)
+        return data
+
+    def _finish(self, key: tuple, task: asyncio.Task):
+        self._inflight.pop(key, None)
+        # Ошибка забирается здесь, даже если все ожидающие уже отменены
+        if not task.cancelled():
+            task.exception()
+
+    async def get_payment(self, yookassa_id: str, fresh: bool = False) -> dict:
+        """Состояние платежа; конкурентные вызовы ждут один запрос, ожидающие статусы кэшируются
+
+        fresh=True - мимо кэша (для уведомлений, где важен текущий статус);
+        такие вызовы разделяют только свежие запросы друг друга.
+        """
+        cached = None if fresh else self._status_cache.get(yookassa_id)
+        if cached is not None:
+            if cached[0] > time.monotonic():
+                self.cache_hits += 1
+                return cached[1]
+            del self._status_cache[yookassa_id]
+
+        key = (yookassa_id, fresh)
+        task = self._inflight.get(key)
+        if task is not None:
+            self.shared += 1
+        else:
+            task = asyncio.create_task(self._fetch_payment(yookassa_id))
+            self._inflight[key] = task
+            task.add_done_callback(lambda done: self._finish(key, done))
+        # shield: отмена одного ожидающего не отменяет общий запрос
+        return await asyncio.shield(task)
+
+    def stats(self) -> dict:
+        return {
+            "circuit": self.breaker.state,
+            "requests": self.requests,
+            "shared": self.shared,
+            "cache_hits": self.cache_hits,
+            "rejected": self.breaker.rejected,
+            "inflight": len(self._inflight),
+            "cached": len(self._status_cache)
+        }